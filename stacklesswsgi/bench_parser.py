@@ -0,0 +1,214 @@
+#
+# A micro-benchmark for the HTTP request parser in stacklesswsgi.
+#
+# It compares HTTPRequest.parse_request, which waits for the whole request
+# head and parses it in a single pass, with the line-by-line parser that
+# stacklesswsgi used before (reproduced below in legacy_request). Both read
+# from an in-memory stand-in for the connection, so only parsing is measured.
+#
+# Usage: python bench_parser.py [iterations]
+#
+
+import sys
+import time
+from urllib import unquote
+from urlparse import urlparse
+
+import stacklesswsgi
+
+
+class string_rfile(object):
+    """Just enough of sock_channel_rfile to parse requests from a string."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def readline(self, limit=-1):
+        end = self.data.find("\n", self.pos)
+        end = len(self.data) if end < 0 else end + 1
+        if limit >= 0:
+            end = min(end, self.pos + limit)
+        line = self.data[self.pos:end]
+        self.pos = end
+        return line
+
+    def read_until(self, delimiter, limit):
+        end = self.data.find(delimiter, self.pos, self.pos + limit)
+        if end < 0:
+            return None
+        end += len(delimiter)
+        head = self.data[self.pos:end]
+        self.pos = end
+        return head
+
+
+class legacy_request(stacklesswsgi.HTTPRequest):
+    """HTTPRequest with the line-by-line parser stacklesswsgi used before,
+    comments removed."""
+
+    def parse_request(self):
+        """Parse the next HTTP request start-line and message-headers."""
+        request_line = self.rfile.readline()
+        if not request_line:
+            self.ready = False
+            return
+
+        if request_line == "\r\n":
+            request_line = self.rfile.readline()
+            if not request_line:
+                self.ready = False
+                return
+
+        environ = self.environ
+
+        method, path, req_protocol = request_line.strip().split(" ", 2)
+        environ["REQUEST_METHOD"] = method
+
+        scheme, location, path, params, qs, frag = urlparse(path)
+
+        if frag:
+            self.simple_response("400 Bad Request",
+                                 "Illegal #fragment in Request-URI.")
+            return
+
+        if scheme:
+            environ["wsgi.url_scheme"] = scheme
+        if params:
+            path = path + ";" + params
+
+        environ["SCRIPT_NAME"] = ""
+
+        atoms = [unquote(x) for x in stacklesswsgi.quoted_slash.split(path)]
+        path = "%2F".join(atoms)
+        environ["PATH_INFO"] = path
+
+        environ["QUERY_STRING"] = qs
+
+        rp = int(req_protocol[5]), int(req_protocol[7])
+        server_protocol = environ["ACTUAL_SERVER_PROTOCOL"]
+        sp = int(server_protocol[5]), int(server_protocol[7])
+        if sp[0] != rp[0]:
+            self.simple_response("505 HTTP Version Not Supported")
+            return
+        environ["SERVER_PROTOCOL"] = req_protocol
+        self.response_protocol = "HTTP/%s.%s" % min(rp, sp)
+
+        if location:
+            environ["SERVER_NAME"] = location
+
+        try:
+            self.read_headers()
+        except ValueError, ex:
+            self.simple_response("400 Bad Request", repr(ex.args))
+            return
+
+        creds = environ.get("HTTP_AUTHORIZATION", "").split(" ", 1)
+        environ["AUTH_TYPE"] = creds[0]
+        if creds[0].lower() == 'basic':
+            user, pw = base64.decodestring(creds[1]).split(":", 1)
+            environ["REMOTE_USER"] = user
+
+        if self.response_protocol == "HTTP/1.1":
+            if environ.get("HTTP_CONNECTION", "") == "close":
+                self.close_connection = True
+        else:
+            if environ.get("HTTP_CONNECTION", "") != "Keep-Alive":
+                self.close_connection = True
+
+        te = None
+        if self.response_protocol == "HTTP/1.1":
+            te = environ.get("HTTP_TRANSFER_ENCODING")
+            if te:
+                te = [x.strip().lower() for x in te.split(",") if x.strip()]
+
+        read_chunked = False
+
+        if te:
+            for enc in te:
+                if enc == "chunked":
+                    read_chunked = True
+                else:
+                    self.simple_response("501 Unimplemented")
+                    self.close_connection = True
+                    return
+
+        if read_chunked:
+            if not self.decode_chunked():
+                return
+
+        if environ.get("HTTP_EXPECT", "") == "100-continue":
+            self.simple_response(100)
+
+        self.ready = True
+
+    def read_headers(self):
+        """Read header lines from the incoming stream."""
+        environ = self.environ
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                raise ValueError("Illegal end of headers.")
+
+            if line == '\r\n':
+                break
+
+            if line[0] in ' \t':
+                v = line.strip()
+            else:
+                k, v = line.split(":", 1)
+                k, v = k.strip().upper(), v.strip()
+                envname = "HTTP_" + k.replace("-", "_")
+
+            if k in stacklesswsgi.comma_separated_headers:
+                existing = environ.get(envname)
+                if existing:
+                    v = ", ".join((existing, v))
+            environ[envname] = v
+
+        ct = environ.pop("HTTP_CONTENT_TYPE", None)
+        if ct:
+            environ["CONTENT_TYPE"] = ct
+        cl = environ.pop("HTTP_CONTENT_LENGTH", None)
+        if cl:
+            environ["CONTENT_LENGTH"] = cl
+
+
+# A typical request from a browser
+request = ("GET /some/path/index.html?a=1&b=2 HTTP/1.1\r\n"
+           "Host: www.example.com\r\n"
+           "User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:60.0) Gecko/20100101 Firefox/60.0\r\n"
+           "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+           "Accept-Language: en-US,en;q=0.5\r\n"
+           "Accept-Encoding: gzip, deflate\r\n"
+           "Referer: http://www.example.com/\r\n"
+           "Cookie: session=0123456789abcdef; theme=dark\r\n"
+           "Connection: keep-alive\r\n"
+           "Cache-Control: max-age=0\r\n"
+           "\r\n")
+
+base_environ = {"ACTUAL_SERVER_PROTOCOL": "HTTP/1.1",
+                "SERVER_SOFTWARE": "bench"}
+
+
+def bench(request_class, iterations):
+    def sendall(data):
+        pass
+    start = time.time()
+    for i in xrange(iterations):
+        environ = base_environ.copy()
+        environ["wsgi.input"] = string_rfile(request)
+        req = request_class(sendall, environ, None)
+        req.parse_request()
+        assert req.ready
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    legacy = bench(legacy_request, iterations)
+    current = bench(stacklesswsgi.HTTPRequest, iterations)
+    print "legacy parser:  %8.0f requests/s" % (iterations / legacy)
+    print "current parser: %8.0f requests/s" % (iterations / current)
+    print "speedup:        %8.2fx" % (legacy / current)
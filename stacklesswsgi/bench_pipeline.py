@@ -0,0 +1,101 @@
+#
+# A benchmark for HTTP pipelining in stacklesswsgi.
+#
+# It forks a stacklesswsgi server with a small "hello world" application and
+# then keeps a number of connections busy, each with depth requests sent
+# ahead of the responses. This is done with and without
+# HTTPConnection.pipelining, which lets the responses to pipelined requests
+# share writes instead of waiting for each to be sent on its own.
+#
+# Usage: python bench_pipeline.py [connections] [depth] [seconds]
+#
+
+import os
+import select
+import signal
+import socket
+import sys
+import time
+
+import stacklesswsgi
+from benchutil import fork_server
+
+
+def app(environ, start_response):
+    body = "hello world\n"
+    start_response("200 OK", [("Content-Type", "text/plain"),
+                              ("Content-Length", str(len(body)))])
+    return [body]
+
+
+request = "GET / HTTP/1.1\r\nHost: localhost\r\n\r\n"
+
+
+def start_server(pipelining):
+    """Fork a server and return its pid and port."""
+    def make_server(fd):
+        stacklesswsgi.HTTPConnection.pipelining = pipelining
+        return stacklesswsgi.Server(fd, app)
+    return fork_server(make_server)
+
+
+def run_client(port, connections, depth, seconds):
+    """Keep depth requests outstanding on each connection for the given
+    number of seconds. Returns the number of responses received."""
+    # Find out what a response looks like, so we can count them by size
+    probe = socket.create_connection(("127.0.0.1", port))
+    probe.sendall(request)
+    response_size = len(probe.recv(65536))
+    probe.close()
+
+    socks = {}
+    for i in xrange(connections):
+        s = socket.create_connection(("127.0.0.1", port))
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.sendall(request * depth)
+        socks[s.fileno()] = [s, 0]
+    poller = select.poll()
+    for fd in socks:
+        poller.register(fd, select.POLLIN)
+
+    completed = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        for fd, event in poller.poll(1000):
+            entry = socks[fd]
+            data = entry[0].recv(65536)
+            if not data:
+                raise RuntimeError("server closed the connection")
+            entry[1] += len(data)
+            responses = entry[1] // response_size
+            if responses:
+                entry[1] -= responses * response_size
+                completed += responses
+                # Top the pipeline back up
+                entry[0].sendall(request * responses)
+    for s, pending in socks.values():
+        s.close()
+    return completed
+
+
+def bench(pipelining, connections, depth, seconds):
+    pid, port = start_server(pipelining)
+    try:
+        return run_client(port, connections, depth, seconds) / float(seconds)
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+
+if __name__ == '__main__':
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+    print "%d connections, %d requests in flight on each" % (connections, depth)
+    single = bench(True, connections, 1, seconds)
+    print "one at a time:          %8.0f requests/s" % single
+    unbatched = bench(False, connections, depth, seconds)
+    print "pipelined, unbatched:   %8.0f requests/s" % unbatched
+    batched = bench(True, connections, depth, seconds)
+    print "pipelined, batched:     %8.0f requests/s" % batched
+    print "speedup from batching:  %8.2fx" % (batched / unbatched)
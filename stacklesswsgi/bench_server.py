@@ -0,0 +1,570 @@
+#
+# A load-testing benchmark suite for the stacklesswsgi server.
+#
+# Each scenario forks a fresh stacklesswsgi.Server on localhost serving a set
+# of reference applications and drives it for a fixed time with a load
+# generator. The generator is a single poll() loop that keeps a number of
+# connections busy, optionally from several processes (-p). It reports:
+#
+#   - requests per second;
+#   - p50, p99 and p99.9 latency, measured from sending a request (or from
+#     connecting, without keep-alive) to receiving all of its response;
+#   - the server's CPU time per request;
+#   - the server's resident memory per connection, for the scenario that
+#     holds open many idle connections.
+#
+# The reference applications are a "hello world", a large response, a
+# streamed (chunked) response, a long-poll in the manner of app_comet.py and
+# the SessionlessApp from app_sessionless.py, which is played to the end by
+# the load generator. The scenarios cover keep-alive on and off, pipelining
+# and 10000 idle connections held open while another scenario runs.
+#
+# The results can be written out as JSON (-o) and compared with those of an
+# earlier run (-c), which flags scenarios whose throughput or p99 latency
+# got worse by more than a tolerance (-t) and exits with status 1 if any did.
+# Run both on the same machine, the numbers only mean something relative to
+# each other.
+#
+# Usage: python bench_server.py [options] [scenario ...]
+#
+
+import imp
+import json
+import marshal
+import os
+import platform
+import re
+import resource
+import select
+import signal
+import socket
+import sys
+import time
+from collections import deque
+from optparse import OptionParser
+
+import stackless
+import stacklesswsgi
+from benchutil import fork_server
+
+
+# The reference applications
+
+hello_body = "hello world\n"
+large_body = "x" * 1048576
+stream_chunk = "y" * 1024
+stream_chunks = 64
+
+# The long-poll requests waiting for the next event, and how often one fires
+comet_listeners = []
+comet_interval = 0.1
+
+
+def comet_event():
+    """Wake every long-poll that is waiting, like the fake event source of
+    app_comet.py. Unlike it, we are woken by the server's timers, since its
+    sleep() blocks the whole process when no other tasklet is runnable."""
+    listeners = comet_listeners[:]
+    del comet_listeners[:]
+    now = time.time()
+    for ch in listeners:
+        ch.send(now)
+    stacklesswsgi.hub.call_later(comet_interval, comet_event)
+
+
+def load_sessionless():
+    """Return a SessionlessApp. The copy next to this file needs dstack,
+    so we use the one in the sandbox, which only needs stackless."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "..", "sandbox", "app_sessionless.py")
+    return imp.load_source("sandbox_app_sessionless", path).SessionlessApp()
+
+
+def make_app(server):
+    sessionless = load_sessionless()
+
+    def app(environ, start_response):
+        path = environ["PATH_INFO"]
+        if path == "/hello":
+            start_response("200 OK", [("Content-Type", "text/plain"),
+                                      ("Content-Length", str(len(hello_body)))])
+            return [hello_body]
+        if path == "/large":
+            start_response("200 OK", [("Content-Type", "text/plain"),
+                                      ("Content-Length", str(len(large_body)))])
+            return [large_body]
+        if path == "/stream":
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return (stream_chunk for i in xrange(stream_chunks))
+        if path == "/comet":
+            ch = stackless.channel()
+            ch.preference = 1
+            comet_listeners.append(ch)
+            timestamp = ch.receive()
+            body = "The time is %s\n" % time.strftime(
+                "%d.%m.%Y %H:%M:%S", time.localtime(timestamp))
+            start_response("200 OK", [("Content-Type", "text/plain"),
+                                      ("Content-Length", str(len(body)))])
+            return [body]
+        if path.startswith("/game"):
+            return sessionless(environ, start_response)
+        if path == "/__usage":
+            # How much CPU time and memory the server has used so far
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            body = json.dumps({"cpu": usage.ru_utime + usage.ru_stime,
+                               "rss": resident_memory(),
+                               "connections": server.connection_count,
+                               "requests": server.metrics.requests})
+            start_response("200 OK", [("Content-Type", "application/json"),
+                                      ("Content-Length", str(len(body)))])
+            return [body]
+        start_response("404 Not Found", [("Content-Length", "0")])
+        return []
+    return app
+
+
+def resident_memory():
+    """The resident set size of this process in bytes."""
+    try:
+        f = open("/proc/self/statm")
+        try:
+            return int(f.read().split()[1]) * resource.getpagesize()
+        finally:
+            f.close()
+    except IOError:
+        # Only the peak is available here
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        if sys.platform == "darwin":
+            return usage.ru_maxrss
+        return usage.ru_maxrss * 1024
+
+
+def make_server(fd):
+    server = stacklesswsgi.Server(fd, None)
+    server.wsgi_app = make_app(server)
+    # Idle connections are held open for as long as we like
+    server.keepalive_timeout = None
+    server.header_timeout = None
+    stacklesswsgi.hub.call_later(comet_interval, comet_event)
+    return server
+
+
+# The load generator
+
+content_length_re = re.compile(r"\r\ncontent-length:[ \t]*(\d+)")
+
+
+def parse_response(buf):
+    """Return the length, status and body of the response at the start of
+    buf, a bytearray, or None if it hasn't been received in full."""
+    head_end = buf.find("\r\n\r\n")
+    if head_end < 0:
+        return None
+    head = str(buf[:head_end + 2]).lower()
+    status = int(head[9:12])
+    start = head_end + 4
+    match = content_length_re.search(head)
+    if match:
+        end = start + int(match.group(1))
+        if len(buf) < end:
+            return None
+        return end, status, str(buf[start:end])
+    if "\r\ntransfer-encoding: chunked\r\n" not in head:
+        raise ValueError("Can't tell where the response ends: %r" % head)
+    body = []
+    pos = start
+    while True:
+        line_end = buf.find("\r\n", pos)
+        if line_end < 0:
+            return None
+        size = int(str(buf[pos:line_end]).split(";", 1)[0], 16)
+        pos = line_end + 2
+        if len(buf) < pos + size + 2:
+            return None
+        if not size:
+            # The server doesn't send trailers
+            return pos + 2, status, "".join(body)
+        body.append(str(buf[pos:pos + size]))
+        pos += size + 2
+
+
+def connect(port):
+    s = socket.create_connection(("127.0.0.1", port))
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return s
+
+
+class scenario(object):
+    """A load to put on the server: connections connections, each with
+    depth requests for path in flight, with or without keep-alive. If idle
+    is given, that many idle connections are held open as well."""
+
+    def __init__(self, name, path, connections, depth=1, keepalive=True, idle=0):
+        self.name = name
+        self.path = path
+        self.connections = connections
+        self.depth = depth
+        self.keepalive = keepalive
+        self.idle = idle
+
+    def new_state(self):
+        """Return whatever per-connection state request() needs."""
+        return None
+
+    def request(self, state):
+        """Return the next request to send on a connection."""
+        if self.keepalive:
+            return "GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n" % self.path
+        return ("GET %s HTTP/1.1\r\nHost: localhost\r\n"
+                "Connection: close\r\n\r\n" % self.path)
+
+    def response(self, state, status, body):
+        """Called with each response received on a connection."""
+        pass
+
+    def parameters(self):
+        return {"path": self.path, "connections": self.connections,
+                "depth": self.depth, "keepalive": self.keepalive,
+                "idle": self.idle}
+
+
+continuation_re = re.compile(r'name="__wc" value="([0-9a-f]+)"')
+
+
+class sessionless_scenario(scenario):
+    """Plays SessionlessApp's guess the number game on each connection,
+    guessing by bisection and starting over once the number is found."""
+
+    def new_state(self):
+        return {"cid": None, "low": 1, "high": 100}
+
+    def request(self, state):
+        if state["cid"] is None:
+            path = self.path
+        else:
+            path = "%s?__wc=%s&guess=%d" % (
+                self.path, state["cid"], (state["low"] + state["high"]) // 2)
+        return "GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n" % path
+
+    def response(self, state, status, body):
+        guess = (state["low"] + state["high"]) // 2
+        if state["cid"] is not None:
+            if "to low" in body:
+                state["low"] = guess + 1
+            elif "to high" in body:
+                state["high"] = guess - 1
+        match = continuation_re.search(body)
+        if match:
+            state["cid"] = match.group(1)
+        else:
+            # Found it, play again
+            state.update(self.new_state())
+
+
+scenarios = [
+    scenario("hello", "/hello", 32),
+    scenario("hello_close", "/hello", 32, keepalive=False),
+    scenario("hello_pipelined", "/hello", 8, depth=16),
+    scenario("large", "/large", 8),
+    scenario("stream", "/stream", 8),
+    scenario("comet", "/comet", 1000),
+    sessionless_scenario("sessionless", "/game", 32),
+    scenario("idle", "/hello", 32, idle=10000),
+]
+
+
+class load_connection(object):
+    """A connection of the load generator, with the times its outstanding
+    requests were sent."""
+
+    def __init__(self, sock, state):
+        self.sock = sock
+        self.state = state
+        self.buffer = bytearray()
+        self.sent = deque()
+
+
+def run_load(port, sc, connections, seconds, warmup):
+    """Put the load of scenario sc on the server with the given number of
+    connections for warmup + seconds seconds. Returns the latencies of the
+    requests completed after the warmup and the number of error responses."""
+    poller = select.poll()
+    conns = {}
+
+    def start(state, started=None):
+        if started is None:
+            started = time.time()
+        conn = load_connection(connect(port), state)
+        conns[conn.sock.fileno()] = conn
+        poller.register(conn.sock.fileno(), select.POLLIN)
+        send(conn, sc.depth, started)
+
+    def send(conn, count, started):
+        conn.sock.sendall(sc.request(conn.state) * count)
+        conn.sent.extend([started] * count)
+
+    def stop(conn):
+        poller.unregister(conn.sock.fileno())
+        del conns[conn.sock.fileno()]
+        conn.sock.close()
+
+    for i in xrange(connections):
+        start(sc.new_state())
+
+    latencies = []
+    errors = 0
+    measure_from = time.time() + warmup
+    end = measure_from + seconds
+    while True:
+        now = time.time()
+        if now >= end:
+            break
+        for fd, event in poller.poll(1000):
+            conn = conns[fd]
+            data = conn.sock.recv(262144)
+            if not data:
+                raise RuntimeError("%s: the server closed a connection" % sc.name)
+            conn.buffer.extend(data)
+            completed = 0
+            while True:
+                parsed = parse_response(conn.buffer)
+                if parsed is None:
+                    break
+                length, status, body = parsed
+                del conn.buffer[:length]
+                now = time.time()
+                sent = conn.sent.popleft()
+                if sent >= measure_from:
+                    latencies.append(now - sent)
+                    if status >= 400:
+                        errors += 1
+                sc.response(conn.state, status, body)
+                completed += 1
+            if not completed:
+                continue
+            if not sc.keepalive:
+                stop(conn)
+                start(conn.state)
+            else:
+                send(conn, completed, time.time())
+    for conn in conns.values():
+        conn.sock.close()
+    return latencies, errors
+
+
+def run_clients(port, sc, processes, seconds, warmup):
+    """run_load() in processes processes, splitting the connections
+    between them, and combine their results."""
+    if processes <= 1:
+        return run_load(port, sc, sc.connections, seconds, warmup)
+    children = []
+    for i in xrange(processes):
+        share = sc.connections // processes
+        if i < sc.connections % processes:
+            share += 1
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(r)
+                out = os.fdopen(w, "wb")
+                marshal.dump(run_load(port, sc, share, seconds, warmup), out)
+                out.close()
+            finally:
+                os._exit(0)
+        os.close(w)
+        children.append((pid, os.fdopen(r, "rb")))
+    latencies = []
+    errors = 0
+    for pid, f in children:
+        try:
+            child_latencies, child_errors = marshal.load(f)
+        except EOFError:
+            raise RuntimeError("%s: a load generator process failed" % sc.name)
+        latencies.extend(child_latencies)
+        errors += child_errors
+        f.close()
+        os.waitpid(pid, 0)
+    return latencies, errors
+
+
+def server_usage(port):
+    s = connect(port)
+    try:
+        s.sendall("GET /__usage HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        buf = bytearray()
+        while True:
+            parsed = parse_response(buf)
+            if parsed is not None:
+                return json.loads(parsed[2])
+            data = s.recv(65536)
+            if not data:
+                raise RuntimeError("The server closed the connection")
+            buf.extend(data)
+    finally:
+        s.close()
+
+
+def wait_for_connections(port, count, timeout=30):
+    """Wait until the server has count connections open, besides the one
+    we ask on. Returns its usage then."""
+    deadline = time.time() + timeout
+    while True:
+        usage = server_usage(port)
+        if usage["connections"] - 1 == count or time.time() > deadline:
+            return usage
+        time.sleep(0.1)
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+
+def run_scenario(sc, processes, seconds, warmup):
+    pid, port = fork_server(make_server)
+    idle = []
+    try:
+        result = {"name": sc.name, "parameters": sc.parameters()}
+        if sc.idle:
+            before = wait_for_connections(port, 0)
+            for i in xrange(sc.idle):
+                idle.append(connect(port))
+            after = wait_for_connections(port, sc.idle)
+            result["idle_connections"] = after["connections"] - 1
+            result["memory_per_connection"] = (
+                (after["rss"] - before["rss"]) / float(max(1, sc.idle)))
+        before = server_usage(port)
+        latencies, errors = run_clients(port, sc, processes, seconds, warmup)
+        after = server_usage(port)
+        # The requests for __usage are counted too
+        requests = after["requests"] - before["requests"] - 1
+        latencies.sort()
+        result.update({
+            "requests": len(latencies),
+            "errors": errors,
+            "requests_per_second": len(latencies) / seconds,
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99),
+            "p999": percentile(latencies, 99.9),
+            "max": latencies[-1] if latencies else 0.0,
+            "cpu_per_request": (after["cpu"] - before["cpu"]) / max(1, requests),
+        })
+        return result
+    finally:
+        for s in idle:
+            s.close()
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+
+def report(result):
+    line = ("%-16s %9.0f req/s  p50 %8.2f ms  p99 %8.2f ms  p99.9 %8.2f ms"
+            "  cpu %7.1f us/req" % (
+                result["name"], result["requests_per_second"],
+                result["p50"] * 1000, result["p99"] * 1000,
+                result["p999"] * 1000, result["cpu_per_request"] * 1000000))
+    if result["errors"]:
+        line += "  %d errors" % result["errors"]
+    if "memory_per_connection" in result:
+        line += "  %d idle, %.0f bytes/conn" % (
+            result["idle_connections"], result["memory_per_connection"])
+    print line
+    sys.stdout.flush()
+
+
+def compare(results, baseline, tolerance):
+    """Print how results compare with those of an earlier run. Returns the
+    names of the scenarios that got worse by more than tolerance."""
+    previous = dict((r["name"], r) for r in baseline["results"])
+    worse = []
+    print
+    print "compared with %s:" % baseline.get("date", "the baseline")
+    for result in results:
+        old = previous.get(result["name"])
+        if old is None:
+            continue
+        throughput = result["requests_per_second"] / max(old["requests_per_second"], 1e-9)
+        latency = result["p99"] / max(old["p99"], 1e-9)
+        flag = ""
+        if throughput < 1 - tolerance or latency > 1 + tolerance:
+            flag = "  REGRESSION"
+            worse.append(result["name"])
+        print "%-16s throughput %6.2fx  p99 %6.2fx%s" % (
+            result["name"], throughput, latency, flag)
+    return worse
+
+
+def raise_fd_limit(wanted):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options] [scenario ...]")
+    parser.add_option("-s", "--seconds", type="float", default=5,
+                      help="how long to measure each scenario for")
+    parser.add_option("-w", "--warmup", type="float", default=1,
+                      help="how long to run each scenario before measuring")
+    parser.add_option("-p", "--processes", type="int", default=1,
+                      help="how many load generator processes to run")
+    parser.add_option("-i", "--idle", type="int", default=None,
+                      help="how many idle connections to hold open")
+    parser.add_option("-o", "--output", help="write the results to this JSON file")
+    parser.add_option("-c", "--compare", help="compare with the results in this JSON file")
+    parser.add_option("-t", "--tolerance", type="float", default=0.1,
+                      help="the fraction by which a result may get worse")
+    parser.add_option("-l", "--list", action="store_true",
+                      help="list the scenarios and exit")
+    options, args = parser.parse_args()
+
+    if options.list:
+        for sc in scenarios:
+            print sc.name, json.dumps(sc.parameters(), sort_keys=True)
+        sys.exit(0)
+    selected = [sc for sc in scenarios if not args or sc.name in args]
+    unknown = set(args) - set(sc.name for sc in scenarios)
+    if unknown:
+        parser.error("unknown scenarios: %s" % ", ".join(sorted(unknown)))
+
+    for sc in selected:
+        if options.idle is not None and sc.idle:
+            sc.idle = options.idle
+        if sc.idle:
+            # Each end of every connection needs a descriptor, in the
+            # server and in the load generator
+            limit = raise_fd_limit(sc.idle + sc.connections + 100)
+            sc.idle = min(sc.idle, limit - sc.connections - 100)
+
+    results = []
+    for sc in selected:
+        result = run_scenario(sc, options.processes, options.seconds, options.warmup)
+        report(result)
+        results.append(result)
+
+    output = {"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "python": sys.version.split()[0],
+              "platform": platform.platform(),
+              "seconds": options.seconds,
+              "warmup": options.warmup,
+              "processes": options.processes,
+              "results": results}
+    if options.output:
+        f = open(options.output, "w")
+        try:
+            json.dump(output, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    if options.compare:
+        f = open(options.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        if compare(results, baseline, options.tolerance):
+            sys.exit(1)
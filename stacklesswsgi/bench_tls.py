@@ -0,0 +1,128 @@
+#
+# A benchmark for TLS handshakes in stacklesswsgi.
+#
+# It forks a stacklesswsgi server serving HTTPS with a throwaway self-signed
+# certificate and has "openssl s_time" make as many connections as it can,
+# each one doing a full handshake, and then again with each one resuming the
+# session of the first. The server's CPU time per handshake is worked out
+# from /proc. s_time only resumes TLS 1.2 sessions, so both runs use that.
+#
+# Usage: python bench_tls.py [-k rsa|ec] [-c clients] [-s seconds]
+#
+
+import optparse
+import os
+import re
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+
+import stacklesswsgi
+from benchutil import fork_server
+
+
+def app(environ, start_response):
+    body = "hello world\n"
+    start_response("200 OK", [("Content-Type", "text/plain"),
+                              ("Content-Length", str(len(body)))])
+    return [body]
+
+
+def make_certificate(directory, key_type):
+    """Write a self-signed certificate and its key to directory and return
+    the path of the PEM file holding both."""
+    path = os.path.join(directory, "server.pem")
+    if key_type == "ec":
+        newkey = ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1"]
+    else:
+        newkey = ["-newkey", "rsa:2048"]
+    subprocess.check_call(["openssl", "req", "-x509", "-nodes", "-days", "1",
+                           "-subj", "/CN=localhost", "-keyout", path,
+                           "-out", path + ".crt"] + newkey,
+                          stderr=open(os.devnull, "w"))
+    with open(path, "a") as f:
+        f.write(open(path + ".crt").read())
+    return path
+
+
+def start_server(certificate):
+    """Fork a server and return its pid and port."""
+    def make_server(fd):
+        server = stacklesswsgi.Server(fd, app)
+        server.ssl_certificate = certificate
+        return server
+    return fork_server(make_server)
+
+
+def cpu_time(pid):
+    """The CPU time used by process pid so far, in seconds."""
+    fields = open("/proc/%d/stat" % pid).read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+
+def run_clients(port, clients, seconds, reuse):
+    """Run clients s_time processes at once for the given number of seconds.
+    Returns the number of handshakes they completed and how many of them
+    resumed a session."""
+    command = ["openssl", "s_time", "-connect", "127.0.0.1:%d" % port,
+               "-tls1_2", "-time", str(int(seconds)),
+               reuse and "-reuse" or "-new"]
+    procs = [subprocess.Popen(command, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+             for i in xrange(clients)]
+    handshakes = resumed = 0
+    for proc in procs:
+        output = proc.communicate()[0]
+        match = re.search(r"(\d+) connections in [\d.]+ real seconds", output)
+        if match is None:
+            raise RuntimeError("s_time failed:\n" + output)
+        handshakes += int(match.group(1))
+        # s_time prints "r" for each resumed session, "*" for each new one
+        for progress in re.findall(r"^[*r]+$", output, re.M):
+            resumed += progress.count("r")
+    return handshakes, resumed
+
+
+def bench(certificate, clients, seconds, reuse):
+    pid, port = start_server(certificate)
+    try:
+        time.sleep(0.2)
+        cpu = cpu_time(pid)
+        start = time.time()
+        handshakes, resumed = run_clients(port, clients, seconds, reuse)
+        elapsed = time.time() - start
+        cpu = cpu_time(pid) - cpu
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    return handshakes / elapsed, resumed, handshakes, cpu / max(handshakes, 1)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-k", "--key", default="rsa", choices=["rsa", "ec"],
+                      help="server key type, rsa (2048 bits) or ec (P-256)")
+    parser.add_option("-c", "--clients", type="int", default=4,
+                      help="s_time processes run at once")
+    parser.add_option("-s", "--seconds", type="float", default=5,
+                      help="how long each run lasts")
+    options, args = parser.parse_args()
+    if args:
+        parser.error("no arguments expected")
+
+    directory = tempfile.mkdtemp()
+    try:
+        certificate = make_certificate(directory, options.key)
+        print "%s key, %d clients" % (options.key, options.clients)
+        full = bench(certificate, options.clients, options.seconds, False)
+        print "full handshakes:     %8.0f /s  %6.3f ms server CPU each" % (
+            full[0], full[3] * 1000)
+        resumed = bench(certificate, options.clients, options.seconds, True)
+        print "resumed handshakes:  %8.0f /s  %6.3f ms server CPU each" \
+              "  (%d of %d resumed)" % (resumed[0], resumed[3] * 1000,
+                                        resumed[1], resumed[2])
+        print "speedup from resumption: %6.2fx" % (resumed[0] / full[0])
+    finally:
+        shutil.rmtree(directory)
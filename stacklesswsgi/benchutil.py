@@ -0,0 +1,29 @@
+#
+# What the stacklesswsgi benchmarks share.
+#
+
+import os
+
+import stacklesswsgi
+
+
+def fork_server(make_server):
+    """Fork a process that serves on a free port of the local host, and
+    return its pid and the port.
+
+    make_server is called in the new process with the descriptor of the
+    listening socket, to be given to Server as its bind_addr, and returns
+    the Server to start. The process exits once the server has stopped.
+    """
+    sock = stacklesswsgi.listen_socket(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    pid = os.fork()
+    if pid == 0:
+        try:
+            fd = os.dup(sock.fileno())
+            sock.close()
+            make_server(fd).start()
+        finally:
+            os._exit(0)
+    sock.close()
+    return pid, port
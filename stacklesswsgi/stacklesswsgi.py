@@ -18,15 +18,30 @@
 #   http://www.tismer.com/mailman/listinfo/stackless
 #
 
+import base64
+import binascii
+import errno
+import fcntl
+import mimetypes
+import mmap
+import os
 import re
 import rfc822
+import signal
+import stat
 import sys
+import tempfile
+import time
 import traceback
+import zlib
 from urllib import unquote
-from urlparse import urlparse
+from urlparse import urlparse, parse_qs
 import asyncore
+import select
 import socket
 import stackless
+from collections import deque, OrderedDict
+from itertools import chain, islice
 
 
 class Server(object):
@@ -39,6 +54,11 @@ class Server(object):
     This will start a server listening on 127.0.0.1 port 8080.
     It will also start the stackless scheduler and begin serving
     requests.
+    
+    Instead of a (host, port) pair, the server can be given the path of a
+    Unix domain socket to listen on, e.g. behind a local reverse proxy, or
+    the number of a file descriptor of a socket it inherited already bound,
+    e.g. from a supervisor that keeps it open across restarts.
     """
     
     protocol = "HTTP/1.1"
@@ -46,9 +66,104 @@ class Server(object):
     ready = False
     environ = {}
     
+    # With start(workers=N), bind a listening socket in each worker with
+    # SO_REUSEPORT and let the kernel spread connections between them,
+    # instead of sharing one socket bound by the master.
+    reuse_port = False
+    
+    # The most connections accepted in one go when several are pending
+    accept_batch = 64
+    
+    # Admission control. The listen backlog is how many connections the
+    # kernel will hold for us while we're not accepting. At most
+    # max_connections connections are served at once. When that many are
+    # open, further connections wait in the backlog, or are accepted and
+    # turned away with a 503 if reject_overload is set. At most max_requests
+    # requests are passed to the application at once, the rest queue for a
+    # free slot. A request that has been queued for longer than
+    # max_queue_delay seconds when its turn comes is answered with a 503,
+    # which keeps the latency of the requests we do serve bounded when the
+    # server is overloaded. None means no limit.
+    backlog = socket.SOMAXCONN
+    max_connections = None
+    reject_overload = False
+    # How long a connection we turn away gets to read our 503. What it has
+    # sent meanwhile is discarded, as closing with it unread would reset
+    # the connection and the 503 could be lost.
+    reject_drain_time = 1
+    max_requests = None
+    max_queue_delay = None
+    
+    # Timeouts in seconds, None to wait forever. keepalive_timeout is how
+    # long an idle connection is kept open between requests, header_timeout
+    # how long a client gets to send the request line and headers in full.
+    # body_timeout is how long the application may wait for the next piece
+    # of the request body and write_timeout how long a write may make no
+    # progress. Connections that time out are closed.
+    keepalive_timeout = 15
+    header_timeout = 30
+    body_timeout = 60
+    write_timeout = 60
+    
+    # Write backpressure. Once more than send_high_water bytes are queued for
+    # a connection, the tasklet writing to it is suspended until they have
+    # drained to send_low_water bytes. See sock_channel.
+    send_high_water = 262144
+    send_low_water = 65536
+    
+    # Graceful shutdown. stop() stops accepting connections and has each
+    # open one close after its next response. Keep-alive connections get
+    # drain_keepalive seconds to send another request, which may already be
+    # on its way. Connections still open drain_timeout seconds later, e.g.
+    # long-polls, are closed regardless. With handle_signals set, SIGTERM
+    # calls stop() and SIGUSR2 reload().
+    drain_keepalive = 1
+    drain_timeout = 30
+    handle_signals = True
+    
+    # TLS. Set ssl_certificate to the path of a PEM file with the server's
+    # certificate chain, and ssl_private_key to that of its key if it's not
+    # in the same file, to serve HTTPS. Or set ssl_context to an
+    # ssl.SSLContext of your own. Resumed handshakes skip the key exchange.
+    # Sessions are resumed from the context's session cache, which each
+    # process keeps for itself, or from session tickets, which the workers
+    # can all decrypt as they share the context's ticket keys. Those are
+    # made anew when the program is reloaded.
+    ssl_certificate = None
+    ssl_private_key = None
+    ssl_context = None
+    
+    # If set to a path such as "/__stats", requests for it from the
+    # admin_addresses are answered with the server's metrics in Prometheus
+    # text format instead of being passed to the application. See stats().
+    stats_path = None
+    
+    # If set to a path such as "/__profile", requests for it from the
+    # admin_addresses run a TaskletProfiler for as many seconds as the query string's
+    # seconds parameter says (10 by default), sampling every interval
+    # seconds of CPU (0.01), and are answered with the stacks it sampled,
+    # or with its report() if format=report is given. accounting=1 measures
+    # the time of every tasklet switch as well, which a report does unless
+    # accounting=0 is given. A profile may last at most max_profile_seconds.
+    profile_path = None
+    max_profile_seconds = 300
+    
+    # The client addresses, as in REMOTE_ADDR, that stats_path and
+    # profile_path are answered for. None are by default. Behind a reverse
+    # proxy on the same host, every client has the proxy's address, so only
+    # list addresses that clients can't come from. local_addresses are the
+    # local host's. Clients of a Unix domain socket have the address "".
+    admin_addresses = ()
+    
+    # Set to a ResponseCache to have responses the application marks as
+    # cacheable kept and sent again as they are, without calling it, until
+    # they expire. With workers, each worker process has its own.
+    response_cache = None
+    
     def __init__(self, bind_addr, wsgi_app, server_name=None):
         """Instantiate a WSGI server.
-        - bind_addr is a (hostname,port) tuple
+        - bind_addr is a (hostname,port) tuple, a Unix domain socket path
+          or an inherited file descriptor, see listen_socket()
         - wsgi_app is a callable application as per the WSGI spec
         - server_name is the server name, defaulting to the local hostname
         """
@@ -62,280 +177,3403 @@ class Server(object):
         self.tasklet_class = stackless.tasklet
         
         self.running = False
+        self.sock_server = None
+        # True while the accept loop runs
+        self.accepting = False
+        # Receives once we have stopped and all connections are closed
+        self.stopped = None
+        # Maps the pids of our worker processes to the time they were started
+        self.workers = {}
+        self.restart_pending = False
+        self.reload_pending = False
+        # The pid of the process that started us with reload(), if any
+        self.predecessor = None
+        
+        self.connection_count = 0
+        # Maps each open HTTPConnection to the tasklet serving it
+        self.connections = {}
+        self.requests_in_flight = 0
+        # Channels of requests waiting for a slot, oldest first
+        self.request_queue = deque()
+        # Receives when a connection closes while the accept loop waits
+        self.connection_slot = stackless.channel()
+        self.metrics = ServerMetrics()
     
-    def start(self, start_stackless=True):
+    def start(self, start_stackless=True, workers=0):
         """Start serving HTTP requests on bound port. If start_stackless
         is True (default) this will call stackless.run() and block. Set it
         to False if you intend to start the stackless processing loop yourself or
         call stackless.schedule by some other means. Otherwise the server will
         not function since all work is deferred to a tasklet.
+        
+        If workers is given, the server binds its port and then forks that
+        many worker processes to serve requests, each with its own stackless
+        scheduler. The calling process stays behind to supervise them, see
+        supervise(). start_stackless is ignored in that case.
+        
+        If this process was started by reload(), the listening socket is
+        taken over from the one that started it, which is then told to stop.
         """
-        self.sock_server = sock_server(self.bind_addr)
+        if self.ssl_context is None and self.ssl_certificate is not None:
+            # Before forking any workers, so that they share the context's
+            # session ticket keys
+            self.ssl_context = make_ssl_context(self.ssl_certificate,
+                                                self.ssl_private_key)
+        if workers:
+            self.supervise(workers)
+            return
+        listener = self._take_over()
+        if listener is None:
+            listener = listen_socket(self.bind_addr, self.backlog)
+        self.sock_server = sock_server(self.bind_addr, listener,
+                                       ssl_context=self.ssl_context)
+        if self.handle_signals:
+            self._handle_signals()
+        self._serve(start_stackless)
+    
+    def _serve(self, start_stackless):
         self.running = True
+        self.stopped = stackless.channel()
+        self.stopped.preference = 1
         
         self.tasklet_class(self._accept_loop)()
+        self._stop_predecessor()
         
         if start_stackless:
-            stackless.run()
+            # Run the other tasklets until we have stopped and drained
+            self.stopped.receive()
     
     def stop(self):
-        """Call this to make the server stop serving requests. If it is serving
-        a request at the time stop() is called, it will finish that and then stop."""
+        """Call this to make the server stop serving requests. Connections are
+        no longer accepted, and each open connection is closed once it has
+        answered its next request, see drain_keepalive. Those still open
+        drain_timeout seconds later are closed regardless. start() returns
+        once all of them are."""
+        if not self.running:
+            return
         self.running = False
+        if self.sock_server is None:
+            # We are supervising workers, supervise() takes it from here
+            return
+        
+        # Stop accepting, waking up the accept loop if it is waiting
+        self.sock_server.close()
+        if self.sock_server.accept_channel.balance < 0:
+            self.sock_server.accept_channel.send([])
+        if self.connection_slot.balance < 0:
+            self.connection_slot.send(None)
+        
+        # Closing a keep-alive connection as the client sends its next
+        # request would lose that request, so they are closed by the client
+        # or once drain_keepalive is up. See HTTPConnection.communicate().
+        for conn in self.connections.keys():
+            if conn.idle:
+                conn.sock_chan.set_deadline(self.drain_keepalive)
+            elif conn.request is not None and not conn.request.sent_headers:
+                conn.request.close_connection = True
+        hub.call_later(self.drain_timeout, self._drain_expired)
+    
+    def _drain_expired(self):
+        """Close the connections that are still open when stop()'s
+        drain_timeout is up."""
+        for conn, tasklet in self.connections.items():
+            conn.sock_chan.close()
+            # The application may be waiting for something other than the
+            # connection, e.g. the event a long-poll waits for
+            if tasklet.alive:
+                tasklet.kill()
+    
+    def _drained(self):
+        if self.stopped is not None and self.stopped.balance < 0:
+            self.stopped.send(None)
+    
+    def _handle_signals(self):
+        """Have SIGTERM stop the server and SIGUSR2 reload it. The work is
+        done by the event loop, which the signals wake up."""
+        def on_term(signum, frame):
+            hub.call_soon(self.stop)
+        def on_usr2(signum, frame):
+            hub.call_soon(self.reload)
+        signal.signal(signal.SIGTERM, on_term)
+        signal.signal(signal.SIGUSR2, on_usr2)
+        hub.watch_signals()
+    
+    def reload(self):
+        """Start a fresh copy of this program, e.g. after it has been upgraded,
+        and hand it our listening socket. Once it is serving it tells us to
+        stop, by sending SIGTERM. The program is started the way this one
+        was, with sys.executable and sys.argv."""
+        if self.sock_server is not None:
+            self._spawn_successor(self.sock_server.socket)
+    
+    def _spawn_successor(self, listener):
+        env = dict(os.environ)
+        env[predecessor_variable] = str(os.getpid())
+        pid = os.fork()
+        if pid:
+            return pid
+        # The child, which must not return from here. Only the listening
+        # socket is passed on. Any other descriptor, a client connection
+        # in particular, would be kept open by the new program.
+        try:
+            if listener is not None:
+                fd = listener.fileno()
+                if fd != listen_fd:
+                    os.dup2(fd, listen_fd)
+                flags = fcntl.fcntl(listen_fd, fcntl.F_GETFD)
+                fcntl.fcntl(listen_fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+                env[listen_fd_variable] = str(listen_fd)
+            os.closerange(listen_fd + 1, max_fd())
+            os.execve(sys.executable, [sys.executable] + sys.argv, env)
+        except:
+            traceback.print_exc()
+        os._exit(127)
+    
+    def _take_over(self):
+        """If we were started by reload(), return the listening socket that
+        was handed to us, if any."""
+        pid = os.environ.pop(predecessor_variable, None)
+        if pid is not None:
+            self.predecessor = int(pid)
+        fd = os.environ.pop(listen_fd_variable, None)
+        if fd is None:
+            return None
+        return listen_socket(int(fd), self.backlog)
+    
+    def _stop_predecessor(self):
+        """If we were started by reload(), tell the process that started us
+        to stop now that we are serving."""
+        if self.predecessor is None:
+            return
+        try:
+            os.kill(self.predecessor, signal.SIGTERM)
+        except OSError:
+            pass
+        self.predecessor = None
+    
+    def supervise(self, count):
+        """Fork count worker processes and keep them running until stop() is
+        called or we get SIGTERM or SIGINT. A worker that dies is replaced.
+        On SIGHUP the workers are replaced one at a time, each new worker
+        being started before the old one is told to exit, so there are
+        always workers accepting connections. Workers are stopped with
+        SIGTERM, on which they stop() gracefully.
+        
+        On SIGUSR2 the whole program is reloaded, see reload(). With
+        reuse_port set there is no listening socket to hand over, the new
+        workers bind their own. The kernel resets the connections still
+        queued for an old worker when it stops, so don't set reuse_port if
+        reloads must not lose any."""
+        listener = self._take_over()
+        if listener is None and (not self.reuse_port
+                                 or not isinstance(self.bind_addr, tuple)):
+            # Only TCP ports can be bound by each worker
+            listener = listen_socket(self.bind_addr, self.backlog)
+        
+        def on_stop(signum, frame):
+            self.stop()
+        def on_hup(signum, frame):
+            self.restart_pending = True
+        def on_usr2(signum, frame):
+            self.reload_pending = True
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+        signal.signal(signal.SIGHUP, on_hup)
+        signal.signal(signal.SIGUSR2, on_usr2)
+        
+        self.running = True
+        try:
+            for i in range(count):
+                self._spawn_worker(listener)
+            self._stop_predecessor()
+            while self.running:
+                if self.restart_pending:
+                    self.restart_pending = False
+                    self._rolling_restart(listener)
+                    continue
+                if self.reload_pending:
+                    self.reload_pending = False
+                    self._spawn_successor(listener)
+                    continue
+                try:
+                    pid, status = os.wait()
+                except OSError, e:
+                    if e.args[0] == errno.EINTR:
+                        # A signal arrived, see what it asked for
+                        continue
+                    raise
+                started = self.workers.pop(pid, None)
+                if started is None or not self.running:
+                    continue
+                sys.stderr.write("stacklesswsgi: worker %d exited with status %d, "
+                                 "starting a new one\n" % (pid, status))
+                if time.time() - started < 1:
+                    # Don't fork like crazy if workers die right away
+                    time.sleep(1)
+                self._spawn_worker(listener)
+        finally:
+            self.running = False
+            # Let the workers drain at the same time
+            for pid in self.workers.keys():
+                self._signal_worker(pid)
+            for pid in self.workers.keys():
+                self._stop_worker(pid)
+            if listener is not None:
+                listener.close()
+    
+    def _spawn_worker(self, listener):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.time()
+            return pid
+        
+        # This is the worker process, it must never return from here
+        status = 1
+        try:
+            try:
+                # We are stopped by the supervisor, with SIGTERM. SIGINT
+                # from a terminal goes to the supervisor as well.
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+                self.workers = {}
+                self.predecessor = None
+                self.environ = dict(self.environ)
+                self.environ["wsgi.multiprocess"] = True
+                if listener is None:
+                    listener = listen_socket(self.bind_addr, self.backlog,
+                                             reuse_port=True)
+                self.sock_server = sock_server(self.bind_addr, listener,
+                                               ssl_context=self.ssl_context)
+                def on_term(signum, frame):
+                    hub.call_soon(self.stop)
+                signal.signal(signal.SIGTERM, on_term)
+                hub.watch_signals()
+                self._serve(True)
+                status = 0
+            except:
+                traceback.print_exc()
+        finally:
+            os._exit(status)
+    
+    def _signal_worker(self, pid):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError, e:
+            if e.args[0] != errno.ESRCH:
+                raise
+    
+    def _stop_worker(self, pid):
+        """Stop a worker and wait for it to drain and exit."""
+        self._signal_worker(pid)
+        while True:
+            try:
+                os.waitpid(pid, 0)
+            except OSError, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] != errno.ECHILD:
+                    raise
+            break
+        self.workers.pop(pid, None)
+    
+    def _rolling_restart(self, listener):
+        for pid in self.workers.keys():
+            if not self.running:
+                return
+            self._spawn_worker(listener)
+            self._stop_worker(pid)
+    
+    def admit_request(self):
+        """Called by a connection before it passes a request to the application.
+        Suspends the caller until fewer than max_requests requests are in
+        flight. Returns False if the request should be turned away instead.
+        Every admitted request must be followed by a call to release_request."""
+        if self.max_requests is None or (
+                self.requests_in_flight < self.max_requests and not self.request_queue):
+            self.requests_in_flight += 1
+            return True
+        
+        ch = stackless.channel()
+        ch.preference = 1
+        queued = time.time()
+        self.request_queue.append(ch)
+        self.metrics.requests_queued += 1
+        # release_request hands its slot straight to us
+        try:
+            ch.receive()
+        except:
+            # We were killed while we waited, e.g. by stop()
+            if ch in self.request_queue:
+                self.request_queue.remove(ch)
+            else:
+                # The slot was handed to us all the same
+                self.release_request()
+            raise
+        waited = time.time() - queued
+        self.metrics.queue_time.record(waited)
+        if self.max_queue_delay is not None and waited > self.max_queue_delay:
+            self.metrics.requests_shed += 1
+            self.release_request()
+            return False
+        return True
+    
+    def release_request(self):
+        """Called when the application is done with an admitted request."""
+        while self.request_queue:
+            ch = self.request_queue.popleft()
+            # Skip any whose tasklet is no longer waiting for it
+            if ch.balance < 0:
+                ch.send(None)
+                return
+        self.requests_in_flight -= 1
+    
+    def _connection_closed(self, connection):
+        self.connection_count -= 1
+        del self.connections[connection]
+        if self.connection_slot.balance < 0:
+            self.connection_slot.send(None)
+        if not self.accepting and not self.connections:
+            self._drained()
+    
+    def stats(self):
+        """Return a snapshot of the server's metrics as a dict. The latency
+        histograms are summarized as a count, sum, maximum and percentiles,
+        all in seconds. With workers, each worker process has its own."""
+        metrics = self.metrics
+        send_queue = send_queue_max = 0
+        for obj, mask in hub.fd_map.itervalues():
+            pending = getattr(obj, "send_pending", 0)
+            send_queue += pending
+            if pending > send_queue_max:
+                send_queue_max = pending
+        tls_handshakes = tls_resumed = 0
+        if self.ssl_context is not None:
+            sessions = self.ssl_context.session_stats()
+            tls_handshakes = int(sessions["accept_good"])
+            tls_resumed = int(sessions["hits"])
+        cache_hits = cache_misses = cache_coalesced = cache_bytes = 0
+        if self.response_cache is not None:
+            cache = self.response_cache
+            cache_hits = cache.hits
+            cache_misses = cache.misses
+            cache_coalesced = cache.coalesced
+            cache_bytes = cache.size
+        return {
+            "uptime": time.time() - metrics.started,
+            "connections_accepted": metrics.connections_accepted,
+            "connections_rejected": metrics.connections_rejected,
+            "connections_active": self.connection_count,
+            "requests": metrics.requests,
+            "requests_in_flight": self.requests_in_flight,
+            "requests_waiting": len(self.request_queue),
+            "requests_queued": metrics.requests_queued,
+            "requests_shed": metrics.requests_shed,
+            "responses": dict(metrics.responses),
+            "bytes_received": hub.bytes_received,
+            "bytes_sent": hub.bytes_sent,
+            "send_queue_bytes": send_queue,
+            "send_queue_max_bytes": send_queue_max,
+            "send_throttled": hub.send_throttled,
+            "tls_handshakes": tls_handshakes,
+            "tls_resumed": tls_resumed,
+            "tls_failed": hub.tls_failed,
+            "response_cache_hits": cache_hits,
+            "response_cache_misses": cache_misses,
+            "response_cache_coalesced": cache_coalesced,
+            "response_cache_bytes": cache_bytes,
+            "tasklets_runnable": stackless.getruncount(),
+            "parse_time": metrics.parse_time.summary(),
+            "app_time": metrics.app_time.summary(),
+            "queue_time": metrics.queue_time.summary(),
+        }
+    
+    def prometheus_text(self):
+        """Return the server's metrics in the Prometheus text exposition
+        format, the body of a response to stats_path."""
+        stats = self.stats()
+        metrics = self.metrics
+        lines = []
+        def metric(name, kind, help, value):
+            name = "stacklesswsgi_" + name
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            if isinstance(value, dict):
+                for labels, v in sorted(value.items()):
+                    lines.append("%s{%s} %r" % (name, labels, v))
+            else:
+                lines.append("%s %r" % (name, value))
+        def histogram(name, help, hist):
+            name = "stacklesswsgi_" + name
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s histogram" % name)
+            bounds = metrics.prometheus_buckets
+            for bound, n in zip(bounds, hist.cumulative(bounds)):
+                lines.append('%s_bucket{le="%r"} %d' % (name, float(bound), n))
+            lines.append('%s_bucket{le="+Inf"} %d' % (name, hist.count))
+            lines.append("%s_sum %r" % (name, hist.sum))
+            lines.append("%s_count %d" % (name, hist.count))
+        
+        metric("uptime_seconds", "gauge", "Seconds since the server started.",
+               stats["uptime"])
+        metric("connections_accepted_total", "counter",
+               "Connections accepted and served.", stats["connections_accepted"])
+        metric("connections_rejected_total", "counter",
+               "Connections turned away for want of room.",
+               stats["connections_rejected"])
+        metric("connections_active", "gauge", "Connections open.",
+               stats["connections_active"])
+        metric("requests_total", "counter", "Requests received.",
+               stats["requests"])
+        metric("requests_in_flight", "gauge",
+               "Requests admitted and not yet responded to.",
+               stats["requests_in_flight"])
+        metric("requests_waiting", "gauge", "Requests waiting for admission.",
+               stats["requests_waiting"])
+        metric("requests_queued_total", "counter",
+               "Requests that had to wait for admission.",
+               stats["requests_queued"])
+        metric("requests_shed_total", "counter",
+               "Requests turned away after waiting too long for admission.",
+               stats["requests_shed"])
+        metric("responses_total", "counter", "Responses by status class.",
+               dict(('code="%sxx"' % k, v)
+                    for k, v in stats["responses"].items()))
+        metric("received_bytes_total", "counter", "Bytes received.",
+               stats["bytes_received"])
+        metric("sent_bytes_total", "counter", "Bytes sent.",
+               stats["bytes_sent"])
+        metric("send_queue_bytes", "gauge",
+               "Bytes queued for sending on all connections.",
+               stats["send_queue_bytes"])
+        metric("send_queue_max_bytes", "gauge",
+               "Bytes queued for sending on the most backed up connection.",
+               stats["send_queue_max_bytes"])
+        metric("send_throttled_total", "counter",
+               "Writes suspended until a connection's send queue drained.",
+               stats["send_throttled"])
+        metric("tls_handshakes_total", "counter", "TLS handshakes completed.",
+               stats["tls_handshakes"])
+        metric("tls_resumed_total", "counter",
+               "TLS handshakes that resumed a session.", stats["tls_resumed"])
+        metric("tls_failed_total", "counter", "TLS handshakes that failed.",
+               stats["tls_failed"])
+        metric("response_cache_hits_total", "counter",
+               "Requests answered from the response cache.",
+               stats["response_cache_hits"])
+        metric("response_cache_misses_total", "counter",
+               "Requests the response cache could not answer.",
+               stats["response_cache_misses"])
+        metric("response_cache_coalesced_total", "counter",
+               "Requests that waited for a response being produced for "
+               "another.", stats["response_cache_coalesced"])
+        metric("response_cache_bytes", "gauge",
+               "Bytes of responses in the response cache.",
+               stats["response_cache_bytes"])
+        metric("tasklets_runnable", "gauge", "Runnable tasklets.",
+               stats["tasklets_runnable"])
+        histogram("parse_seconds", "Time taken to read and parse request heads.",
+                  metrics.parse_time)
+        histogram("app_seconds",
+                  "Time from admitting a request to its response being sent.",
+                  metrics.app_time)
+        histogram("queue_seconds", "Time requests waited for admission.",
+                  metrics.queue_time)
+        lines.append("")
+        return "\n".join(lines)
+    
+    def _stats_app(self, environ, start_response):
+        """Answers requests for stats_path from the admin_addresses with
+        prometheus_text(), and for profile_path with _profile_app(), and
+        passes all others to the application."""
+        path = environ["PATH_INFO"]
+        admin = environ.get("REMOTE_ADDR") in self.admin_addresses
+        if path == self.stats_path and admin:
+            body = self.prometheus_text()
+            start_response("200 OK", [
+                ("Content-Type", "text/plain; version=0.0.4"),
+                ("Content-Length", str(len(body))),
+                ("Cache-Control", "no-cache")])
+            return [body]
+        if path == self.profile_path and admin:
+            return self._profile_app(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+    
+    def _profile_app(self, environ, start_response):
+        """Runs a TaskletProfiler as a request for profile_path asks and
+        answers it with the results."""
+        query = parse_qs(environ.get("QUERY_STRING", ""))
+        report = query.get("format", ["folded"])[0] == "report"
+        accounting = query.get("accounting", [report and "1" or "0"])[0] == "1"
+        try:
+            seconds = float(query.get("seconds", ["10"])[0])
+            interval = float(query.get("interval", ["0.01"])[0])
+        except ValueError:
+            seconds = interval = 0
+        if (not 0 < seconds <= self.max_profile_seconds or interval <= 0
+                or interval > seconds):
+            status, body = "400 Bad Request", "Invalid seconds or interval.\n"
+        elif TaskletProfiler.active is not None:
+            status, body = "409 Conflict", "A profile is already being taken.\n"
+        else:
+            profiler = TaskletProfiler(accounting, interval)
+            done = stackless.channel()
+            def finish():
+                if done.balance < 0:
+                    done.send(None)
+            profiler.start()
+            timer = hub.call_later(seconds, finish)
+            try:
+                done.receive()
+            finally:
+                timer.cancel()
+                profiler.stop()
+            status = "200 OK"
+            if report:
+                body = profiler.report()
+            else:
+                body = profiler.folded()
+        start_response(status, [("Content-Type", "text/plain"),
+                                ("Content-Length", str(len(body))),
+                                ("Cache-Control", "no-cache")])
+        return [body]
+    
+    def _reject(self, s):
+        """Turn away a connection we have no room for."""
+        self.metrics.connections_rejected += 1
+        try:
+            s.sendall(overload_response)
+            s.drain(self.reject_drain_time)
+        finally:
+            s.close()
     
     def _accept_loop(self):
         """The main loop of the server, run in a seperate tasklet by start()."""
+        # The parts of the WSGI environment that are the same for every
+        # connection, including the value of the Server response header.
+        # Our entries are layered over the connection class's defaults here,
+        # once, so that each connection only has to copy the result.
+        server_environ = self.connection_class.environ.copy()
+        server_environ.update(self.environ)
+        server_environ["SERVER_SOFTWARE"] = "%s WSGI Server" % self.version
+        server_environ["ACTUAL_SERVER_PROTOCOL"] = self.protocol
+        server_environ["SERVER_NAME"] = self.server_name
+        if self.sock_server.ssl_context is not None:
+            server_environ["wsgi.url_scheme"] = "https"
+            server_environ["HTTPS"] = "on"
+        if isinstance(self.bind_addr, tuple):
+            server_environ["SERVER_PORT"] = str(self.bind_addr[1])
+        else:
+            # A Unix domain socket has no port, and an inherited socket's
+            # is whatever it was bound to
+            name = self.sock_server.socket.getsockname()
+            if isinstance(name, tuple):
+                server_environ["SERVER_PORT"] = str(name[1])
+            else:
+                server_environ["SERVER_PORT"] = ""
+        if self.stats_path is None and self.profile_path is None:
+            app = self.wsgi_app
+        else:
+            app = self._stats_app
+        self.accepting = True
         while self.running:
-            # This line will suspend the server tasklet until there is a connection
-            s, addr = self.sock_server.accept()
+            if (self.max_connections is not None and not self.reject_overload
+                    and self.connection_count >= self.max_connections):
+                # Leave new connections in the listen backlog until one of
+                # ours closes
+                self.connection_slot.receive()
+                continue
             
-            # See if we have already been asked to stop
-            if not self.running:
-                return
+            # Don't accept more connections than we have room for, unless
+            # there is no room and we accept them only to turn them away.
+            limit = self.accept_batch
+            if self.max_connections is not None:
+                free = self.max_connections - self.connection_count
+                if free > 0:
+                    limit = min(limit, free)
+            
+            # This line will suspend the server tasklet until there is a
+            # connection. All the connections that are pending, up to limit,
+            # are accepted at once.
+            accepted = self.sock_server.accept_many(limit)
             
-            # Initialize the WSGI environment
-            environ = self.environ.copy()
-            environ["SERVER_SOFTWARE"] = "%s WSGI Server" % self.version
-            environ["ACTUAL_SERVER_PROTOCOL"] = self.protocol
-            environ["SERVER_NAME"] = self.server_name
-            environ["SERVER_PORT"] = str(self.bind_addr[1])
+            # Serve these even if we have been asked to stop since they
+            # would be lost otherwise
+            for s, addr in accepted:
+                self._start_connection(s, addr, server_environ, app)
+        
+        self.accepting = False
+        if not self.connections:
+            self._drained()
+    
+    def _start_connection(self, s, addr, server_environ, app):
+        """Start serving the connection s from addr with the WSGI
+        application app in a new tasklet."""
+        if (self.max_connections is not None
+                and self.connection_count >= self.max_connections):
+            self.tasklet_class(self._reject)(s)
+            return
+        
+        # Initialize the WSGI environment
+        environ = server_environ.copy()
+        if isinstance(addr, tuple):
             environ["REMOTE_ADDR"] = addr[0]
             environ["REMOTE_PORT"] = str(addr[1])
-            
-            # self.connection_class is a reference to a class that will
-            # take care of reading and parsing requests out of the connection
-            conn = self.connection_class(s, self.wsgi_app, environ)
-            
-            # We create a new tasklet for each connection. This is similar
-            # to how threaded web servers work, except they usually keep a thread
-            # pool with an upper limit on number of threads. We just create new tasklets
-            # blindly without regard for how many requests the server is serving
-            # already. This is possible because of the light-weight nature of
-            # tasklets compared to threads.
-            def comm(connection):
-                try:
-                    connection.communicate()
-                finally:
-                    connection.close()
-            self.tasklet_class(comm)(conn)
-
-
-# This method is intended to be started in a seperate tasklet.
-# It will repeatedly call asyncore.poll() to dispatch asyncore events
-# to the relevant listeners.
-# This is started by sock_server, which is in turn started by the server above.
-# It is the responsibility of the caller not to invoke this if it's already
-# running. Callers can check the asyncore_loop.running attribute to see
-# if another invocation is active.
-def asyncore_loop():
-    # Make sure only one invocation is active at any time
-    assert asyncore_loop.running == False
-    asyncore_loop.running = True
+        else:
+            # The client of a Unix domain socket has no address to speak of
+            environ["REMOTE_ADDR"] = ""
+            environ["REMOTE_PORT"] = ""
+        
+        # self.connection_class is a reference to a class that will
+        # take care of reading and parsing requests out of the connection
+        conn = self.connection_class(s, app, environ, self)
+        
+        # We create a new tasklet for each connection. This is similar
+        # to how threaded web servers work, except they usually keep a thread
+        # pool with an upper limit on number of threads. Tasklets are
+        # light-weight enough that we don't need a pool, but the number of
+        # connections and requests can be limited, see max_connections and
+        # max_requests.
+        self.connection_count += 1
+        self.metrics.connections_accepted += 1
+        def comm(connection):
+            try:
+                connection.communicate()
+            finally:
+                connection.close()
+                self._connection_closed(connection)
+        self.connections[conn] = self.tasklet_class(comm)(conn)
+
+
+class Histogram(object):
+    """A histogram of durations in the manner of HdrHistogram.
+    
+    Values are kept in microseconds in log-linear buckets: each power of two
+    is split into sub_buckets equal parts, so any recorded value is known to
+    within 1/sub_buckets of itself (12.5%) whatever its magnitude, and
+    recording one is a little arithmetic and a list increment. Values of
+    more than a day and a half all land in the last bucket.
+    """
+    
+    sub_buckets = 8
+    sub_bits = 3
+    max_exponent = 33
+    
+    def __init__(self):
+        self.counts = [0] * (self.sub_buckets * (self.max_exponent + 2))
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+    
+    def record(self, seconds):
+        """Add a duration, in seconds, to the histogram."""
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+        value = int(seconds * 1000000)
+        if value < self.sub_buckets:
+            index = value if value > 0 else 0
+        else:
+            exponent = value.bit_length() - self.sub_bits - 1
+            index = (exponent << self.sub_bits) + (value >> exponent)
+            if index >= len(self.counts):
+                index = len(self.counts) - 1
+        self.counts[index] += 1
+    
+    def bucket_limit(self, index):
+        """The least value, in microseconds, beyond the bucket at index."""
+        if index < self.sub_buckets:
+            return index + 1
+        exponent = (index >> self.sub_bits) - 1
+        return (index - (exponent << self.sub_bits) + 1) << exponent
+    
+    def percentile(self, p):
+        """Return the duration in seconds that p percent of the recorded
+        durations don't exceed, to within the histogram's precision."""
+        if not self.count:
+            return 0.0
+        wanted = max(1, self.count * p / 100.0)
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= wanted:
+                return min(self.bucket_limit(index) / 1000000.0, self.max)
+        return self.max
+    
+    def cumulative(self, bounds):
+        """Return how many durations fell at or below each of bounds, a
+        sorted list of durations in seconds, for Prometheus style buckets.
+        A histogram bucket that straddles a bound is counted above it."""
+        result = []
+        seen = 0
+        index = 0
+        counts = self.counts
+        for bound in bounds:
+            limit = bound * 1000000
+            while index < len(counts) and self.bucket_limit(index) <= limit:
+                seen += counts[index]
+                index += 1
+            result.append(seen)
+        return result
+    
+    def summary(self):
+        return {"count": self.count, "sum": self.sum, "max": self.max,
+                "p50": self.percentile(50), "p90": self.percentile(90),
+                "p99": self.percentile(99), "p999": self.percentile(99.9)}
+
+
+class ServerMetrics(object):
+    """Counters and latency histograms kept by a Server, see Server.stats().
+    
+    Everything here is updated in passing by the server's tasklets, a few
+    additions and a histogram record per request, so they are always kept.
+    Durations are measured with time.time().
+    """
+    
+    # The upper bounds, in seconds, of the histogram buckets we export in
+    # Prometheus format
+    prometheus_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                          0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    
+    def __init__(self):
+        self.started = time.time()
+        self.connections_accepted = 0
+        self.connections_rejected = 0
+        self.requests = 0
+        self.requests_queued = 0
+        self.requests_shed = 0
+        # Maps the first digit of a response status to a count
+        self.responses = {}
+        # From the first byte of a request being at hand to its head parsed
+        self.parse_time = Histogram()
+        # From a request being admitted to its response being written
+        self.app_time = Histogram()
+        # How long requests waited for admission, when they had to
+        self.queue_time = Histogram()
+
+
+class TaskletProfiler(object):
+    """Finds out where a server's time goes, by tasklet and by request.
+
+    With accounting set, the time each tasklet spends running, by the wall
+    clock and in CPU time, is measured at every tasklet switch from
+    stackless's schedule callback, and the time spent on requests is added
+    up by request path, see report(). That costs two clock readings per
+    switch, so it is best left off unless it's wanted.
+
+    With sample_interval, the stack of whichever tasklet is running is
+    sampled each time the process has used another sample_interval seconds
+    of CPU, from a SIGPROF handler, and counted under the path of the
+    request that tasklet is serving. Tasklets that aren't serving a request
+    are counted under "[server]". The cost is that of the samples taken, not
+    of the switches or requests made. folded() gives the counts as folded
+    stacks, the format flamegraph.pl and speedscope read.
+
+    Only one profiler runs at a time, the active one, which HTTPRequest
+    tells when each request starts and finishes. Requests are counted under
+    at most max_paths paths, the rest under "[other]". Profilers may be
+    started and stopped on a live server, see Server.profile_path. The
+    signal handler and schedule callback are the process's own, so with
+    workers each worker has to be profiled by itself.
+    """
+
+    active = None
+
+    max_paths = 1000
+    max_depth = 100
+
+    def __init__(self, accounting=True, sample_interval=None):
+        self.accounting = accounting
+        self.sample_interval = sample_interval
+        # Maps each tasklet that has run to its [cpu, running, switches]
+        self.tasklets = {}
+        # The totals of the tasklets that have finished since, and how many
+        self.finished = [0.0, 0.0, 0, 0]
+        self.prune_size = 1024
+        # Maps each tasklet serving a request to the request's path and the
+        # tasklet's (cpu, running) totals and the time when it started
+        self.requests = {}
+        # Maps a path to its [requests, cpu, running, elapsed] totals
+        self.paths = {}
+        # Maps (path, code objects of the stack, outermost first) to the
+        # number of times it was sampled
+        self.stacks = {}
+        self.samples = 0
+        self.started = None
+        self.stopped = None
+        self.slice_cpu = 0.0
+        self.slice_wall = 0.0
+        self.old_handler = None
+
+    def start(self):
+        if TaskletProfiler.active is not None:
+            raise RuntimeError("A TaskletProfiler is already running.")
+        TaskletProfiler.active = self
+        self.started = time.time()
+        if self.accounting:
+            self.slice_cpu = time.clock()
+            self.slice_wall = time.time()
+            stackless.set_schedule_callback(self._switched)
+        if self.sample_interval:
+            self.old_handler = signal.signal(signal.SIGPROF, self._sample)
+            # Restart the system calls the signal interrupts, rather than
+            # have them fail with EINTR
+            signal.siginterrupt(signal.SIGPROF, False)
+            signal.setitimer(signal.ITIMER_PROF, self.sample_interval,
+                             self.sample_interval)
+
+    def stop(self):
+        if TaskletProfiler.active is not self:
+            return
+        if self.sample_interval:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self.old_handler or signal.SIG_DFL)
+        if self.accounting:
+            stackless.set_schedule_callback(None)
+            self._switched(stackless.getcurrent(), None)
+        TaskletProfiler.active = None
+        self.stopped = time.time()
+
+    def _switched(self, prev, next):
+        """The schedule callback. Charges the time since the last switch to
+        prev."""
+        cpu = time.clock()
+        wall = time.time()
+        if prev is not None:
+            record = self.tasklets.get(prev)
+            if record is None:
+                record = self.tasklets[prev] = [0.0, 0.0, 0]
+                if len(self.tasklets) > self.prune_size:
+                    self._prune()
+            record[0] += cpu - self.slice_cpu
+            record[1] += wall - self.slice_wall
+            record[2] += 1
+        self.slice_cpu = cpu
+        self.slice_wall = wall
+
+    def _prune(self):
+        """Fold the records of the tasklets that have finished into
+        finished."""
+        finished = self.finished
+        for t, record in self.tasklets.items():
+            if not t.alive:
+                del self.tasklets[t]
+                finished[0] += record[0]
+                finished[1] += record[1]
+                finished[2] += record[2]
+                finished[3] += 1
+        self.prune_size = max(1024, 2 * len(self.tasklets))
+
+    def _spent(self, t):
+        """Return the (cpu, running) time the current tasklet t has used."""
+        cpu = time.clock() - self.slice_cpu
+        running = time.time() - self.slice_wall
+        record = self.tasklets.get(t)
+        if record is not None:
+            cpu += record[0]
+            running += record[1]
+        return cpu, running
+
+    def _sample(self, signum, frame):
+        """The SIGPROF handler. Counts the stack of the running tasklet."""
+        codes = []
+        depth = self.max_depth
+        while frame is not None and depth:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+            depth -= 1
+        codes.reverse()
+        request = self.requests.get(stackless.getcurrent())
+        if request is None:
+            key = ("[server]", tuple(codes))
+        else:
+            key = (request[0], tuple(codes))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def request_started(self, environ):
+        """Called by the tasklet serving a request as it starts on it."""
+        path = environ.get("SCRIPT_NAME", "") + environ.get("PATH_INFO", "")
+        if path not in self.paths:
+            # Keep the folded stack format intact
+            path = (path.replace(";", "%3B").replace(" ", "%20")
+                    .replace("\r", "%0D").replace("\n", "%0A"))
+            if path not in self.paths:
+                if len(self.paths) >= self.max_paths:
+                    path = "[other]"
+                self.paths.setdefault(path, [0, 0.0, 0.0, 0.0])
+        t = stackless.getcurrent()
+        if self.accounting:
+            cpu, running = self._spent(t)
+        else:
+            cpu = running = 0.0
+        self.requests[t] = (path, cpu, running, time.time())
+
+    def request_finished(self):
+        """Called by the tasklet serving a request once it is done with it."""
+        t = stackless.getcurrent()
+        request = self.requests.pop(t, None)
+        if request is None:
+            # It started before we did
+            return
+        path, cpu, running, started = request
+        totals = self.paths[path]
+        totals[0] += 1
+        if self.accounting:
+            now_cpu, now_running = self._spent(t)
+            totals[1] += now_cpu - cpu
+            totals[2] += now_running - running
+        totals[3] += time.time() - started
+
+    def folded(self):
+        """Return the sampled stacks in the folded stack format: a line per
+        stack, its frames separated by semicolons, outermost first, then a
+        space and the number of samples. The first frame is the request
+        path."""
+        names = {}
+        lines = []
+        for (path, codes), count in self.stacks.iteritems():
+            frames = [path]
+            for code in codes:
+                name = names.get(code)
+                if name is None:
+                    name = names[code] = "%s (%s:%d)" % (
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno)
+                frames.append(name)
+            lines.append("%s %d\n" % (";".join(frames), count))
+        lines.sort()
+        return "".join(lines)
+
+    def report(self, limit=50):
+        """Return a plain text report of the time spent on each request
+        path and by the limit busiest tasklets."""
+        end = self.stopped or time.time()
+        lines = ["Profiled for %.1f seconds, %d samples." % (
+            end - (self.started or end), self.samples), ""]
+        lines.append("%10s %12s %12s %12s %10s  %s" % (
+            "requests", "cpu s", "running s", "elapsed s", "cpu ms/req",
+            "path"))
+        paths = sorted(self.paths.items(), key=lambda item: -item[1][1])
+        for path, (count, cpu, running, elapsed) in paths[:limit]:
+            lines.append("%10d %12.3f %12.3f %12.3f %10.3f  %s" % (
+                count, cpu, running, elapsed, cpu * 1000 / max(count, 1), path))
+        if self.accounting:
+            if not self.stopped:
+                # Bring the current tasklet's record up to date
+                self._switched(stackless.getcurrent(), None)
+            self._prune()
+            lines.append("")
+            lines.append("%10s %12s %12s %10s  %s" % (
+                "tasklet", "cpu s", "running s", "switches", "serving"))
+            tasklets = sorted(self.tasklets.items(),
+                              key=lambda item: -item[1][0])
+            for t, (cpu, running, switches) in tasklets[:limit]:
+                request = self.requests.get(t)
+                lines.append("%10x %12.3f %12.3f %10d  %s" % (
+                    id(t) & 0xffffffffff, cpu, running, switches,
+                    request and request[0] or ""))
+            cpu, running, switches, count = self.finished
+            lines.append("%10s %12.3f %12.3f %10d  %d finished tasklets" % (
+                "", cpu, running, switches, count))
+        lines.append("")
+        return "\n".join(lines)
+
+
+# Readiness flags as reported by poll() and epoll(). They have the same values
+# for both, and we fall back to the standard values where the select module
+# doesn't define them (e.g. on Windows).
+try:
+    POLLIN, POLLPRI, POLLOUT = select.POLLIN, select.POLLPRI, select.POLLOUT
+    POLLERR, POLLHUP, POLLNVAL = select.POLLERR, select.POLLHUP, select.POLLNVAL
+except AttributeError:
+    POLLIN, POLLPRI, POLLOUT, POLLERR, POLLHUP, POLLNVAL = 1, 2, 4, 8, 16, 32
+
+
+class _select_poller(object):
+    """A poll() look-alike built on select.select(), for platforms that have
+    neither epoll nor poll. It has to scan every descriptor on every call, so
+    it's only here to keep things working, not to be fast."""
+    
+    def __init__(self):
+        self.masks = {}
+    
+    def register(self, fd, mask):
+        self.masks[fd] = mask
+    modify = register
+    
+    def unregister(self, fd):
+        del self.masks[fd]
+    
+    def poll(self, timeout=None):
+        r = [fd for fd, mask in self.masks.iteritems() if mask & POLLIN]
+        w = [fd for fd, mask in self.masks.iteritems() if mask & POLLOUT]
+        if not r and not w:
+            # select() on Windows refuses three empty lists
+            if timeout:
+                time.sleep(timeout)
+            return []
+        r, w, e = select.select(r, w, [], timeout)
+        events = {}
+        for fd in r:
+            events[fd] = POLLIN
+        for fd in w:
+            events[fd] = events.get(fd, 0) | POLLOUT
+        return events.items()
+
+
+class timer(object):
+    """A callback scheduled on a timer_wheel. Call cancel() if it's no longer
+    wanted."""
+    
+    __slots__ = ("wheel", "tick", "callback", "slot")
+    
+    def cancel(self):
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+
+
+class timer_wheel(object):
+    """A hierarchical timing wheel, as in the Linux kernel.
+    
+    Time is divided into ticks of resolution seconds. The wheel has levels
+    of 2**bits slots each. The slots of the first level hold the timers due
+    in each of the next 2**bits ticks, the slots of the level above hold
+    2**bits ticks worth of timers each, and so on. Whenever the first level
+    wraps around, the next slot of the level above is cascaded down into
+    it. Adding and cancelling a timer takes constant time no matter how
+    many there are, which is what we need when every connection has a
+    timeout that is reset on each read and write.
+    
+    The wheel keeps its own clock, which follows time.time() but doesn't go
+    back when the system clock is set back. Otherwise the timers added
+    after the clock was set back would wait for it to catch up again.
+    """
+    
+    bits = 6
+    levels = 4
+    
+    def __init__(self, resolution=0.1):
+        self.resolution = resolution
+        self.mask = (1 << self.bits) - 1
+        self.wheels = [[set() for i in xrange(1 << self.bits)]
+                       for level in xrange(self.levels)]
+        # What we add to time.time() to get our clock, and its last reading
+        self.skew = 0.0
+        self.last = time.time()
+        # The next tick to be run
+        self.tick = int(self.last / resolution)
+        self.count = 0
+    
+    def clock(self, now):
+        """Return the wheel's time when time.time() is now."""
+        now += self.skew
+        if now < self.last:
+            # The system clock has been set back
+            self.skew += self.last - now
+            now = self.last
+        self.last = now
+        return now
+    
+    def add(self, seconds, callback):
+        """Call callback() once seconds have passed. Returns a timer."""
+        t = timer()
+        t.wheel = self
+        t.callback = callback
+        # Round up, a timer must never fire early
+        t.tick = int((self.clock(time.time()) + seconds) / self.resolution) + 1
+        self._place(t)
+        self.count += 1
+        return t
+    
+    def _place(self, t):
+        delta = max(0, t.tick - self.tick)
+        tick = max(t.tick, self.tick)
+        level = 0
+        while level < self.levels - 1 and delta >> (self.bits * (level + 1)):
+            level += 1
+        if delta >> (self.bits * self.levels):
+            # Too far away for the wheel, park it in the furthest slot. It
+            # will be placed again when that slot is cascaded.
+            tick = self.tick + (1 << (self.bits * self.levels)) - 1
+        slot = self.wheels[level][(tick >> (self.bits * level)) & self.mask]
+        slot.add(t)
+        t.slot = slot
+    
+    def _cascade(self, level, index):
+        slot = self.wheels[level][index]
+        timers = list(slot)
+        slot.clear()
+        for t in timers:
+            self._place(t)
+    
+    def timeout(self, now):
+        """How long until the wheel next has to run(), or None if it holds no
+        timers."""
+        if not self.count:
+            return None
+        now = max(now + self.skew, self.last)
+        tick = self.tick
+        slots = self.wheels[0]
+        # Look for the next non-empty slot on the first level. If there is
+        # none before it wraps around, we need to be back for the cascade.
+        while tick & self.mask and not slots[tick & self.mask]:
+            tick += 1
+        return max(0.0, tick * self.resolution - now)
+    
+    def run(self, now):
+        """Fire all timers that are due by now."""
+        target = int(self.clock(now) / self.resolution)
+        if not self.count:
+            self.tick = max(self.tick, target + 1)
+            return
+        while self.tick <= target:
+            index = self.tick & self.mask
+            if not index:
+                level = 1
+                while level < self.levels:
+                    higher = (self.tick >> (self.bits * level)) & self.mask
+                    self._cascade(level, higher)
+                    if higher:
+                        break
+                    level += 1
+            slot = self.wheels[0][index]
+            # Timers added by the callbacks must go into the next tick
+            self.tick += 1
+            if slot:
+                timers = list(slot)
+                slot.clear()
+                self.count -= len(timers)
+                for t in timers:
+                    t.slot = None
+                    try:
+                        t.callback()
+                    except (KeyboardInterrupt, SystemExit):
+                        raise
+                    except:
+                        traceback.print_exc()
+
+
+class event_hub(object):
+    """Dispatches socket readiness events to the dispatchers registered with it.
+    
+    Unlike asyncore.poll(), which asks every dispatcher in asyncore.socket_map
+    whether it is readable() and writable() on every call, the hub keeps the
+    interest mask of each descriptor registered with the kernel (using epoll
+    where available) and only changes it when a dispatcher calls update().
+    The cost of a poll is thus proportional to the number of ready sockets,
+    not the number of open ones.
+    
+    The hub loop runs in its own tasklet. When other tasklets are runnable it
+    only checks for ready sockets and yields to them. When it is the only
+    runnable tasklet it blocks in the kernel until a socket becomes ready.
+    
+    The loop also keeps the current time in now, and the current time as an
+    HTTP date in date, so that responses don't need to format it each.
+    """
+    
+    def __init__(self):
+        self.running = False
+        # Maps a file descriptor to a [dispatcher, interest mask] pair
+        self.fd_map = {}
+        self.poller = None
+        self.timers = timer_wheel()
+        # Totals over all connections
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.send_throttled = 0
+        self.tls_failed = 0
+        # Callbacks for the loop to run as soon as it can, see call_soon()
+        self.pending = deque()
+        self.wakeup_fd = None
+        self.date_second = None
+        self.tick()
+    
+    def tick(self):
+        """Update now, and date if we have moved on to another second."""
+        now = self.now = time.time()
+        second = int(now)
+        if second != self.date_second:
+            self.date_second = second
+            self.date = rfc822.formatdate(second)
+    
+    def call_later(self, seconds, callback):
+        """Have the event loop call callback() in seconds. Returns a timer."""
+        return self.timers.add(seconds, callback)
+    
+    def call_soon(self, callback):
+        """Have the event loop call callback() the next time round. Unlike
+        call_later() this is safe to call from a signal handler, after
+        watch_signals() has been called."""
+        self.pending.append(callback)
+    
+    def watch_signals(self):
+        """Make signals wake up the loop when it is waiting for sockets, so
+        that their handlers' call_soon() callbacks are run right away. It
+        must be called from the main thread."""
+        if self.wakeup_fd is not None:
+            return
+        r, w = os.pipe()
+        for fd in (r, w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        signal.set_wakeup_fd(w)
+        if self.poller is None:
+            self.poller = self._make_poller()
+        # The pipe is left out of fd_map so that it doesn't keep the loop
+        # running, see poll()
+        self.poller.register(r, POLLIN)
+        self.wakeup_fd = r
+    
+    def _make_poller(self):
+        # Each poller has its own idea of the units of the timeout and of
+        # how to say "wait forever".
+        if hasattr(select, "epoll"):
+            self.timeout_scale, self.timeout_forever = 1, -1
+            return select.epoll()
+        elif hasattr(select, "poll"):
+            self.timeout_scale, self.timeout_forever = 1000, None
+            return select.poll()
+        self.timeout_scale, self.timeout_forever = 1, None
+        return _select_poller()
+    
+    def interest(self, obj):
+        mask = 0
+        if obj.readable():
+            mask |= POLLIN | POLLPRI
+        if obj.writable():
+            mask |= POLLOUT
+        return mask
+    
+    def register(self, obj):
+        if self.poller is None:
+            self.poller = self._make_poller()
+        fd = obj._fileno
+        mask = self.interest(obj)
+        self.fd_map[fd] = [obj, mask]
+        self.poller.register(fd, mask)
+    
+    def unregister(self, obj):
+        fd = obj._fileno
+        entry = self.fd_map.pop(fd, None)
+        if entry is not None:
+            try:
+                self.poller.unregister(fd)
+            except (EnvironmentError, KeyError, ValueError):
+                # The descriptor may already have been closed behind our back
+                pass
+    
+    def update(self, obj):
+        """Recompute obj's interest mask from its readable() and writable()
+        methods and tell the kernel if it has changed. Dispatchers must call
+        this whenever the answer of either method may have changed."""
+        entry = self.fd_map.get(obj._fileno)
+        if entry is None:
+            return
+        mask = self.interest(obj)
+        if mask != entry[1]:
+            entry[1] = mask
+            self.poller.modify(obj._fileno, mask)
+    
+    def poll(self, timeout=None):
+        """Wait at most timeout seconds (forever if None) for sockets to become
+        ready and dispatch the events to their owners."""
+        if timeout is None:
+            timeout = self.timeout_forever
+        else:
+            timeout = timeout * self.timeout_scale
+        try:
+            events = self.poller.poll(timeout)
+        except (select.error, EnvironmentError), err:
+            if err.args[0] == errno.EINTR:
+                return
+            raise
+        
+        fd_map = self.fd_map
+        for fd, flags in events:
+            entry = fd_map.get(fd)
+            if entry is None:
+                if fd == self.wakeup_fd:
+                    # A signal arrived, its handler has already run
+                    try:
+                        while os.read(fd, 512):
+                            pass
+                    except OSError:
+                        pass
+                # Otherwise closed by the handler of an earlier event in
+                # this batch
+                continue
+            obj = entry[0]
+            try:
+                if flags & (POLLIN | POLLPRI):
+                    obj.handle_read_event()
+                if flags & POLLOUT and fd in fd_map:
+                    obj.handle_write_event()
+                if flags & (POLLERR | POLLHUP | POLLNVAL) and not flags & POLLIN:
+                    # If there was data to read as well, handle_read has
+                    # already found out about the error or end of stream.
+                    obj.handle_close()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                obj.handle_error()
+            if fd in fd_map:
+                self.update(obj)
+    
+    def loop(self):
+        """The event loop. This is intended to be started in a seperate tasklet
+        and is started by sock_server, which is in turn started by the Server.
+        It is the responsibility of the caller not to invoke this if it's
+        already running, see the running attribute."""
+        # Make sure only one invocation is active at any time
+        assert self.running == False
+        self.running = True
+        try:
+            while len(self.fd_map):
+                if stackless.getruncount() == 1:
+                    # We are the only tasklet running, the rest are blocked on
+                    # channels waiting for socket events. Block until one
+                    # occurs or a timer is due instead of busy waiting.
+                    self.poll(self.timers.timeout(time.time()))
+                else:
+                    self.poll(0)
+                self.tick()
+                self.timers.run(self.now)
+                while self.pending:
+                    try:
+                        self.pending.popleft()()
+                    except (KeyboardInterrupt, SystemExit):
+                        raise
+                    except:
+                        traceback.print_exc()
+                stackless.schedule()
+        finally:
+            self.running = False
+
+hub = event_hub()
+
+
+# Errors on send() and recv() that mean the other end has gone away
+_disconnected = frozenset((errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN,
+                           errno.ECONNABORTED, errno.EPIPE, errno.EBADF))
+
+# Scatter/gather writes are only possible where the socket module has
+# sendmsg(). The number of segments a single call may take is limited by
+# the platform's IOV_MAX.
+_has_sendmsg = hasattr(socket.socket, "sendmsg")
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+# sendfile() lets the kernel copy file contents straight to a socket. It's in
+# the os module from Python 3.3, the pysendfile package provides it before.
+try:
+    from os import sendfile
+except ImportError:
     try:
-        while len(asyncore.socket_map):
-            asyncore.poll(0.05)
-            stackless.schedule()
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+# Python may have been built without OpenSSL
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+
+class hub_dispatcher(asyncore.dispatcher):
+    """An asyncore.dispatcher that registers with the event hub instead of
+    asyncore.socket_map. Subclasses must call hub.update(self) whenever the
+    result of readable() or writable() may have changed."""
+    
+    def add_channel(self, map=None):
+        hub.register(self)
+    
+    def del_channel(self, map=None):
+        if self._fileno is not None:
+            hub.unregister(self)
+        self._fileno = None
+
+
+# SO_REUSEPORT lets several processes bind the same port, with the kernel
+# balancing connections between them. Python 2 doesn't know the constant.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT",
+                       sys.platform.startswith("linux") and 15 or None)
+
+# TCP_NODELAY applies to sockets of these families
+_tcp_families = frozenset([socket.AF_INET, getattr(socket, "AF_INET6", socket.AF_INET)])
+
+# On Linux accepted sockets inherit TCP_NODELAY from the listening socket, so
+# it only needs to be set there rather than on every connection.
+_nodelay_inherited = sys.platform.startswith("linux")
+
+# How Server.reload() tells the program it starts which descriptor is the
+# listening socket it hands over, and which process to stop once serving
+listen_fd = 3
+listen_fd_variable = "STACKLESSWSGI_LISTEN_FD"
+predecessor_variable = "STACKLESSWSGI_PREDECESSOR"
+
+def max_fd():
+    """One more than the highest file descriptor we may have open."""
+    try:
+        return os.sysconf("SC_OPEN_MAX")
+    except (AttributeError, ValueError, OSError):
+        return 65536
+
+def listen_socket(addr, backlog=socket.SOMAXCONN, reuse_port=False):
+    """Return a socket listening on addr, which is one of:
+    - a (host, port) pair, for TCP over IPv4, or IPv6 if host has a colon
+    - a string, the path of a Unix domain socket. A socket left behind at
+      the path by an earlier server is removed first.
+    - an integer, the file descriptor of an inherited socket that is
+      already bound. It is taken over, i.e. closed once the socket object
+      has been made from it.
+    reuse_port only applies to TCP."""
+    if isinstance(addr, (int, long)):
+        return inherited_socket(addr, backlog)
+    if isinstance(addr, basestring):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if stat.S_ISSOCK(os.stat(addr).st_mode):
+                os.unlink(addr)
+        except OSError:
+            pass
+        sock.bind(addr)
+        sock.listen(backlog)
+        return sock
+    if ":" in addr[0]:
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if reuse_port:
+        if SO_REUSEPORT is None:
+            raise socket.error(errno.ENOPROTOOPT,
+                               "SO_REUSEPORT is not supported on this platform")
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(addr)
+    sock.listen(backlog)
+    return sock
+
+def inherited_socket(fd, backlog=socket.SOMAXCONN):
+    """Return a listening socket object for the bound socket fd, which is
+    closed in favour of the socket object's own descriptor."""
+    # fromfd() needs to be told the family, but getsockname() reports the
+    # address in whatever family the socket really has.
+    probe = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        name = probe.getsockname()
     finally:
-        asyncore_loop.running = False
-asyncore_loop.running = False
+        probe.close()
+    if isinstance(name, str):
+        family = socket.AF_UNIX
+    elif len(name) == 4:
+        family = socket.AF_INET6
+    else:
+        family = socket.AF_INET
+    # fromfd() gives the bare _socket object, which hands out bare sockets
+    # from accept() that the ssl module can't wrap
+    sock = socket.socket(_sock=socket.fromfd(fd, family, socket.SOCK_STREAM))
+    os.close(fd)
+    # Make sure it is listening, and with our backlog
+    sock.listen(backlog)
+    return sock
+
+
+# Renegotiation is of no use to HTTP/1.1 and would let a client have us do
+# handshakes at will. Python 2 doesn't know the OpenSSL 1.1 constant.
+OP_NO_RENEGOTIATION = getattr(ssl, "OP_NO_RENEGOTIATION", 0x40000000)
 
+def make_ssl_context(certificate, private_key=None):
+    """Return an ssl.SSLContext for serving HTTPS with the certificate chain
+    in the PEM file certificate and the private key in private_key, or in
+    certificate as well if that is None."""
+    if ssl is None:
+        raise RuntimeError("TLS needs Python's ssl module")
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certificate, private_key)
+    context.options |= OP_NO_RENEGOTIATION
+    if hasattr(context, "set_alpn_protocols"):
+        context.set_alpn_protocols(["http/1.1"])
+    return context
 
-class sock_server(asyncore.dispatcher):
-    """This is an asyncore.dispatcher that listens on a TCP port. For each
-    incoming connection, a sock_channel dispatcher is created and given
-    responsibility over the socket"""
+
+class sock_server(hub_dispatcher):
+    """This is a dispatcher that listens on a TCP port or a Unix domain
+    socket. For each incoming connection, a sock_channel dispatcher is
+    created and given responsibility over the socket"""
+    
+    # When we run out of file descriptors, we stop accepting for this many
+    # seconds, leaving connections in the listen backlog until some close.
+    accept_backoff = 0.1
     
-    def __init__(self, addr):
-        """Bind to addr and start listening"""
+    def __init__(self, addr, sock=None, backlog=socket.SOMAXCONN,
+                 ssl_context=None):
+        """Bind to addr and start listening, or listen on sock if given. addr
+        may be anything listen_socket() accepts. sock must already be bound
+        and listening, e.g. inherited from a parent. With ssl_context, an
+        ssl.SSLContext, connections are ssl_channels speaking TLS."""
         asyncore.dispatcher.__init__(self)
-        self.accept_channel = None
+        self.ssl_context = ssl_context
+        self.accept_channel = stackless.channel()
+        # The hub must keep dispatching events when it hands a connection
+        # to the accepting tasklet, rather than switch to it right away.
+        self.accept_channel.preference = 1
+        self.accept_waiting = 0
+        self.accept_limit = 1
+        # Set while we back off after running out of file descriptors
+        self.accept_paused = False
         self.addr = addr
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.bind(addr)
-        self.listen(5)
+        if sock is None:
+            sock = listen_socket(addr, backlog)
+        elif sock.family in _tcp_families:
+            # An inherited socket may not have it set yet
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(0)
+        self.set_socket(sock)
+        self.accepting = True
         
-        # Start the asyncore polling loop if it's not already running
-        if not asyncore_loop.running:
-            stackless.tasklet(asyncore_loop)()
+        # Start the event loop if it's not already running
+        if not hub.running:
+            stackless.tasklet(hub.loop)()
+    
+    def readable(self):
+        # Only ask for accept events while someone is waiting in accept(),
+        # otherwise the pending connection would be reported over and over.
+        return self.accept_waiting > 0 and not self.accept_paused
+    
+    def writable(self):
+        return False
+    
+    def _resume_accept(self):
+        self.accept_paused = False
+        hub.update(self)
     
     def accept(self):
+        """Wait for a connection and return a (sock_channel, address) pair."""
+        return self.accept_many(1)[0]
+    
+    def accept_many(self, limit):
+        """Wait for connections and return a list of at least one and at most
+        limit (sock_channel, address) pairs, as many as are pending."""
         # This will suspend the current tasklet (by reading from
         # self.accept_channel). See handle_accept for details on
         # when the tasklet is resumed.
-        if self.accept_channel is None:
-            self.accept_channel = stackless.channel()
+        self.accept_limit = limit
+        self.accept_waiting += 1
+        hub.update(self)
         return self.accept_channel.receive()
 
     def handle_accept(self):
-        # This is called by asyncore to signal that a socket is ready for
-        # accept on the listening port. We see if any calls to self.accept()
-        # are waiting on self.accept_channel. If so, we accept the socket
-        # and write the results on the channel and the tasklet that called
-        # accept() is resumed.
-        if self.accept_channel and self.accept_channel.balance < 0:
-            s, a = asyncore.dispatcher.accept(self)
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s = sock_channel(s)
-            self.accept_channel.send((s,a))
-    
-
-class sock_channel(asyncore.dispatcher):
-    """This is an asyncore dispatcher in charge of handling connections
+        # This is called by the hub to signal that sockets are ready for
+        # accept on the listening port. We see if any calls to accept_many()
+        # are waiting on self.accept_channel. If so, we accept as many
+        # sockets as are pending and we are asked for, and write them on the
+        # channel in one go. The tasklet that called accept_many() is resumed.
+        if not self.accept_waiting or self.accept_channel.balance >= 0:
+            return
+        accepted = []
+        accept = self.socket.accept
+        set_nodelay = not _nodelay_inherited
+        context = self.ssl_context
+        for i in xrange(self.accept_limit):
+            try:
+                s, a = accept()
+            except socket.error, why:
+                if why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN,
+                                   errno.ECONNABORTED):
+                    # No more pending, or someone else got to it first
+                    break
+                if accepted:
+                    # e.g. out of file descriptors. Serve what we have, we
+                    # will hear of the rest again.
+                    break
+                if why.args[0] in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+                                   errno.ENOMEM):
+                    # Raising would close the listening socket. Leave the
+                    # connections in the backlog and try again shortly,
+                    # when some of ours may have closed.
+                    self.accept_paused = True
+                    hub.call_later(self.accept_backoff, self._resume_accept)
+                    return
+                raise
+            if context is None:
+                accepted.append((sock_channel(s, a, set_nodelay), a))
+            else:
+                accepted.append((ssl_channel(s, a, set_nodelay, context), a))
+        if accepted:
+            self.accept_waiting -= 1
+            self.accept_channel.send(accepted)
+    
+
+class file_segment(object):
+    """A region of an open file, queued on a sock_channel like a string. It
+    is written out with sendfile(), so its contents never pass through Python.
+    The file must stay open until the segment has been sent."""
+    
+    def __init__(self, fd, offset, count):
+        self.fd = fd
+        self.offset = offset
+        self.count = count
+    
+    def __len__(self):
+        return self.count
+
+
+class sock_channel(hub_dispatcher):
+    """This is a dispatcher in charge of handling connections
     to http clients."""
     
-    def __init__(self, sock):
+    def __init__(self, sock, addr=None, set_nodelay=True):
         """Initialize and start handling the connection on sock. Usually called
-        by sock_server"""
+        by sock_server, which passes the peer's address as returned by accept()
+        and tells us whether TCP_NODELAY has already been inherited from the
+        listening socket."""
         if sock.type == socket.SOCK_DGRAM:
             raise NotImplementedError("sock_channel can only handle TCP sockets")
-        asyncore.dispatcher.__init__(self, sock)
-        self.send_buffer = ""
-        self.recv_buffer = ""
+        # These must be set up before registering with the hub, which asks
+        # for readable() and writable().
+        # Outgoing data is kept as a queue of the strings handed to send(),
+        # which are never joined or re-sliced. send_offset is how much of the
+        # first one has already been written and send_pending the number of
+        # bytes left in the queue.
+        self.send_queue = deque()
+        self.send_offset = 0
+        self.send_pending = 0
+        self.bytes_sent = 0
+        self.bytes_copied = 0
+        # Incoming data is read straight into recv_buffer. The unread data is
+        # recv_buffer[recv_start:recv_end], the rest is free space.
+        self.recv_buffer = bytearray()
+        self.recv_start = 0
+        self.recv_end = 0
+        self.read_waiting = False
+        # How long a tasklet may wait for data to arrive, or for any of its
+        # output to be written, before the connection is given up on. The
+        # deadline is a timer that closes the connection regardless.
+        self.read_timeout = None
+        self.write_timeout = None
+        self.write_timer = None
+        self.deadline = None
+        # A tasklet waiting in sendall(), or for the queue to drain to the
+        # low water mark, receives on sendall_channel. It is woken once no
+        # more than send_wake_level bytes are left to send.
         self.sendall_channel = None
+        self.send_wake_level = 0
         self.recv_channel = stackless.channel()
+        # The hub should keep dispatching events after waking up a reader
+        self.recv_channel.preference = 1
+        # This is what asyncore.dispatcher.__init__ does, minus the system
+        # calls we can do without. Being marked as connected before we
+        # register with the hub saves updating our interest mask right after.
+        asyncore.dispatcher.__init__(self)
+        sock.setblocking(0)
+        self.socket = sock
+        self._recv_into = sock.recv_into
+        self._fileno = sock.fileno()
+        self.connected = True
+        if addr is None:
+            try:
+                addr = sock.getpeername()
+            except socket.error:
+                pass
+        self.addr = addr
+        if set_nodelay and sock.family in _tcp_families:
+            # We coalesce our output ourselves, what we write should go
+            # out right away.
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.add_channel()
+    
+    def readable(self):
+        # We only ask for read events while a tasklet is waiting in recv().
+        # The rest of the time unread data stays in the kernel buffer.
+        return self.read_waiting
     
     def writable(self):
         if not self.connected:
             return True
         # If we have buffered data to send, we're intersted in write events
-        return len(self.send_buffer)
+        return self.send_pending > 0
     
-    def send(self, data):
-        if self.send_buffer is None:
+    def _enqueue(self, data):
+        """Queue data, and return how many bytes it is."""
+        if self.send_queue is None:
             raise socket.error(socket.EBADF, "Connection closed")
-        self.send_buffer += data
-        # Request a schedule so that asyncore get's a chance to invoke the
-        # handle_write event. There is no guarantee that the data will have
-        # been sent completely when we return to here again.
-        stackless.schedule()
-        return len(data)
+        size = 0
+        if isinstance(data, (list, tuple)):
+            for segment in data:
+                if segment:
+                    self.send_queue.append(segment)
+                    size += len(segment)
+        elif data:
+            self.send_queue.append(data)
+            size = len(data)
+        self.send_pending += size
+        hub.update(self)
+        return size
+    
+    # Watermarks for the send queue. Once more than send_high_water bytes
+    # are queued, send() and write() suspend the calling tasklet until no
+    # more than send_low_water are left. A client that reads slowly thus
+    # holds up whoever writes to it rather than costing us memory, and the
+    # writer gets to queue more before the kernel runs out of data to send.
+    send_high_water = 262144
+    send_low_water = 65536
+    
+    def send(self, data):
+        """Queue data for sending and yield to let the hub write it out.
+        data may be a string or a list of strings, which are sent in as few
+        system calls as possible without being joined first. The strings
+        are queued by reference and must not be modified afterwards."""
+        size = self._enqueue(data)
+        if self.send_pending > self.send_high_water:
+            self._throttle()
+        else:
+            # Request a schedule so that the hub get's a chance to invoke the
+            # handle_write event. There is no guarantee that the data will
+            # have been sent completely when we return to here again.
+            stackless.schedule()
+        return size
 
     def sendall(self, data):
-        if self.send_buffer is None:
-            raise socket.error(socket.EBADF, "Connection closed")
-        self.send_buffer += data
+        """Like send(), but only returns once everything has been written."""
+        size = self._enqueue(data)
+        if not self.send_pending:
+            return 0
         # Instead of asking for a schedule like send() does, we suspend
-        # the current tasklet by reading from self.sendall_channel. Only
-        # when the send_buffer has been completely sent on the wire, this
-        # call is resumed.
+        # the current tasklet until the send_queue has been completely sent
+        # on the wire.
+        self._wait_for_output(0)
+        # Here we are guaranteed that all of data has been sent
+        return size
+
+    def write(self, data):
+        """Queue data for sending and return without yielding, unless more
+        than send_high_water bytes are queued. The hub writes it out together
+        with anything queued after it the next time it runs. Use flush() to
+        wait until it has been written."""
+        self._enqueue(data)
+        if self.send_pending > self.send_high_water:
+            self._throttle()
+    
+    def _throttle(self):
+        # Too much is queued, wait for the client to catch up
+        hub.send_throttled += 1
+        self._wait_for_output(self.send_low_water)
+    
+    def _wait_for_output(self, level):
+        """Suspend the current tasklet until no more than level bytes are left
+        to send. If none are written for write_timeout seconds, the connection
+        is closed and socket.timeout is raised."""
         if self.sendall_channel is None:
             self.sendall_channel = stackless.channel()
-        self.sendall_channel.receive()
-        # Here we are guaranteed that all of data has been sent
-        return len(data)
+            self.sendall_channel.preference = 1
+        self.send_wake_level = level
+        if self.write_timeout is not None:
+            # handle_write pushes this back whenever it makes progress
+            self.write_timer = hub.call_later(self.write_timeout, self.timed_out)
+        try:
+            self.sendall_channel.receive()
+        finally:
+            if self.write_timer is not None:
+                self.write_timer.cancel()
+                self.write_timer = None
+
+    def flush(self):
+        """Suspend the current tasklet until everything queued has been
+        written."""
+        self.sendall(())
+
+    # Without sendmsg() each write takes a single segment. Runs of segments
+    # smaller than this (headers, chunk framing) are joined before being
+    # written so that they don't cost a system call each.
+    coalesce_size = 16384
+    
+    def _write_segments(self):
+        """Write as much of the send queue as the kernel will take in a single
+        system call. Returns the number of bytes written and the number of
+        bytes we tried to write."""
+        queue = self.send_queue
+        head = queue[0]
+        if isinstance(head, file_segment):
+            count = len(head) - self.send_offset
+            return sendfile(self._fileno, head.fd,
+                            head.offset + self.send_offset, count), count
+        if self.send_offset:
+            head = buffer(head, self.send_offset)
+        if _has_sendmsg and len(queue) > 1:
+            segments = [head]
+            for segment in islice(queue, 1, IOV_MAX):
+                if isinstance(segment, file_segment):
+                    break
+                segments.append(segment)
+            attempted = sum([len(segment) for segment in segments])
+            return self.socket.sendmsg(segments), attempted
+        
+        if (not self.send_offset and isinstance(head, str)
+                and len(head) < self.coalesce_size and len(queue) > 1):
+            # Join the small segments at the front of the queue. Each
+            # segment is copied at most once this way.
+            total = len(head)
+            count = 1
+            for segment in islice(queue, 1, None):
+                if (not isinstance(segment, str)
+                        or total + len(segment) > self.coalesce_size):
+                    break
+                total += len(segment)
+                count += 1
+            if count > 1:
+                head = "".join([queue.popleft() for i in xrange(count)])
+                queue.appendleft(head)
+                self.bytes_copied += total
+        return self.socket.send(head), len(head)
+    
+    def handle_write(self):
+        # This is called by the hub when it is ready to send out data.
+        # We keep writing until the kernel's send buffer is full or we
+        # have nothing more to send.
+        queue = self.send_queue
+        while queue:
+            try:
+                written, attempted = self._write_segments()
+            except EnvironmentError, why:
+                if why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    break
+                elif why.args[0] in _disconnected:
+                    self.handle_close()
+                    return
+                raise
+            
+            if not written and isinstance(queue[0], file_segment):
+                # The file is shorter than it was when it was queued, so we
+                # can't send what we promised. All we can do is hang up.
+                self.handle_close()
+                return
+            
+            self.send_pending -= written
+            self.bytes_sent += written
+            hub.bytes_sent += written
+            if written and self.write_timer is not None:
+                self.write_timer.cancel()
+                self.write_timer = hub.call_later(self.write_timeout, self.timed_out)
+            # Drop the segments that were written completely and remember
+            # how far we got into the next one.
+            offset = self.send_offset + written
+            while queue and offset >= len(queue[0]):
+                offset -= len(queue.popleft())
+            self.send_offset = offset
+            
+            if written < attempted:
+                # The kernel didn't take everything, wait for the next event
+                break
+
+        # If a tasklet is waiting in sendall for us to send everything in
+        # self.send_queue, or for the queue to drain to the low water mark,
+        # and we got that far, let it know so it can resume.
+        if (self.sendall_channel and self.sendall_channel.balance < 0
+                and self.send_pending <= self.send_wake_level):
+            self.sendall_channel.send(None)
+
+    # The most we ask the kernel for per read event. The receive buffer grows
+    # beyond this when a caller waits for a long line or a large read.
+    recv_size = 16384
+    
+    def _wait_for_data(self, timeout=None):
+        """Suspend the current tasklet until handle_read has added data to the
+        receive buffer. Returns False if there will be no more data. If none
+        arrives within timeout (read_timeout by default) seconds, the
+        connection is closed and socket.timeout is raised."""
+        if not self.connected:
+            return False
+        if timeout is None:
+            timeout = self.read_timeout
+        available = self.recv_end - self.recv_start
+        self.read_waiting = True
+        hub.update(self)
+        t = None
+        if timeout is not None:
+            t = hub.call_later(timeout, self.timed_out)
+        try:
+            self.recv_channel.receive()
+        finally:
+            if t is not None:
+                t.cancel()
+        return self.recv_end - self.recv_start > available
+    
+    def wait_for_data(self, timeout=None):
+        """Suspend the current tasklet until there is unread data. See
+        _wait_for_data for the arguments and return value."""
+        if self.recv_start < self.recv_end:
+            return True
+        return self._wait_for_data(timeout)
+
+    def buffered(self, delimiter, skip=0):
+        """Return True if delimiter occurs in the data that has already been
+        received, not counting the first skip bytes. Nothing is read."""
+        start = self.recv_start + skip
+        if start >= self.recv_end:
+            return False
+        return self.recv_buffer.find(delimiter, start, self.recv_end) >= 0
+
+    def set_deadline(self, seconds):
+        """Close the connection, raising socket.timeout in any waiting tasklet,
+        if clear_deadline() hasn't been called within seconds."""
+        self.clear_deadline()
+        self.deadline = hub.call_later(seconds, self.timed_out)
+    
+    def clear_deadline(self):
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+    
+    def timed_out(self):
+        """Called by the hub when one of our timeouts expires."""
+        self.deadline = None
+        self.write_timer = None
+        while self.recv_channel.balance < 0:
+            self.recv_channel.send_exception(socket.timeout, "timed out")
+        while self.sendall_channel and self.sendall_channel.balance < 0:
+            self.sendall_channel.send_exception(socket.timeout, "timed out")
+        self.close()
+    
+    def _consume(self, byte_count):
+        """Return the next byte_count bytes of the receive buffer as a string."""
+        start = self.recv_start
+        data = str(buffer(self.recv_buffer, start, byte_count))
+        self.recv_start = start + byte_count
+        if self.recv_start == self.recv_end:
+            # Everything has been read, start over at the beginning of the
+            # buffer. If it had to grow for a large read, let it go.
+            self.recv_start = self.recv_end = 0
+            if len(self.recv_buffer) > self.recv_size:
+                self.recv_buffer = bytearray()
+        return data
+    
+    def recv(self, byte_count):
+        # A call to this method will suspend the current tasklet until there is
+        # data available to be received. See handle_read on how that happens.
+        if byte_count > 0 and self.recv_start == self.recv_end:
+            self._wait_for_data()
+        
+        # Give the caller only as much as he asked for
+        return self._consume(min(byte_count, self.recv_end - self.recv_start))
+    
+    def read(self, byte_count=-1):
+        """Read byte_count bytes, or until the other end closes the connection
+        if byte_count is negative. Less data is returned only at end of stream."""
+        if byte_count < 0:
+            while self._wait_for_data():
+                pass
+            byte_count = self.recv_end - self.recv_start
+        else:
+            while self.recv_end - self.recv_start < byte_count:
+                if not self._wait_for_data():
+                    byte_count = self.recv_end - self.recv_start
+                    break
+        return self._consume(byte_count)
+    
+    def read_until(self, delimiter, limit):
+        """Read up to and including the next occurence of delimiter. Returns
+        None, and consumes nothing, if it doesn't occur within limit bytes.
+        If the connection is closed first, whatever is left is returned."""
+        scanned = 0
+        overlap = len(delimiter) - 1
+        while True:
+            end = min(self.recv_end, self.recv_start + limit)
+            idx = self.recv_buffer.find(delimiter, self.recv_start + scanned, end)
+            if idx >= 0:
+                return self._consume(idx + len(delimiter) - self.recv_start)
+            if end - self.recv_start >= limit:
+                return None
+            # The delimiter may straddle the end of what we have so far
+            scanned = max(0, end - self.recv_start - overlap)
+            if not self._wait_for_data():
+                return self._consume(self.recv_end - self.recv_start)
+    
+    def readline(self, limit=-1):
+        """Read up to and including the next newline, but no more than limit
+        bytes if limit is not negative."""
+        # Where to resume looking for the newline, relative to recv_start.
+        # Data we have already scanned is not scanned again.
+        scanned = 0
+        while True:
+            end = self.recv_end
+            if limit >= 0:
+                end = min(end, self.recv_start + limit)
+            idx = self.recv_buffer.find("\n", self.recv_start + scanned, end)
+            if idx >= 0:
+                return self._consume(idx + 1 - self.recv_start)
+            scanned = end - self.recv_start
+            if limit >= 0 and scanned >= limit:
+                return self._consume(limit)
+            if not self._wait_for_data():
+                return self._consume(self.recv_end - self.recv_start)
+    
+    def handle_read(self):
+        # This is called by the hub to let us know that there is data available
+        # to be received.
+        buf = self.recv_buffer
+        if len(buf) - self.recv_end < self.recv_size:
+            # Make room at the end of the buffer for recv_size bytes, first by
+            # dropping what has already been read and then by growing it.
+            if self.recv_start:
+                del buf[:self.recv_start]
+                self.recv_end -= self.recv_start
+                self.recv_start = 0
+            if len(buf) - self.recv_end < self.recv_size:
+                buf.extend(bytearray(self.recv_size - (len(buf) - self.recv_end)))
+        try:
+            view = memoryview(buf)[self.recv_end:]
+            try:
+                received = self._recv_into(view, self.recv_size)
+            finally:
+                # The buffer can't be resized while the view is alive
+                del view
+        except socket.error, err:
+            if err.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                # Nothing after all, keep waiting
+                return
+            if err.args[0] in _disconnected:
+                self.handle_close()
+                return
+            self.read_waiting = False
+            if self.send_queue:
+                self.send_queue.clear()
+                self.send_offset = self.send_pending = 0
+            # Any errors on the socket is propogated to the callers of recv()
+            if self.recv_channel.balance < 0:
+                self.recv_channel.send_exception(socket.error, *err.args)
+            return
+        if not received:
+            # This means the other end closed the connection, close our end.
+            # This also wakes up anyone waiting in recv().
+            self.handle_close()
+            return
+        self.read_waiting = False
+        self.recv_end += received
+        hub.bytes_received += received
+        # Wake whoever is calling recv()
+        if self.recv_channel.balance < 0:
+            self.recv_channel.send(None)
+
+    def shutdown_write(self):
+        """Tell the other end we won't send any more, keeping our end open
+        for reading."""
+        self.socket.shutdown(socket.SHUT_WR)
+    
+    def drain(self, timeout, limit=65536):
+        """Shut down our end for writing and discard what the other end sends
+        until it closes the connection, for at most timeout seconds and limit
+        bytes. Closing a socket with unread data makes the kernel reset the
+        connection, and the other end may then lose what we sent it last."""
+        deadline = time.time() + timeout
+        discarded = 0
+        try:
+            self.shutdown_write()
+            while discarded < limit:
+                discarded += self.recv_end - self.recv_start
+                self.recv_start = self.recv_end = 0
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._wait_for_data(remaining):
+                    break
+        except socket.error:
+            # Including socket.timeout, we have waited long enough
+            pass
+
+    def close(self):
+        if self.send_queue is None:
+            # Already closed
+            return
+        asyncore.dispatcher.close(self)
+        # The bound method would keep the socket, and its descriptor, open
+        self._recv_into = None
+        self.connected = False
+        self.accepting = False
+        self.read_waiting = False
+        self.send_queue = None
+        self.send_pending = 0
+        self.clear_deadline()
+        
+        # Wake any tasklets that are waiting for sendall() to return
+        if self.sendall_channel and self.sendall_channel.balance < 0:
+            self.sendall_channel.send(None)
+        
+        # Wake any tasklets that are waiting for recv to return
+        while self.recv_channel and self.recv_channel.balance < 0:
+            self.recv_channel.send(None)
+    
+    def handle_close(self):
+        self.close()
+
+    def handle_expt(self):
+        self.close()
+
+
+class ssl_channel(sock_channel):
+    """A sock_channel that speaks TLS, on a socket wrapped with an
+    ssl.SSLContext. The hub does the server's side of the handshake as soon
+    as the client starts it, so the tasklet serving the connection only
+    ever sees the request.
+    
+    Queued data is encrypted as it is written, ssl_write_size bytes at a
+    time. Strings are handed to OpenSSL by reference, except that small ones
+    are joined to share a record. File segments are mapped rather than sent
+    with sendfile(), so their contents don't pass through Python either."""
+    
+    # The most we encrypt per write, a full TLS record
+    ssl_write_size = 16384
+    
+    def __init__(self, sock, addr=None, set_nodelay=True, context=None):
+        sock = context.wrap_socket(sock, server_side=True,
+                                   do_handshake_on_connect=False)
+        # Set up before sock_channel registers with the hub. Until the
+        # handshake is done, it tells us whether it waits to read or write.
+        self.handshaking = True
+        self.handshake_write = False
+        # After a write that would have blocked, OpenSSL must be given the
+        # same data again
+        self.ssl_retry = None
+        # The file segment at the head of the send queue and a map of the
+        # file from the page it starts on
+        self.mapped_segment = None
+        self.mapped = None
+        self.mapped_start = 0
+        sock_channel.__init__(self, sock, addr, set_nodelay)
+        self._recv_into = self._ssl_recv_into
+    
+    def readable(self):
+        if self.handshaking:
+            return not self.handshake_write
+        return self.read_waiting
+    
+    def writable(self):
+        if self.handshaking:
+            return self.handshake_write
+        return sock_channel.writable(self)
+    
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError, err:
+            if err.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.handshake_write = False
+            elif err.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.handshake_write = True
+            else:
+                # Not TLS, or nothing in common with the client
+                hub.tls_failed += 1
+                self.handle_close()
+            return
+        except socket.error:
+            hub.tls_failed += 1
+            self.handle_close()
+            return
+        self.handshaking = False
+        if self.read_waiting:
+            # The request may have come along with the end of the handshake
+            sock_channel.handle_read(self)
+    
+    def handle_read(self):
+        if self.handshaking:
+            self._handshake()
+        else:
+            sock_channel.handle_read(self)
+    
+    def handle_write(self):
+        if self.handshaking:
+            self._handshake()
+        else:
+            sock_channel.handle_write(self)
+    
+    def _ssl_recv_into(self, view, size):
+        try:
+            return self.socket.recv_into(view, size)
+        except ssl.SSLError, err:
+            if err.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                # Only part of a record has arrived
+                raise socket.error(errno.EWOULDBLOCK, "TLS record incomplete")
+            raise
+    
+    def _wait_for_data(self, timeout=None):
+        if self.connected and not self.handshaking and self.socket.pending():
+            # OpenSSL has decrypted more than we took. The socket won't tell
+            # the hub about that, so there is no need to wait.
+            available = self.recv_end - self.recv_start
+            self.read_waiting = True
+            sock_channel.handle_read(self)
+            return self.recv_end - self.recv_start > available
+        return sock_channel._wait_for_data(self, timeout)
+    
+    def _write_segments(self):
+        data = self.ssl_retry
+        if data is None:
+            data = self._next_record()
+            if data is None:
+                # See handle_write
+                return 0, len(self.send_queue[0])
+        written = self.socket.send(data)
+        if not written:
+            self.ssl_retry = data
+            raise socket.error(errno.EWOULDBLOCK, "TLS write would block")
+        self.ssl_retry = None
+        return written, len(data)
+    
+    def _next_record(self):
+        """Return up to ssl_write_size bytes from the front of the send
+        queue, or None if it's a segment of a file that is now shorter."""
+        queue = self.send_queue
+        head = queue[0]
+        offset = self.send_offset
+        size = self.ssl_write_size
+        if isinstance(head, file_segment):
+            if head is not self.mapped_segment and not self._map_segment(head):
+                return None
+            return buffer(self.mapped, self.mapped_start + offset,
+                          min(size, len(head) - offset))
+        if self.mapped is not None:
+            self._unmap()
+        if offset:
+            head = buffer(head, offset)
+        if len(head) >= size:
+            return buffer(head, 0, size)
+        if len(queue) == 1:
+            return head
+        
+        # Fill the record up with what follows
+        pieces = [head]
+        total = len(head)
+        for segment in islice(queue, 1, None):
+            if isinstance(segment, file_segment):
+                break
+            if total + len(segment) > size:
+                pieces.append(segment[:size - total])
+                total = size
+                break
+            pieces.append(segment)
+            total += len(segment)
+        if len(pieces) == 1:
+            return head
+        self.bytes_copied += total
+        return "".join([str(piece) for piece in pieces])
+    
+    def _map_segment(self, segment):
+        self._unmap()
+        end = segment.offset + segment.count
+        if os.fstat(segment.fd).st_size < end:
+            return False
+        start = segment.offset - segment.offset % mmap.ALLOCATIONGRANULARITY
+        self.mapped = mmap.mmap(segment.fd, end - start,
+                                access=mmap.ACCESS_READ, offset=start)
+        self.mapped_start = segment.offset - start
+        self.mapped_segment = segment
+        return True
+    
+    def _unmap(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = self.mapped_segment = None
+    
+    def shutdown_write(self):
+        # SSLSocket.shutdown() would stop TLS on a socket we still read
+        # from. The other end closes once it has what we sent.
+        pass
+    
+    def close(self):
+        self.ssl_retry = None
+        self._unmap()
+        sock_channel.close(self)
+
+
+class sock_channel_rfile(object):
+    """This class provides a read-only file-like object on top of sock_channel.
+    It is used by the HTTPRequest class to get data from the connection and
+    allow WSGI apps to read the request body."""
+    
+    def __init__(self, sock_chan):
+        self.sock_chan = sock_chan
+        # How much has been read, so that HTTPRequest can tell whether the
+        # application read the whole request body
+        self.bytes_read = 0
+    
+    def read(self, size=-1):
+        data = self.sock_chan.read(size)
+        self.bytes_read += len(data)
+        return data
+    
+    def readline(self, size=-1):
+        data = self.sock_chan.readline(size)
+        self.bytes_read += len(data)
+        return data
+    
+    def read_until(self, delimiter, limit):
+        data = self.sock_chan.read_until(delimiter, limit)
+        if data is not None:
+            self.bytes_read += len(data)
+        return data
+    
+    def readlines(self, hint=None):
+        lines = []
+        line = self.readline()
+        while line:
+            lines.append(line)
+            line = self.readline()
+        return lines
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        line = self.readline()
+        if line:
+            return line
+        else:
+            raise StopIteration
+    
+    def close(self):
+        self.sock_chan = None
+
+
+# The rest of this file is taken from CherryPy's excellent WSGI Server by Robert
+# Brewer. CherryPy is distributed under the BSD license.
+# See http://www.cherrypy.org for more information. I have only removed parts
+# relevant to SSL support and added one call to stackless.schedule.
+# Otherwise, this code is:
+#
+# Copyright (c) 2004, CherryPy Team (team@cherrypy.org)
+# All rights reserved.
+
+quoted_slash = re.compile("(?i)%2F")
+http_version = re.compile(r"HTTP/\d\.\d$")
+
+socket_errors_to_ignore = set(getattr(errno, _) for _ in ("EPIPE", "ETIMEDOUT",
+          "ECONNREFUSED", "ECONNRESET", "EHOSTDOWN", "EHOSTUNREACH", "EBADF",
+          "WSAECONNABORTED", "WSAECONNREFUSED", "WSAECONNRESET",
+          "WSAENETRESET", "WSAETIMEDOUT") if _ in dir(errno))
+socket_errors_to_ignore.add("timed out")
+
+# The addresses of the local host, see Server.admin_addresses
+local_addresses = ("127.0.0.1", "::1", "::ffff:127.0.0.1")
+
+continue_response = "HTTP/1.1 100 Continue\r\n\r\n"
+
+# What we send to connections we turn away because we are overloaded
+overload_response = ("HTTP/1.1 503 Service Unavailable\r\n"
+                     "Content-Length: 0\r\n"
+                     "Connection: close\r\n"
+                     "Retry-After: 1\r\n\r\n")
+
+comma_separated_headers = set(['ACCEPT', 'ACCEPT-CHARSET', 'ACCEPT-ENCODING',
+    'ACCEPT-LANGUAGE', 'ACCEPT-RANGES', 'ALLOW', 'CACHE-CONTROL',
+    'CONNECTION', 'CONTENT-ENCODING', 'CONTENT-LANGUAGE', 'EXPECT',
+    'IF-MATCH', 'IF-NONE-MATCH', 'PRAGMA', 'PROXY-AUTHENTICATE', 'TE',
+    'TRAILER', 'TRANSFER-ENCODING', 'UPGRADE', 'VARY', 'VIA', 'WARNING',
+    'WWW-AUTHENTICATE'])
+comma_separated_environ_keys = set("HTTP_" + h.replace("-", "_")
+                                   for h in comma_separated_headers)
+
+# Maps header names, as sent by clients, to their environ keys. Clients send
+# the same few names over and over, so this saves us from building the key
+# anew for each header of each request. It is primed with the common ones and
+# learns new ones up to a limit, so that a client can't make it grow forever.
+header_environ_keys = {}
+header_environ_keys_max = 1000
+
+def header_environ_key(name):
+    """Return the (interned) environ key for a header name."""
+    try:
+        return header_environ_keys[name]
+    except KeyError:
+        pass
+    key = intern("HTTP_" + name.strip().upper().replace("-", "_"))
+    if len(header_environ_keys) < header_environ_keys_max:
+        header_environ_keys[name] = key
+    return key
+
+for _ in ("Accept", "Accept-Charset", "Accept-Encoding", "Accept-Language",
+          "Authorization", "Cache-Control", "Connection", "Content-Length",
+          "Content-Type", "Cookie", "Expect", "Host", "If-Modified-Since",
+          "If-None-Match", "Keep-Alive", "Origin", "Pragma", "Range", "Referer",
+          "TE", "Transfer-Encoding", "Upgrade", "User-Agent", "Via",
+          "X-Forwarded-For", "X-Requested-With"):
+    header_environ_key(_)
+    header_environ_key(_.lower())
+    header_environ_key(_.upper())
+
+
+# The response headers send_headers() may add or change, by lower-case name.
+# The names in an application's response headers are looked up in
+# response_header_names, which maps them to one of these, or to "" for any
+# other header. Like header_environ_keys, it learns new spellings up to a
+# limit.
+known_response_headers = frozenset(["connection", "content-encoding",
+    "content-length", "content-type", "date", "etag", "server",
+    "transfer-encoding", "vary"])
+response_header_names = {}
+response_header_names_max = 1000
+
+def response_header_name(name):
+    """Return the lower-case name of a header send_headers() may add or
+    change, or ""."""
+    try:
+        return response_header_names[name]
+    except KeyError:
+        pass
+    lower = name.lower()
+    if lower not in known_response_headers:
+        lower = ""
+    if len(response_header_names) < response_header_names_max:
+        response_header_names[name] = lower
+    return lower
+
+for _ in ("Cache-Control", "Connection", "Content-Encoding", "Content-Length",
+          "Content-Type", "Date", "ETag", "Expires", "Last-Modified",
+          "Location", "Server", "Set-Cookie", "Transfer-Encoding", "Vary"):
+    response_header_name(_)
+    response_header_name(_.lower())
+
+# The content coding we use for each Accept-Encoding request header, gzip or
+# deflate, or None for none. Clients send the same few values over and over.
+accept_encoding_codings = {}
+accept_encoding_codings_max = 1000
+
+def preferred_coding(accept_encoding):
+    """Return the content coding to compress a response in for a client that
+    sent accept_encoding, or None."""
+    try:
+        return accept_encoding_codings[accept_encoding]
+    except KeyError:
+        pass
+    qvalues = {}
+    for coding in accept_encoding.split(","):
+        coding, sep, params = coding.partition(";")
+        q = 1.0
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qvalues[coding.strip().lower()] = q
+    chosen, best = None, 0.0
+    for coding in ("gzip", "deflate"):
+        q = qvalues.get(coding, qvalues.get("*", 0.0))
+        if q > best:
+            chosen, best = coding, q
+    if len(accept_encoding_codings) < accept_encoding_codings_max:
+        accept_encoding_codings[accept_encoding] = chosen
+    return chosen
+
+
+def coded_etag(etag, coding):
+    """Return the entity tag of the response with ETag etag compressed with
+    coding. See strip_etag_coding()."""
+    if etag.endswith('"'):
+        return '%s;%s"' % (etag[:-1], coding)
+    return "%s;%s" % (etag, coding)
+
+# A coding coded_etag() has added to an entity tag in a list of them.
+# Semicolons are rare in the entity tags applications make up, unlike the
+# dashes they join the parts of them with.
+etag_coding_re = re.compile(r';(?:gzip|deflate)(?="?\s*(?:,|$))')
+
+def strip_etag_coding(value):
+    """Return value, an If-None-Match or If-Match header, with the codings
+    coded_etag() added taken off its entity tags."""
+    return etag_coding_re.sub("", value)
+
+
+class CompressionCache(object):
+    """A least recently used cache of compressed response bodies.
+    
+    HTTPRequest keeps the compressed body of each response that has an ETag,
+    and serves it from here when the same version of the resource is asked
+    for again, without calling on the application to produce it. Entries
+    are keyed by host, path, query string, ETag and content coding. The cache holds at most
+    max_bytes of bodies, none larger than max_entry_size.
+    """
+    
+    def __init__(self, max_bytes=16777216, max_entry_size=1048576):
+        self.max_bytes = max_bytes
+        self.max_entry_size = max_entry_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        body = self.entries.pop(key, None)
+        if body is None:
+            self.misses += 1
+            return None
+        # Move it to the most recently used end
+        self.entries[key] = body
+        self.hits += 1
+        return body
+    
+    def put(self, key, body):
+        if len(body) > self.max_entry_size:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = body
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            key, old = self.entries.popitem(last=False)
+            self.size -= len(old)
+    
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+class ResponseCache(object):
+    """A cache of complete responses, put in front of the application by
+    setting Server.response_cache.
+
+    The response to a GET request that a shared cache may keep is kept
+    serialized, status line, headers and body, and written out as it is to
+    answer GET and HEAD requests for the same resource until it expires,
+    without calling the application. Only the Date, Age and Connection
+    headers are added for each request. A response is kept for its
+    Cache-Control s-maxage or max-age, or until its Expires date, or for
+    default_ttl seconds if it has none of those and default_ttl isn't None.
+    Responses marked no-store, no-cache or private, that set a cookie or that
+    vary on everything are not kept, nor are those to requests that carry
+    credentials. Responses are compressed, if HTTPRequest.compression is
+    set, before they are kept.
+
+    Resources are keyed by Host, path and query string. A resource has a
+    response for each set of values of the request headers its Vary header
+    names.
+
+    While the response for a resource is being produced, other requests for
+    it wait for it rather than call the application too, so a popular
+    resource that expires is only produced once. If it turns out not to be
+    cacheable, requests for the resource go straight to the application for
+    the next uncacheable_ttl seconds.
+
+    The cache holds at most max_bytes of responses, none with a body larger
+    than max_entry_size, the least recently used resources being dropped
+    first.
+    """
+
+    cacheable_statuses = frozenset(["200", "203", "300", "301", "404", "410"])
+    uncacheable_ttl = 10
+
+    # Headers we add to each response as it is sent, or set ourselves
+    per_request_headers = frozenset(["age", "connection", "content-length",
+                                     "date", "keep-alive", "transfer-encoding"])
+
+    def __init__(self, max_bytes=67108864, max_entry_size=1048576,
+                 default_ttl=None):
+        self.max_bytes = max_bytes
+        self.max_entry_size = max_entry_size
+        self.default_ttl = default_ttl
+        # Maps (host, path, query) to a _cached_resource, least recently
+        # used first
+        self.resources = OrderedDict()
+        self.size = 0
+        # Maps the key of each response being produced to the channels of
+        # the requests waiting for it
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def respond(self, req):
+        """Answer req, from the cache if we can. Returns False, having done
+        nothing, if req is one we leave to the application."""
+        environ = req.environ
+        method = environ["REQUEST_METHOD"]
+        if method not in ("GET", "HEAD") or "HTTP_AUTHORIZATION" in environ:
+            return False
+        key = (environ.get("HTTP_HOST", ""),
+               environ.get("SCRIPT_NAME", "") + environ.get("PATH_INFO", ""),
+               environ.get("QUERY_STRING", ""))
+        while True:
+            now = time.time()
+            values = None
+            resource = self.resources.pop(key, None)
+            if resource is not None:
+                # Move it to the most recently used end
+                self.resources[key] = resource
+                if resource.names is None:
+                    if now < resource.expires:
+                        return False
+                    self.remove(key)
+                else:
+                    values = tuple([environ.get(name) for name in resource.names])
+                    response = resource.responses.get(values)
+                    if response is not None:
+                        if now < response.expires:
+                            self.hits += 1
+                            self.send(req, response, int(now - response.stored))
+                            return True
+                        self.remove(key, values)
+            if method == "HEAD":
+                # We only keep responses to GET
+                self.misses += 1
+                return False
+            waiting = self.pending.get((key, values))
+            if waiting is None:
+                break
+            self.coalesced += 1
+            ch = stackless.channel()
+            waiting.append(ch)
+            if not ch.receive():
+                # It wasn't cacheable, or the application failed
+                return False
+
+        self.misses += 1
+        waiting = self.pending[key, values] = []
+        kept = False
+        try:
+            kept = self.produce(req, key)
+        finally:
+            del self.pending[key, values]
+            for ch in waiting:
+                if ch.balance < 0:
+                    ch.send(kept)
+        return True
+
+    def produce(self, req, key):
+        """Have the application answer req and keep the response if we can.
+        Returns True if it was kept."""
+        response = req.wsgi_app(req.environ, req.start_response)
+        body = []
+        size = 0
+        chunks = None
+        try:
+            if (not req.started_response
+                    and not isinstance(response, FileWrapper)):
+                # A generator, or middleware wrapping one, only calls
+                # start_response once it is iterated, so we need its first
+                # chunk to tell whether the response may be kept
+                chunks = iter(response)
+                for chunk in chunks:
+                    body.append(chunk)
+                    size += len(chunk)
+                    break
+            ttl = None
+            if (req.started_response and not req.sent_headers
+                    and not isinstance(response, FileWrapper)):
+                ttl = self.time_to_live(req.status, req.outheaders)
+            if ttl is None:
+                self.uncacheable(key)
+                if chunks is None:
+                    # write_response closes it
+                    unread, response = response, None
+                    req.write_response(unread)
+                else:
+                    req.write_response(chain(body, chunks))
+                return False
+
+            if chunks is None:
+                chunks = iter(response)
+            for chunk in chunks:
+                body.append(chunk)
+                size += len(chunk)
+                if size > self.max_entry_size or req.sent_headers:
+                    # Too large to be kept, or the application has begun
+                    # writing it out itself
+                    self.uncacheable(key)
+                    req.write_response(chain(body, chunks))
+                    return False
+        finally:
+            if hasattr(response, "close"):
+                response.close()
+        body = "".join(body)
+
+        headers = req.outheaders
+        for i, (k, v) in enumerate(headers):
+            if k.lower() == "content-length":
+                headers[i] = (k, str(len(body)))
+                break
+        else:
+            headers.append(("Content-Length", str(len(body))))
+        if req.compression and req.start_compression():
+            if req.cached_body is not None:
+                body = req.cached_body
+            else:
+                body = req.compressor.compress(body) + req.compressor.flush()
+                req.compressor = None
+                req.compressed = None
+
+        names = ()
+        for k, v in headers:
+            if k.lower() == "vary":
+                names += tuple(["HTTP_" + name.strip().upper().replace("-", "_")
+                                for name in v.split(",") if name.strip()])
+        cached = _cached_response(req, body, ttl)
+        self.keep(key, tuple(sorted(set(names))), cached, req.environ)
+        self.send(req, cached, None)
+        return True
+
+    def time_to_live(self, status, headers):
+        """Return how many seconds a response with status and headers may be
+        kept for, or None if it may not be kept."""
+        if status[:3] not in self.cacheable_statuses:
+            return None
+        max_age = shared_max_age = expires = date = None
+        for k, v in headers:
+            name = k.lower()
+            if name == "cache-control":
+                for directive in v.split(","):
+                    directive, equals, value = directive.partition("=")
+                    directive = directive.strip().lower()
+                    if directive in ("no-store", "no-cache", "private"):
+                        return None
+                    if directive in ("max-age", "s-maxage"):
+                        try:
+                            seconds = int(value.strip().strip('"'))
+                        except ValueError:
+                            return None
+                        if directive == "max-age":
+                            max_age = seconds
+                        else:
+                            shared_max_age = seconds
+            elif name == "set-cookie":
+                return None
+            elif name == "vary":
+                if v.strip() == "*":
+                    return None
+            elif name == "expires":
+                # An invalid date means it has already expired
+                expires = http_date_seconds(v) or 0
+            elif name == "date":
+                date = http_date_seconds(v)
+        if shared_max_age is not None:
+            ttl = shared_max_age
+        elif max_age is not None:
+            ttl = max_age
+        elif expires is not None:
+            ttl = expires - (date or time.time())
+        else:
+            ttl = self.default_ttl
+        if ttl is None or ttl <= 0:
+            return None
+        return ttl
+
+    def send(self, req, cached, age):
+        """Write out the cached response to req, as age seconds old, or as
+        new if age is None."""
+        req.status = cached.status
+        req.sent_headers = True
+        if req.continue_pending:
+            # The client may yet send a body we haven't asked for
+            req.close_connection = True
+        buf = [cached.head, "Date: ", hub.date, "\r\n"]
+        if age is not None:
+            buf.append("Age: %d\r\n" % age)
+        if req.response_protocol == 'HTTP/1.1':
+            if req.close_connection:
+                buf.append("Connection: close\r\n")
+        elif not req.close_connection:
+            buf.append("Connection: Keep-Alive\r\n")
+        buf.append("\r\n")
+        head = "".join(buf)
+        if req.environ["REQUEST_METHOD"] == "HEAD" or not cached.body:
+            req.output(head, len(head))
+        else:
+            # The body is queued as it is, not copied
+            req.output([head, cached.body], len(head) + len(cached.body))
+        req.flush()
+
+    def keep(self, key, names, cached, environ):
+        """Keep the cached response to a request with environ for the
+        resource key, whose responses vary on the environ entries names."""
+        if len(cached.body) > self.max_entry_size:
+            return
+        resource = self.resources.pop(key, None)
+        if resource is not None and resource.names != names:
+            # The resource has changed what it varies on
+            self.size -= resource.size
+            resource = None
+        if resource is None:
+            resource = _cached_resource(names)
+        self.resources[key] = resource
+        values = tuple([environ.get(name) for name in names])
+        old = resource.responses.get(values)
+        if old is not None:
+            resource.size -= old.size
+            self.size -= old.size
+        resource.responses[values] = cached
+        resource.size += cached.size
+        self.size += cached.size
+        while self.size > self.max_bytes and self.resources:
+            key, old = self.resources.popitem(last=False)
+            self.size -= old.size
+
+    def uncacheable(self, key):
+        """Have requests for the resource key skip the cache for a while."""
+        self.remove(key)
+        resource = _cached_resource(None)
+        resource.expires = time.time() + self.uncacheable_ttl
+        self.resources[key] = resource
+
+    def remove(self, key, values=None):
+        """Drop the response for the given values of the resource key, or
+        the whole resource if values is None."""
+        resource = self.resources.get(key)
+        if resource is None:
+            return
+        if values is None:
+            del self.resources[key]
+            self.size -= resource.size
+            return
+        old = resource.responses.pop(values, None)
+        if old is not None:
+            resource.size -= old.size
+            self.size -= old.size
+
+    def clear(self):
+        self.resources.clear()
+        self.size = 0
+
+
+class _cached_resource(object):
+    """The responses ResponseCache keeps for one resource, by the values of
+    the environ entries names. A resource with names None is one we don't
+    cache until expires."""
+
+    def __init__(self, names):
+        self.names = names
+        self.responses = {}
+        self.size = 0
+        self.expires = 0
+
+
+class _cached_response(object):
+    """A response ResponseCache keeps: its status, its status line and
+    headers as they are sent, less the ones we add for each request, and
+    its body."""
+
+    def __init__(self, req, body, ttl):
+        self.status = req.status
+        self.body = body
+        self.stored = time.time()
+        self.expires = self.stored + ttl
+        buf = [status_line(req.environ['ACTUAL_SERVER_PROTOCOL'], req.status)]
+        server = False
+        skip = ResponseCache.per_request_headers
+        for k, v in req.outheaders:
+            name = k.lower()
+            if name == "server":
+                server = True
+            elif name in skip:
+                continue
+            buf.append(k + ": " + v + "\r\n")
+        buf.append("Content-Length: %d\r\n" % len(body))
+        if not server:
+            buf.append("Server: " + req.environ['SERVER_SOFTWARE'] + "\r\n")
+        self.head = "".join(buf)
+        self.size = len(self.head) + len(body)
+
+
+# Status lines, by protocol and status. Applications give one of a handful of
+# statuses, so each line is built once and then reused.
+status_lines = {}
+status_lines_max = 1000
+
+def status_line(protocol, status):
+    """Return the status line for status, including the line break."""
+    try:
+        return status_lines[protocol, status]
+    except KeyError:
+        pass
+    line = "%s %s\r\n" % (protocol, status)
+    if len(status_lines) < status_lines_max:
+        status_lines[protocol, status] = line
+    return line
+
+for _ in ("200 OK", "201 Created", "204 No Content", "206 Partial Content",
+          "301 Moved Permanently", "302 Found", "303 See Other",
+          "304 Not Modified", "400 Bad Request", "401 Unauthorized",
+          "403 Forbidden", "404 Not Found", "500 Internal Server Error",
+          "503 Service Unavailable"):
+    status_line("HTTP/1.1", _)
+
+
+class FileWrapper(object):
+    """The wsgi.file_wrapper given to applications.
+    
+    When an application returns one of these around a regular file,
+    HTTPRequest.respond sends the file with sendfile(), or from an mmap of it
+    when the response is chunked or sendfile() is not available. Any other
+    file-like object is simply iterated over in blocks of blksize bytes.
+    """
+    
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, "close"):
+            self.close = filelike.close
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
+
+
+class StaticFiles(object):
+    """A WSGI application that serves the files under root.
+    
+    Files of up to max_entry_size bytes are kept in memory, at most max_bytes
+    of them, and larger ones are kept open and mapped, at most max_files
+    files in all, the least recently used being dropped first. Each file's
+    headers, ETag included, are worked out when it is loaded. A file is only
+    looked at again, with a stat(), when it is asked for more than
+    revalidate seconds after it last was, and reloaded if it has changed.
+    Otherwise requests for it don't touch the disk, be they plain,
+    conditional or for a range of bytes.
+    
+    A directory is served by its index_file, if it has one. Requests for
+    anything else that isn't there are passed to fallback if given, or
+    answered with a 404. With max_age, responses say they may be cached for
+    that many seconds.
+    """
+    
+    index_file = "index.html"
+    default_type = "application/octet-stream"
+    
+    def __init__(self, root, fallback=None, max_age=None, revalidate=1,
+                 max_bytes=16777216, max_entry_size=262144, max_files=1024):
+        self.root = os.path.abspath(root)
+        # What files must resolve to be under, symbolic links followed
+        self.real_root = os.path.join(os.path.realpath(root), "")
+        self.fallback = fallback
+        self.max_age = max_age
+        self.revalidate = revalidate
+        self.max_bytes = max_bytes
+        self.max_entry_size = max_entry_size
+        self.max_files = max_files
+        # Maps PATH_INFO to a _static_file, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def __call__(self, environ, start_response):
+        path_info = environ.get("PATH_INFO", "")
+        entry = self.lookup(path_info)
+        if entry is None:
+            path = self.filename(path_info)
+            if (path is not None and not path_info.endswith("/")
+                    and os.path.isdir(path)):
+                # Relative links in the index only work from under it
+                location = environ.get("SCRIPT_NAME", "") + path_info + "/"
+                if environ.get("QUERY_STRING"):
+                    location += "?" + environ["QUERY_STRING"]
+                start_response("301 Moved Permanently", [
+                    ("Location", location), ("Content-Length", "0")])
+                return []
+            if self.fallback is not None:
+                return self.fallback(environ, start_response)
+            return self._error(start_response, "404 Not Found")
+        
+        method = environ["REQUEST_METHOD"]
+        if method not in ("GET", "HEAD"):
+            start_response("405 Method Not Allowed", [
+                ("Allow", "GET, HEAD"), ("Content-Length", "0")])
+            return []
+        
+        if entry.not_modified(environ):
+            start_response("304 Not Modified", entry.validators)
+            return []
+        
+        size = entry.size
+        start, end = 0, size
+        status = "200 OK"
+        headers = list(entry.headers)
+        if (method == "GET" and "HTTP_RANGE" in environ
+                and entry.range_applies(environ)):
+            byte_range = parse_byte_range(environ["HTTP_RANGE"], size)
+            if byte_range is False:
+                start_response("416 Requested Range Not Satisfiable", [
+                    ("Content-Range", "bytes */%d" % size),
+                    ("Content-Length", "0")])
+                return []
+            if byte_range is not None:
+                start, end = byte_range
+                status = "206 Partial Content"
+                headers.append(("Content-Range",
+                                "bytes %d-%d/%d" % (start, end - 1, size)))
+        headers.append(("Content-Length", str(end - start)))
+        start_response(status, headers)
+        
+        if method == "HEAD" or start == end:
+            return []
+        if entry.body is not None:
+            if end - start == size:
+                return [entry.body]
+            return [entry.body[start:end]]
+        file_wrapper = environ.get("wsgi.file_wrapper", FileWrapper)
+        return file_wrapper(_mapped_file(entry, start, end))
+    
+    def _error(self, start_response, status):
+        body = status[4:]
+        start_response(status, [("Content-Type", "text/plain"),
+                                ("Content-Length", str(len(body)))])
+        return [body]
+    
+    def filename(self, path_info):
+        """Return the path under root that path_info names, or None if it
+        tries to leave root, with .. or by way of a symbolic link."""
+        parts = []
+        for part in path_info.split("/"):
+            if part in ("", "."):
+                continue
+            if part == ".." or "\0" in part or (os.altsep and os.altsep in part):
+                return None
+            parts.append(part)
+        path = os.path.join(self.root, *parts)
+        if not self.under_root(path):
+            return None
+        return path
+    
+    def under_root(self, path):
+        """Return True if path resolves to root or a file under it."""
+        return os.path.join(os.path.realpath(path), "").startswith(self.real_root)
+    
+    def lookup(self, path_info):
+        """Return the _static_file for path_info, or None if there is no
+        such file."""
+        entries = self.entries
+        entry = entries.pop(path_info, None)
+        if entry is not None:
+            self.size -= entry.memory
+            now = time.time()
+            if now - entry.checked < self.revalidate:
+                self.hits += 1
+                return self._keep(path_info, entry)
+            try:
+                st = os.stat(entry.path)
+            except OSError:
+                st = None
+            if st is not None and entry.identity == _file_identity(st):
+                entry.checked = now
+                self.hits += 1
+                return self._keep(path_info, entry)
+            entry.close()
+        
+        self.misses += 1
+        path = self.filename(path_info)
+        if path is None:
+            return None
+        try:
+            if os.path.isdir(path):
+                if not path_info.endswith("/"):
+                    return None
+                path = os.path.join(path, self.index_file)
+                if not self.under_root(path):
+                    return None
+            elif path_info.endswith("/"):
+                # Only a directory is named with a trailing slash
+                return None
+            f = open(path, "rb")
+        except (IOError, OSError):
+            return None
+        try:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                return None
+            content_type = mimetypes.guess_type(path)[0] or self.default_type
+            entry = _static_file(path, st, content_type, self.max_age)
+            if st.st_size <= self.max_entry_size:
+                entry.body = f.read(st.st_size)
+                entry.memory = len(entry.body)
+            else:
+                entry.file = f
+                entry.mapped = mmap.mmap(f.fileno(), st.st_size,
+                                         access=mmap.ACCESS_READ)
+                f = None
+        finally:
+            if f is not None:
+                f.close()
+        return self._keep(path_info, entry)
+    
+    def _keep(self, path_info, entry):
+        entries = self.entries
+        entries[path_info] = entry
+        self.size += entry.memory
+        while self.size > self.max_bytes or len(entries) > self.max_files:
+            path_info, old = entries.popitem(last=False)
+            self.size -= old.memory
+            if old is not entry:
+                old.close()
+        return entry
+    
+    def clear(self):
+        for entry in self.entries.itervalues():
+            entry.close()
+        self.entries.clear()
+        self.size = 0
+
+
+def _file_identity(st):
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+class _static_file(object):
+    """A file StaticFiles serves, with the headers of a response for it. A
+    small file's contents are in body, a large one's in the open file and a
+    map of it."""
+    
+    def __init__(self, path, st, content_type, max_age):
+        self.path = path
+        self.identity = _file_identity(st)
+        self.checked = time.time()
+        self.size = st.st_size
+        self.mtime = int(st.st_mtime)
+        self.etag = '"%x-%x"' % (int(st.st_mtime * 1000000), st.st_size)
+        self.last_modified = rfc822.formatdate(st.st_mtime)
+        # The headers of a 304, and of a full response less its length
+        self.validators = [("ETag", self.etag),
+                           ("Last-Modified", self.last_modified)]
+        if max_age is not None:
+            self.validators.append(("Cache-Control", "max-age=%d" % max_age))
+        self.headers = [("Content-Type", content_type),
+                        ("Accept-Ranges", "bytes")] + self.validators
+        self.body = None
+        self.file = None
+        self.mapped = None
+        # What body costs us
+        self.memory = 0
+        # How many responses are sending the open file, and whether it is
+        # to be closed once they are done
+        self.users = 0
+        self.dropped = False
+    
+    def close(self):
+        """Close the file and its map once no response is sending them,
+        when StaticFiles drops the entry."""
+        self.dropped = True
+        if self.users or self.file is None:
+            return
+        self.mapped.close()
+        self.file.close()
+        self.mapped = self.file = None
     
-    def handle_write(self):
-        # This is called by asyncore when it is ready to send out data.
-        # First see if we have some data to send...
-        if len(self.send_buffer):
-            sent = asyncore.dispatcher.send(self, self.send_buffer[:512])
-            self.send_buffer = self.send_buffer[sent:]
+    def not_modified(self, environ):
+        """Return True if the request is conditional on the file having
+        changed since the client's copy, and it hasn't."""
+        if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+        if if_none_match is not None:
+            # If-Modified-Since is ignored when If-None-Match is given
+            for tag in if_none_match.split(","):
+                tag = tag.strip()
+                if tag.startswith("W/"):
+                    # Weak comparison will do for a GET
+                    tag = tag[2:]
+                if tag == "*" or tag == self.etag:
+                    return True
+            return False
+        if_modified_since = environ.get("HTTP_IF_MODIFIED_SINCE")
+        if if_modified_since is not None:
+            since = http_date_seconds(if_modified_since)
+            return since is not None and self.mtime <= since
+        return False
+    
+    def range_applies(self, environ):
+        """Return False if the request's If-Range says the client's copy is
+        not the current one, in which case the whole file is sent."""
+        if_range = environ.get("HTTP_IF_RANGE")
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            # Weak tags never match here
+            return if_range == self.etag
+        return http_date_seconds(if_range) == self.mtime
 
-            # If we completed sending everything in self.send_buffer and a call to
-            # sendall is waiting in another tasklet, let it know so it can resume.
-            if len(self.send_buffer) == 0 and self.sendall_channel and self.sendall_channel.balance < 0:
-                self.sendall_channel.send(None)
 
-    def recv(self, byte_count):
-        # A call to this method will suspend the current tasklet until there is
-        # data available to be received. See handle_read on how that happens.
-        if byte_count > 0 and len(self.recv_buffer) == 0 or self.recv_channel.balance > 0:
-            self.recv_buffer += self.recv_channel.receive()
-        
-        # Give the caller only as much as he asked for
-        ret = self.recv_buffer[:byte_count]
-        
-        # and stash the rest in self.recv_buffer
-        self.recv_buffer = self.recv_buffer[byte_count:]
-        
-        return ret
+class _mapped_file(object):
+    """The part of a large file StaticFiles holds open from start to end,
+    as a file-like object for wsgi.file_wrapper. The server sends it from
+    the open file, other readers get it from the map."""
+    
+    def __init__(self, entry, start, end):
+        self.entry = entry
+        self.pos = start
+        self.end = end
+        entry.users += 1
     
-    def handle_read(self):
-        # This is called by asyncore to let us know that there is data available
-        # to be received.
-        try:
-            ret = asyncore.dispatcher.recv(self, 20000)
-            if not ret:
-                # This means the other end closed the connection, close our end.
-                self.close()
-            # Send the data to whoever is or will be calling recv()
-            self.recv_channel.send(ret)
-        except socket.error, err:
-            if self.send_buffer:
-                self.send_buffer = ""
-            # Any errors on the socket is propogated to the callers of recv()
-            self.recv_channel.send_exception(stdsocket.error, err)
-
     def close(self):
-        asyncore.dispatcher.close(self)
-        self.connected = False
-        self.accepting = False
-        self.send_buffer = None
-        
-        # Wake any tasklets that are waiting for sendall() to return
-        if self.sendall_channel and self.sendall_channel.balance < 0:
-            self.sendall_channel.send(None)
-        
-        # Wake any tasklets that are waiting for recv to return
-        while self.recv_channel and self.recv_channel.balance < 0:
-            self.recv_channel.send("")
+        entry = self.entry
+        if entry is None:
+            return
+        self.entry = None
+        entry.users -= 1
+        if entry.dropped:
+            entry.close()
     
-    def handle_close(self):
-        pass
+    def fileno(self):
+        return self.entry.file.fileno()
+    
+    def tell(self):
+        return self.pos
+    
+    def read(self, size=-1):
+        end = self.end
+        if size >= 0:
+            end = min(end, self.pos + size)
+        data = self.entry.mapped[self.pos:end]
+        self.pos = end
+        return data
 
-    def handle_expt(self):
-        self.close()
 
+def http_date_seconds(value):
+    """Return the time an HTTP date stands for in seconds since the epoch,
+    or None if it isn't one."""
+    parsed = rfc822.parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return rfc822.mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
 
-class sock_channel_rfile(object):
-    """This class provides a read-only file-like object on top of sock_channel.
-    It is used by the HTTPRequest class to get data from the connection and
-    allow WSGI apps to read the request body."""
+
+def parse_byte_range(value, size):
+    """Return the (start, end) offsets of the byte range a Range header asks
+    for in a resource of size bytes, end being exclusive. Returns None if it
+    isn't a single byte range, which we answer with the whole resource, or
+    False if the range lies beyond the end."""
+    units, equals, spec = value.partition("=")
+    if not equals or units.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    first = first.strip()
+    last = last.strip()
+    if not dash or not (first or last):
+        return None
+    if (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+    if not first:
+        # The last so many bytes
+        count = int(last)
+        if not count:
+            return False
+        start, end = max(size - count, 0), size
+    else:
+        start = int(first)
+        end = size
+        if last:
+            if int(last) < start:
+                return None
+            end = min(int(last) + 1, size)
+    if start >= size:
+        return False
+    return start, end
+
+
+class MaxSizeExceeded(Exception):
+    """Raised when a request body is larger than HTTPRequest.max_body_size."""
+    pass
+
+
+class ChunkedRFile(object):
+    """The wsgi.input for a request body sent with the chunked transfer-coding.
     
-    def __init__(self, sock_chan):
-        self.sock_chan = sock_chan
-        self.buffer = ""
+    The body is decoded as the application reads it, so that it can start on
+    the first chunk while the rest are still on their way and we never hold
+    more than the application asks for. MaxSizeExceeded is raised when the
+    body grows beyond maxlen bytes, and ValueError when it is malformed.
+    read_trailers is called to read the trailer headers after the last chunk.
+    """
+    
+    def __init__(self, rfile, maxlen=None, read_trailers=None, max_line=65536):
+        self.rfile = rfile
+        self.maxlen = maxlen
+        self.read_trailers = read_trailers
+        self.max_line = max_line
+        self.bytes_read = 0
+        # What is left of the chunk we are in
+        self.chunk_left = 0
+        self.done = False
+    
+    def _remaining(self):
+        """Return the number of bytes left in the current chunk, starting on
+        the next one if need be. Returns 0 at the end of the body."""
+        if self.chunk_left or self.done:
+            return self.chunk_left
+        line = self.rfile.readline(self.max_line)
+        if not line.endswith("\n"):
+            raise ValueError("Bad chunked transfer coding (bad chunk size line)")
+        try:
+            size = int(line.split(";", 1)[0].strip(), 16)
+        except ValueError:
+            raise ValueError("Bad chunked transfer coding (bad chunk size %r)"
+                             % line.strip())
+        if size < 0:
+            raise ValueError("Bad chunked transfer coding (bad chunk size %r)"
+                             % line.strip())
+        if size == 0:
+            self.done = True
+            if self.read_trailers is not None:
+                self.read_trailers()
+            else:
+                while self.rfile.readline(self.max_line) not in ("\r\n", "\n", ""):
+                    pass
+            return 0
+        if self.maxlen is not None and self.bytes_read + size > self.maxlen:
+            raise MaxSizeExceeded()
+        self.chunk_left = size
+        return size
+    
+    def _consumed(self, data):
+        """Account for data having been read from the current chunk."""
+        if not data:
+            raise ValueError("Request body ended in the middle of a chunk")
+        self.chunk_left -= len(data)
+        self.bytes_read += len(data)
+        if not self.chunk_left:
+            crlf = self.rfile.read(2)
+            if crlf != "\r\n":
+                raise ValueError("Bad chunked transfer coding "
+                                 "(expected '\\r\\n', got %r)" % crlf)
+        return data
     
     def read(self, size=-1):
-        if size == -1:
-            data = self.sock_chan.recv(512)
-            while len(data):
-                self.buffer += data
-                data = self.sock_chan.recv(512)
-            data = self.buffer
-            self.buffer = ""
-            return data
-        else:
-            data = self.sock_chan.recv(size)
-            retval = self.buffer + data
-            self.buffer = ""
-            return retval
-    
-    def readline(self):
-        idx = self.buffer.find("\n")
-        if idx > -1:
-            line = self.buffer[:idx+1]
-            self.buffer = self.buffer[idx+1:]
-            return line
-        
-        while "\n" not in self.buffer:
-            chunk = self.read(512)
-            if chunk == "":
+        data = []
+        while size:
+            left = self._remaining()
+            if not left:
                 break
-            self.buffer += chunk
-        
-        if self.buffer == "":
-            return ""
-        
-        idx = self.buffer.find("\n")
-        if idx > -1:
-            line = self.buffer[:idx+1]
-            self.buffer = self.buffer[idx+1:]
-            return line
-        else:
-            line = self.buffer
-            self.buffer = ""
-            return line
+            if size > 0:
+                left = min(left, size)
+            piece = self._consumed(self.rfile.read(left))
+            data.append(piece)
+            if size > 0:
+                size -= len(piece)
+        return "".join(data)
+    
+    def readline(self, size=-1):
+        line = []
+        while size:
+            left = self._remaining()
+            if not left:
+                break
+            if size > 0:
+                left = min(left, size)
+            piece = self._consumed(self.rfile.readline(left))
+            line.append(piece)
+            if piece.endswith("\n"):
+                break
+            if size > 0:
+                size -= len(piece)
+        return "".join(line)
     
     def readlines(self, hint=None):
         lines = []
@@ -356,34 +3594,48 @@ class sock_channel_rfile(object):
             raise StopIteration
     
     def close(self):
-        self.sock_chan = None
-        self.buffer = ""
-
-
-# The rest of this file is taken from CherryPy's excellent WSGI Server by Robert
-# Brewer. CherryPy is distributed under the BSD license.
-# See http://www.cherrypy.org for more information. I have only removed parts
-# relevant to SSL support and added one call to stackless.schedule.
-# Otherwise, this code is:
-#
-# Copyright (c) 2004, CherryPy Team (team@cherrypy.org)
-# All rights reserved.
-
-quoted_slash = re.compile("(?i)%2F")
+        pass
 
-import errno
-socket_errors_to_ignore = set(_ for _ in ("EPIPE", "ETIMEDOUT", "ECONNREFUSED", "ECONNRESET",
-          "EHOSTDOWN", "EHOSTUNREACH",
-          "WSAECONNABORTED", "WSAECONNREFUSED", "WSAECONNRESET",
-          "WSAENETRESET", "WSAETIMEDOUT") if _ in dir(errno))
-socket_errors_to_ignore.add("timed out")
 
-comma_separated_headers = set(['ACCEPT', 'ACCEPT-CHARSET', 'ACCEPT-ENCODING',
-    'ACCEPT-LANGUAGE', 'ACCEPT-RANGES', 'ALLOW', 'CACHE-CONTROL',
-    'CONNECTION', 'CONTENT-ENCODING', 'CONTENT-LANGUAGE', 'EXPECT',
-    'IF-MATCH', 'IF-NONE-MATCH', 'PRAGMA', 'PROXY-AUTHENTICATE', 'TE',
-    'TRAILER', 'TRANSFER-ENCODING', 'UPGRADE', 'VARY', 'VIA', 'WARNING',
-    'WWW-AUTHENTICATE'])
+class ContinueRFile(object):
+    """The wsgi.input for a request whose client waits for "100 Continue"
+    before it sends the body. send_continue is called when the application
+    first reads from it, after which reads go straight to rfile."""
+    
+    def __init__(self, rfile, send_continue):
+        self.rfile = rfile
+        self.send_continue = send_continue
+    
+    def _continue(self):
+        self.read = self.rfile.read
+        self.readline = self.rfile.readline
+        self.readlines = self.rfile.readlines
+        self.send_continue()
+    
+    def read(self, size=-1):
+        self._continue()
+        return self.read(size)
+    
+    def readline(self, size=-1):
+        self._continue()
+        return self.readline(size)
+    
+    def readlines(self, hint=None):
+        self._continue()
+        return self.readlines(hint)
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        line = self.readline()
+        if line:
+            return line
+        else:
+            raise StopIteration
+    
+    def close(self):
+        self.rfile.close()
 
 
 class HTTPRequest(object):
@@ -419,11 +3671,76 @@ class HTTPRequest(object):
     chunked_write: if True, output will be encoded with the "chunked"
         transfer-coding. This value is set automatically inside
         send_headers.
+    file_chunk_size: the size of the pieces a file returned through
+        wsgi.file_wrapper is written in when it can't use sendfile.
+    send: a function that queues data for sending without waiting for it
+        to be written, or None. Without it, output is not coalesced.
+    output_buffer_size, output_buffer_time: see output().
+    compression: if True, responses of the compressible_types are
+        compressed with gzip or deflate for clients that accept it, see
+        start_compression(). compression_level is the zlib level used.
+        Responses known to be shorter than compress_min_size bytes are
+        sent as they are. Compressed bodies of responses with an ETag are
+        kept in compression_cache, unless it is None.
+    response_cache: a ResponseCache that requests are answered from, if
+        they can be, before the application is called, or None.
+    max_header_size, max_headers: limits on the request line and headers.
+    max_body_size: the largest request body we accept, or None.
+    discard_body_size: see discard_body().
+    spool_chunked: if True, a chunked request body is read into a temporary
+        file before the application is called, rather than decoded as it
+        reads wsgi.input. It is kept in memory up to spool_memory_size bytes.
     """
     
-    def __init__(self, sendall, environ, wsgi_app):
+    file_chunk_size = 65536
+    
+    # Limits on the size of the request line and headers, and on the number
+    # of header lines. Requests exceeding them are answered with a 431.
+    max_header_size = 65536
+    max_headers = 100
+    
+    # Requests with a larger body are answered with a 413. For a chunked
+    # body that is decoded as the application reads it, we only find out
+    # when it reads that far.
+    max_body_size = None
+    
+    # What the application leaves unread of a body with a Content-Length is
+    # thrown away, to get to the next request on the connection, if it is
+    # no more than this many bytes. The connection is closed otherwise.
+    discard_body_size = 65536
+    
+    spool_chunked = False
+    spool_memory_size = 1048576
+    
+    # The headers, the chunked framing and the pieces of the body are queued
+    # together and written in as few system calls as possible. We only wait
+    # for them to be written when output_buffer_size bytes have built up,
+    # when the oldest has been queued for output_buffer_time seconds, when
+    # the application yields an empty string or calls write(), and at the
+    # end of the response. Whatever is queued is also written whenever the
+    # application blocks, e.g. waiting for an event to stream to the client.
+    output_buffer_size = 65536
+    output_buffer_time = 0.05
+    
+    # Compressed output is only sent as the compressor produces it. An
+    # application that streams a compressible type should yield an empty
+    # string to have everything it has produced so far sent.
+    compression = False
+    compression_level = 6
+    compress_min_size = 1024
+    compressible_types = frozenset(["application/javascript",
+        "application/json", "application/xml", "image/svg+xml", "text/css",
+        "text/csv", "text/html", "text/javascript", "text/plain", "text/xml"])
+    compression_cache = CompressionCache()
+    
+    response_cache = None
+    
+    def __init__(self, sendall, environ, wsgi_app, send=None):
         self.rfile = environ['wsgi.input']
         self.sendall = sendall
+        self.send = send
+        self.output_pending = 0
+        self.output_since = 0
         self.environ = environ.copy()
         self.wsgi_app = wsgi_app
         
@@ -434,6 +3751,22 @@ class HTTPRequest(object):
         self.sent_headers = False
         self.close_connection = False
         self.chunked_write = False
+        # The ChunkedRFile the request body is read through, if it is chunked
+        self.chunked_body = None
+        # How much had been read from rfile when the body began
+        self.body_start = 0
+        # Set while the client waits for "100 Continue" to send the body
+        self.continue_pending = False
+        
+        self.compression_decided = False
+        self.compressor = None
+        self.cache_key = None
+        # The compressed body so far, if it is to go in the cache
+        self.compressed = None
+        self.compressed_size = 0
+        self.cached_body = None
+        # The entity tags the client sent back, if we took codings off any
+        self.validator_tags = None
     
     def parse_request(self):
         """Parse the next HTTP request start-line and message-headers."""
@@ -444,29 +3777,58 @@ class HTTPRequest(object):
         # and doesn't need the client to request or acknowledge the close
         # (although your TCP stack might suffer for it: cf Apache's history
         # with FIN_WAIT_2).
-        request_line = self.rfile.readline()
-        if not request_line:
-            # Force self.ready = False so the connection will close.
-            self.ready = False
+        #
+        # Rather than reading line by line, we wait for the whole head of the
+        # request to arrive and then parse it in one go. The extra 2 bytes
+        # allow for a leading CRLF, see below.
+        head = self.rfile.read_until("\r\n\r\n", self.max_header_size + 2)
+        if head is None:
+            self.close_connection = True
+            self.simple_response("431 Request Header Fields Too Large")
             return
         
-        if request_line == "\r\n":
+        if head[:2] == "\r\n":
             # RFC 2616 sec 4.1: "...if the server is reading the protocol
             # stream at the beginning of a message and receives a CRLF
             # first, it should ignore the CRLF."
             # But only ignore one leading line! else we enable a DoS.
-            request_line = self.rfile.readline()
-            if not request_line:
-                self.ready = False
-                return
+            head = head[2:]
+        
+        if not head.endswith("\r\n\r\n"):
+            # The connection was closed before we had the whole head.
+            # Force self.ready = False so the connection will close.
+            self.ready = False
+            return
+        
+        lines = head.split("\r\n")
+        # The head ends with two empty "lines", and starts with the request line
+        if len(lines) - 3 > self.max_headers:
+            self.close_connection = True
+            self.simple_response("431 Request Header Fields Too Large")
+            return
         
         environ = self.environ
         
-        method, path, req_protocol = request_line.strip().split(" ", 2)
+        try:
+            method, path, req_protocol = lines[0].strip().split(" ", 2)
+        except ValueError:
+            self.simple_response("400 Bad Request", "Malformed Request-Line")
+            return
+        if not http_version.match(req_protocol):
+            self.simple_response("400 Bad Request", "Malformed Request-Line")
+            return
         environ["REQUEST_METHOD"] = method
         
-        # path may be an abs_path (including "http://host.domain.tld");
-        scheme, location, path, params, qs, frag = urlparse(path)
+        if path[:1] == "/":
+            # The usual case, an abs_path. We can split it ourselves.
+            scheme = location = ""
+            path, sep, qs = path.partition("?")
+            frag = "#" in path or "#" in qs
+        else:
+            # path may be an abs_path (including "http://host.domain.tld");
+            scheme, location, path, params, qs, frag = urlparse(path)
+            if params:
+                path = path + ";" + params
         
         if frag:
             self.simple_response("400 Bad Request",
@@ -475,8 +3837,6 @@ class HTTPRequest(object):
         
         if scheme:
             environ["wsgi.url_scheme"] = scheme
-        if params:
-            path = path + ";" + params
         
         environ["SCRIPT_NAME"] = ""
         
@@ -486,8 +3846,9 @@ class HTTPRequest(object):
         # But note that "...a URI must be separated into its components
         # before the escaped characters within those components can be
         # safely decoded." http://www.ietf.org/rfc/rfc2396.txt, sec 2.4.2
-        atoms = [unquote(x) for x in quoted_slash.split(path)]
-        path = "%2F".join(atoms)
+        if "%" in path:
+            atoms = [unquote(x) for x in quoted_slash.split(path)]
+            path = "%2F".join(atoms)
         environ["PATH_INFO"] = path
         
         # Note that, like wsgiref and most other WSGI servers,
@@ -522,7 +3883,7 @@ class HTTPRequest(object):
         
         # then all the http headers
         try:
-            self.read_headers()
+            self.parse_headers(lines, 1)
         except ValueError, ex:
             self.simple_response("400 Bad Request", repr(ex.args))
             return
@@ -530,7 +3891,12 @@ class HTTPRequest(object):
         creds = environ.get("HTTP_AUTHORIZATION", "").split(" ", 1)
         environ["AUTH_TYPE"] = creds[0]
         if creds[0].lower() == 'basic':
-            user, pw = base64.decodestring(creds[1]).split(":", 1)
+            try:
+                user, pw = base64.decodestring(creds[-1]).split(":", 1)
+            except (binascii.Error, ValueError):
+                self.simple_response("400 Bad Request",
+                                     "Malformed Authorization Header.")
+                return
             environ["REMOTE_USER"] = user
         
         # Persistent connection support
@@ -551,6 +3917,18 @@ class HTTPRequest(object):
         
         read_chunked = False
         
+        if self.max_body_size is not None:
+            try:
+                cl = int(environ.get("CONTENT_LENGTH") or 0)
+            except ValueError:
+                self.simple_response("400 Bad Request",
+                                     "Malformed Content-Length Header.")
+                return
+            if cl > self.max_body_size:
+                self.simple_response("413 Request Entity Too Large",
+                                     "The request body is too large.")
+                return
+        
         if te:
             for enc in te:
                 if enc == "chunked":
@@ -562,10 +3940,6 @@ class HTTPRequest(object):
                     self.close_connection = True
                     return
         
-        if read_chunked:
-            if not self.decode_chunked():
-                return
-        
         # From PEP 333:
         # "Servers and gateways that implement HTTP 1.1 must provide
         # transparent support for HTTP 1.1's "expect/continue" mechanism.
@@ -581,19 +3955,30 @@ class HTTPRequest(object):
         #      expect/continue, and sends the request body on its own.
         #      (This is suboptimal, and is not recommended.)
         #
-        # We used to do 3, but are now doing 1. Maybe we'll do 2 someday,
-        # but it seems like it would be a big slowdown for such a rare case.
-        if environ.get("HTTP_EXPECT", "") == "100-continue":
-            self.simple_response(100)
+        # We used to do 3, then 1, and now do 2, so that a body the
+        # application turns down without reading it is never sent at all.
+        # The wrapper only costs anything until the first read.
+        if read_chunked:
+            if not self.decode_chunked():
+                return
         
+        if (self.response_protocol == "HTTP/1.1"
+                and environ.get("HTTP_EXPECT", "").lower() == "100-continue"
+                and (read_chunked or environ.get("CONTENT_LENGTH", "0") != "0")):
+            self.continue_pending = True
+            environ["wsgi.input"] = ContinueRFile(environ["wsgi.input"],
+                                                  self.send_continue)
+        
+        self.body_start = self.rfile.bytes_read
         self.ready = True
     
     def read_headers(self):
-        """Read header lines from the incoming stream."""
-        environ = self.environ
-        
+        """Read header lines from the incoming stream. This is only used for
+        the trailers of chunked requests, parse_request reads the headers
+        in one go."""
+        lines = []
         while True:
-            line = self.rfile.readline()
+            line = self.rfile.readline(self.max_header_size)
             if not line:
                 # No more data--illegal end of headers
                 raise ValueError("Illegal end of headers.")
@@ -602,19 +3987,43 @@ class HTTPRequest(object):
                 # Normal end of headers
                 break
             
+            if len(lines) >= self.max_headers:
+                raise ValueError("Too many headers.")
+            lines.append(line.rstrip("\r\n"))
+        lines.append("")
+        self.parse_headers(lines)
+    
+    def parse_headers(self, lines, start=0):
+        """Parse header lines, without their line endings, into the environ.
+        The headers end at the first empty line at or after lines[start]."""
+        environ = self.environ
+        envname = None
+        # This loop runs for every header of every request, so look
+        # these up only once
+        environ_keys = header_environ_keys
+        comma_separated = comma_separated_environ_keys
+        
+        for line in islice(lines, start, None):
+            if not line:
+                # Normal end of headers
+                break
+            
             if line[0] in ' \t':
                 # It's a continuation line.
-                v = line.strip()
-            else:
-                k, v = line.split(":", 1)
-                k, v = k.strip().upper(), v.strip()
-                envname = "HTTP_" + k.replace("-", "_")
+                if envname is None:
+                    raise ValueError("Illegal continuation line.")
+                environ[envname] = environ[envname] + " " + line.strip()
+                continue
             
-            if k in comma_separated_headers:
-                existing = environ.get(envname)
-                if existing:
-                    v = ", ".join((existing, v))
-            environ[envname] = v
+            k, sep, v = line.partition(":")
+            if not sep:
+                raise ValueError("Illegal header line.")
+            envname = environ_keys.get(k) or header_environ_key(k)
+            
+            if envname in comma_separated and environ.get(envname):
+                environ[envname] = ", ".join((environ[envname], v.strip()))
+            else:
+                environ[envname] = v.strip()
         
         ct = environ.pop("HTTP_CONTENT_TYPE", None)
         if ct:
@@ -624,53 +4033,199 @@ class HTTPRequest(object):
             environ["CONTENT_LENGTH"] = cl
     
     def decode_chunked(self):
-        """Decode the 'chunked' transfer coding."""
-        cl = 0
-        data = StringIO.StringIO()
-        while True:
-            line = self.rfile.readline().strip().split(";", 1)
-            chunk_size = int(line.pop(0), 16)
-            if chunk_size <= 0:
-                break
-            cl += chunk_size
-            data.write(self.rfile.read(chunk_size))
-            crlf = self.rfile.read(2)
-            if crlf != "\r\n":
-                self.simple_response("400 Bad Request",
-                                     "Bad chunked transfer coding "
-                                     "(expected '\\r\\n', got %r)" % crlf)
-                return
-        
-        # Grab any trailer headers
-        self.read_headers()
+        """Decode the 'chunked' transfer coding, as the application reads
+        wsgi.input. See also spool_body()."""
+        self.chunked_body = ChunkedRFile(
+            self.rfile, self.max_body_size, self.read_headers,
+            self.max_header_size)
+        self.environ["wsgi.input"] = self.chunked_body
+        # The body ends where the encoding says it does, there is no
+        # CONTENT_LENGTH to stop at.
+        self.environ["wsgi.input_terminated"] = True
+        return True
+    
+    def spool_body(self):
+        """If spool_chunked is set, read a chunked request body into a
+        temporary file, so the application gets it with a CONTENT_LENGTH.
+        Returns False if an error response has been sent instead."""
+        if not self.spool_chunked or self.chunked_body is None:
+            return True
+        # This sends "100 Continue" first if the client is waiting for it
+        body = self.environ["wsgi.input"]
+        spool = tempfile.SpooledTemporaryFile(self.spool_memory_size)
+        try:
+            while True:
+                data = body.read(self.file_chunk_size)
+                if not data:
+                    break
+                spool.write(data)
+        except MaxSizeExceeded:
+            spool.close()
+            self.simple_response("413 Request Entity Too Large",
+                                 "The request body is too large.")
+            return False
+        except ValueError, ex:
+            spool.close()
+            self.close_connection = True
+            self.simple_response("400 Bad Request", ex.args[0])
+            return False
         
-        data.seek(0)
-        self.environ["wsgi.input"] = data
-        self.environ["CONTENT_LENGTH"] = str(cl) or ""
+        spool.seek(0)
+        self.environ["wsgi.input"] = spool
+        self.environ["CONTENT_LENGTH"] = str(self.chunked_body.bytes_read)
+        del self.environ["wsgi.input_terminated"]
+        return True
+    
+    def body_consumed(self):
+        """Return False if the application left part of a chunked request
+        body unread, in which case the connection can't be used again."""
+        return self.chunked_body is None or self.chunked_body.done
+    
+    def discard_body(self):
+        """Read and throw away what the application left unread of the
+        request body, so that the next request on the connection can be
+        read. Returns False if the connection can't be used again: part of
+        a chunked body is unread, or more than discard_body_size bytes of
+        one with a Content-Length, or the client hasn't been asked to send
+        it."""
+        if self.chunked_body is not None:
+            return self.chunked_body.done
+        try:
+            length = int(self.environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            return False
+        left = length - (self.rfile.bytes_read - self.body_start)
+        if left <= 0:
+            return True
+        if self.continue_pending or left > self.discard_body_size:
+            # The client may not send it, or it isn't worth waiting for
+            return False
+        while left > 0:
+            data = self.rfile.read(min(left, self.file_chunk_size))
+            if not data:
+                return False
+            left -= len(data)
         return True
     
+    def send_continue(self):
+        """Called by ContinueRFile when the application first reads the
+        body, to tell the client to send it. Once the response has been
+        started it is too late for that, the body is read if the client
+        sends it anyway."""
+        self.continue_pending = False
+        if not self.sent_headers:
+            self.sendall(continue_response)
+    
     def respond(self):
         """Call the appropriate WSGI app and write its iterable output."""
-        response = self.wsgi_app(self.environ, self.start_response)
-        try:
-            for chunk in response:
-                # "The start_response callable must not actually transmit
-                # the response headers. Instead, it must store them for the
-                # server or gateway to transmit only after the first
-                # iteration of the application return value that yields
-                # a NON-EMPTY string, or upon the application's first
-                # invocation of the write() callable." (PEP 333)
-                if chunk:
-                    self.write(chunk)
-                stackless.schedule()
+        profiler = TaskletProfiler.active
+        if profiler is not None:
+            profiler.request_started(self.environ)
+        try:
+            self._respond()
+        except MaxSizeExceeded:
+            # The application read more of a chunked body than we allow
+            self.close_connection = True
+            if not self.sent_headers:
+                self.simple_response("413 Request Entity Too Large",
+                                     "The request body is too large.")
+        finally:
+            if profiler is not None:
+                profiler.request_finished()
+    
+    def _respond(self):
+        if self.compression:
+            self.strip_validator_codings()
+        if self.response_cache is not None and self.response_cache.respond(self):
+            return
+        self.write_response(self.wsgi_app(self.environ, self.start_response))
+    
+    def write_response(self, response):
+        """Write out the iterable the application returned, and close it."""
+        try:
+            if (self.compression and self.started_response
+                    and not self.sent_headers):
+                self.start_compression()
+            if self.cached_body is not None:
+                # We have compressed this very body before, so there is no
+                # need to have the application produce it
+                pass
+            elif (isinstance(response, FileWrapper) and self.compressor is None
+                    and self.write_file(response)):
+                pass
+            else:
+                for chunk in response:
+                    # "The start_response callable must not actually transmit
+                    # the response headers. Instead, it must store them for the
+                    # server or gateway to transmit only after the first
+                    # iteration of the application return value that yields
+                    # a NON-EMPTY string, or upon the application's first
+                    # invocation of the write() callable." (PEP 333)
+                    if chunk:
+                        self.write_chunk(chunk)
+                    else:
+                        # An empty string asks for what we have to be sent
+                        self.flush_compressor()
+                        self.flush()
+                    if self.cached_body is not None:
+                        break
         finally:
             if hasattr(response, "close"):
                 response.close()
         if (self.ready and not self.sent_headers):
             self.sent_headers = True
             self.send_headers()
+        if self.cached_body is not None:
+            self.output(self.cached_body, len(self.cached_body))
+        if self.compressor is not None:
+            self.finish_compression()
         if self.chunked_write:
-            self.sendall("0\r\n\r\n")
+            self.output("0\r\n\r\n", 5)
+        self.flush()
+    
+    def write_file(self, wrapper):
+        """Write out the file in a wsgi.file_wrapper without reading it into
+        Python strings. Returns False without writing anything if the wrapped
+        object is not a regular file."""
+        try:
+            fd = wrapper.filelike.fileno()
+            st = os.fstat(fd)
+            offset = wrapper.filelike.tell()
+        except (AttributeError, EnvironmentError, ValueError):
+            return False
+        if not stat.S_ISREG(st.st_mode):
+            return False
+        if not self.started_response:
+            raise AssertionError("WSGI file_wrapper returned before start_response.")
+        
+        count = max(st.st_size - offset, 0)
+        if not self.sent_headers:
+            for key, value in self.outheaders:
+                if key.lower() == "content-length":
+                    count = min(count, int(value))
+                    break
+            else:
+                # We know the length, so there's no need to chunk
+                self.outheaders.append(("Content-Length", str(count)))
+            self.sent_headers = True
+            self.send_headers()
+        if not count:
+            return True
+        
+        if sendfile is not None and not self.chunked_write:
+            self.sendall(file_segment(fd, offset, count))
+            return True
+        
+        # Each piece is sent by reference to the mapped file. write() only
+        # returns once it has gone out, so the map can be closed afterwards.
+        end = offset + count
+        mapped = mmap.mmap(fd, end, access=mmap.ACCESS_READ)
+        try:
+            for pos in xrange(offset, end, self.file_chunk_size):
+                self.write(buffer(mapped, pos, min(self.file_chunk_size, end - pos)))
+        finally:
+            mapped.close()
+        return True
     
     def simple_response(self, status, msg=""):
         """Write a simple response back to the client."""
@@ -678,9 +4233,13 @@ class HTTPRequest(object):
         buf = ["%s %s\r\n" % (self.environ['ACTUAL_SERVER_PROTOCOL'], status),
                "Content-Length: %s\r\n" % len(msg)]
         
-        if status[:3] == "413" and self.response_protocol == 'HTTP/1.1':
-            # Request Entity Too Large
+        if status[:3] == "413" or self.continue_pending:
+            # Request Entity Too Large, or the client may yet send a body
+            # we haven't asked for
             self.close_connection = True
+        
+        if (self.close_connection
+                and getattr(self, "response_protocol", None) == 'HTTP/1.1'):
             buf.append("Connection: close\r\n")
         
         buf.append("\r\n")
@@ -707,9 +4266,17 @@ class HTTPRequest(object):
     def write(self, chunk):
         """WSGI callable to write unbuffered data to the client.
         
-        This method is also used internally by start_response (to write
-        data from the iterable returned by the WSGI application).
+        This method is also used internally by write_file, which needs each
+        piece to have been written when it returns.
         """
+        self.write_chunk(chunk)
+        self.flush_compressor()
+        self.flush()
+    
+    def write_chunk(self, chunk):
+        """Queue a piece of the response body, compressed and framed as the
+        response requires. The headers are queued first if they haven't
+        been yet."""
         if not self.started_response:
             raise AssertionError("WSGI write called before start_response.")
         
@@ -717,21 +4284,239 @@ class HTTPRequest(object):
             self.sent_headers = True
             self.send_headers()
         
+        if self.compressor is not None:
+            chunk = self.compressor.compress(chunk)
+            if not chunk:
+                return
+            self.keep_compressed(chunk)
+        elif self.cached_body is not None:
+            # What we send instead is already known
+            return
+        self.queue_body(chunk)
+    
+    def queue_body(self, chunk):
+        """Queue a piece of the response body, framed if the response is
+        chunked."""
+        size = len(chunk)
         if self.chunked_write and chunk:
-            buf = [hex(len(chunk))[2:], "\r\n", chunk, "\r\n"]
-            self.sendall("".join(buf))
+            if size < 4096 and isinstance(chunk, str):
+                # A small chunk is cheaper to copy once than to queue as
+                # three pieces.
+                self.output("%x\r\n%s\r\n" % (size, chunk), size)
+            else:
+                # Queue the chunk as is, rather than joining it with its
+                # framing.
+                self.output(["%x\r\n" % size, chunk, "\r\n"], size)
+        else:
+            self.output(chunk, size)
+    
+    def output(self, data, size):
+        """Queue data, which counts as size bytes of output, and wait for
+        what we have queued to be written if enough has built up. Anything
+        but strings, e.g. a buffer of a mapped file, is always waited for."""
+        if self.send is None or not isinstance(data, str) and not (
+                isinstance(data, list) and isinstance(data[1], str)):
+            self.output_pending = 0
+            self.sendall(data)
+            return
+        now = time.time()
+        if not self.output_pending:
+            self.output_since = now
+        self.send(data)
+        self.output_pending += size
+        if (self.output_pending >= self.output_buffer_size
+                or now - self.output_since >= self.output_buffer_time):
+            self.flush()
+    
+    def flush(self):
+        """Wait for the response output queued so far to be written."""
+        self.output_pending = 0
+        self.sendall(())
+    
+    def strip_validator_codings(self):
+        """Take the codings start_compression() adds to the ETags of
+        compressed responses off those the client sends back, so that the
+        application recognises them. If-Range is left as it is, as a range
+        of the uncompressed entity is of no use to the client."""
+        environ = self.environ
+        for key in ("HTTP_IF_NONE_MATCH", "HTTP_IF_MATCH"):
+            value = environ.get(key)
+            if value is not None:
+                stripped = strip_etag_coding(value)
+                if stripped != value:
+                    environ[key] = stripped
+                    if self.validator_tags is None:
+                        self.validator_tags = set()
+                    self.validator_tags.update(
+                        [tag.strip() for tag in value.split(",")])
+    
+    def validator_etag(self, etag):
+        """Return the entity tag to answer a revalidation that matched etag
+        with: that of the compressed entity the client has, if it sent one
+        back, preferring the coding it would be sent in now."""
+        tags = self.validator_tags
+        codings = ("gzip", "deflate")
+        coding = preferred_coding(self.environ.get("HTTP_ACCEPT_ENCODING", ""))
+        if coding is not None:
+            codings = (coding,) + codings
+        for coding in codings:
+            tag = coded_etag(etag, coding)
+            if tag in tags or "W/" + tag in tags:
+                return tag
+        return etag
+    
+    def start_compression(self):
+        """Decide whether to compress the response, and if so, adjust its
+        headers to match. Returns True if the response is to be compressed.
+        
+        A response is compressed if it is a 200 with one of the
+        compressible_types, isn't already encoded, isn't known to be
+        shorter than compress_min_size, and the client accepts gzip or
+        deflate. If its compressed body is in the compression_cache, it is
+        left in cached_body.
+        """
+        if self.compression_decided:
+            return self.compressor is not None or self.cached_body is not None
+        self.compression_decided = True
+        
+        headers = self.outheaders
+        environ = self.environ
+        if self.status[:3] == "304" and self.validator_tags is not None:
+            # If the client revalidated a compressed entity, the ETag must
+            # be that of the compressed entity too
+            for i, (k, v) in enumerate(headers):
+                if k.lower() == "etag":
+                    headers[i] = (k, self.validator_etag(v))
+            return False
+        if self.status[:3] != "200" or environ["REQUEST_METHOD"] == "HEAD":
+            return False
+        found = {}
+        names = response_header_names
+        for i, (k, v) in enumerate(headers):
+            name = names.get(k)
+            if name is None:
+                name = response_header_name(k)
+            if name:
+                found[name] = i
+        if "content-encoding" in found or "content-type" not in found:
+            return False
+        content_type = headers[found["content-type"]][1]
+        if (content_type.split(";", 1)[0].strip().lower()
+                not in self.compressible_types):
+            return False
+        if "content-length" in found:
+            try:
+                length = int(headers[found["content-length"]][1])
+            except ValueError:
+                return False
+            if length < self.compress_min_size:
+                return False
+        
+        # Whether we compress or not, the response depends on Accept-Encoding
+        if "vary" in found:
+            k, v = headers[found["vary"]]
+            if "accept-encoding" not in v.lower() and v.strip() != "*":
+                headers[found["vary"]] = (k, v + ", Accept-Encoding")
+        else:
+            headers.append(("Vary", "Accept-Encoding"))
+        
+        coding = preferred_coding(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        if coding is None:
+            return False
+        
+        headers.append(("Content-Encoding", coding))
+        if "etag" in found:
+            # The compressed body is a different entity, so it needs an
+            # entity tag of its own
+            k, etag = headers[found["etag"]]
+            headers[found["etag"]] = (k, coded_etag(etag, coding))
+            if self.compression_cache is not None:
+                self.cache_key = (environ.get("HTTP_HOST", ""),
+                                  environ.get("SCRIPT_NAME", "") +
+                                  environ.get("PATH_INFO", ""),
+                                  environ.get("QUERY_STRING", ""), etag, coding)
+                self.cached_body = self.compression_cache.get(self.cache_key)
+        
+        if self.cached_body is not None:
+            if "content-length" in found:
+                headers[found["content-length"]] = ("Content-Length",
+                                                    str(len(self.cached_body)))
+            else:
+                headers.append(("Content-Length", str(len(self.cached_body))))
+            return True
+        
+        # We don't know how long the compressed body will be
+        if "content-length" in found:
+            del headers[found["content-length"]]
+        if coding == "gzip":
+            wbits = 16 + zlib.MAX_WBITS
+        else:
+            wbits = zlib.MAX_WBITS
+        self.compressor = zlib.compressobj(self.compression_level,
+                                           zlib.DEFLATED, wbits)
+        if self.cache_key is not None:
+            self.compressed = []
+        return True
+    
+    def keep_compressed(self, data):
+        """Keep a piece of the compressed body for the compression_cache."""
+        if self.compressed is None:
+            return
+        self.compressed_size += len(data)
+        if self.compressed_size > self.compression_cache.max_entry_size:
+            # Too large to be cached
+            self.compressed = None
         else:
-            self.sendall(chunk)
+            self.compressed.append(data)
+    
+    def flush_compressor(self):
+        """Queue what the compressor has of the response body so far."""
+        if self.compressor is not None:
+            data = self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                self.keep_compressed(data)
+                self.queue_body(data)
+    
+    def finish_compression(self):
+        """Queue the end of the compressed body, and cache it if we can."""
+        data = self.compressor.flush()
+        self.compressor = None
+        if data:
+            self.keep_compressed(data)
+            self.queue_body(data)
+        if self.compressed is not None:
+            self.compression_cache.put(self.cache_key, "".join(self.compressed))
+            self.compressed = None
     
     def send_headers(self):
         """Assert, process, and send the HTTP response message-headers."""
-        hkeys = [key.lower() for key, value in self.outheaders]
+        if self.compression:
+            self.start_compression()
+        
+        # Find out which of the headers we may add the application has set,
+        # without lower-casing the name of every header.
+        present = set()
+        names = response_header_names
+        for k, v in self.outheaders:
+            name = names.get(k)
+            if name is None:
+                if not isinstance(k, str):
+                    raise TypeError("WSGI response header key %r is not a string." % (k,))
+                name = response_header_name(k)
+            if name:
+                present.add(name)
         status = int(self.status[:3])
         
+        if self.continue_pending:
+            # We are answering without having asked for the body. The client
+            # may send it regardless, so we can't tell where the next
+            # request would start.
+            self.close_connection = True
+        
         if status == 413:
             # Request Entity Too Large. Close conn to avoid garbage.
             self.close_connection = True
-        elif "content-length" not in hkeys:
+        elif "content-length" not in present:
             # "All 1xx (informational), 204 (no content),
             # and 304 (not modified) responses MUST NOT
             # include a message-body." So no point chunking.
@@ -746,7 +4531,7 @@ class HTTPRequest(object):
                     # Closing the conn is the only way to determine len.
                     self.close_connection = True
         
-        if "connection" not in hkeys:
+        if "connection" not in present:
             if self.response_protocol == 'HTTP/1.1':
                 if self.close_connection:
                     self.outheaders.append(("Connection", "close"))
@@ -754,13 +4539,13 @@ class HTTPRequest(object):
                 if not self.close_connection:
                     self.outheaders.append(("Connection", "Keep-Alive"))
         
-        if "date" not in hkeys:
-            self.outheaders.append(("Date", rfc822.formatdate()))
+        if "date" not in present:
+            self.outheaders.append(("Date", hub.date))
         
-        if "server" not in hkeys:
+        if "server" not in present:
             self.outheaders.append(("Server", self.environ['SERVER_SOFTWARE']))
         
-        buf = [self.environ['ACTUAL_SERVER_PROTOCOL'], " ", self.status, "\r\n"]
+        buf = [status_line(self.environ['ACTUAL_SERVER_PROTOCOL'], self.status)]
         try:
             buf += [k + ": " + v + "\r\n" for k, v in self.outheaders]
         except TypeError:
@@ -771,7 +4556,8 @@ class HTTPRequest(object):
             else:
                 raise
         buf.append("\r\n")
-        self.sendall("".join(buf))
+        buf = "".join(buf)
+        self.output(buf, len(buf))
 
 
 class HTTPConnection(object):
@@ -779,10 +4565,17 @@ class HTTPConnection(object):
     
     sock_chan: the sock_channel object for this connection.
     wsgi_app: the WSGI application for this server/connection.
-    environ: a WSGI environ template. This will be copied for each request.
+    environ: a WSGI environ template for this connection, which the
+        connection keeps and adds to. This will be copied for each request.
+    server: the Server that accepted the connection, if any. Requests are
+        only passed to the application once the server admits them.
     
     rfile: a fileobject for reading from the sock_chan.
     sendall: a function for writing (+ flush) to the sock_chan.
+    pipelining: if True, a response is only queued, not waited for, when the
+        client has already sent the next request. Responses to pipelined
+        requests then go out in as few writes as possible. How much of them
+        is kept queued is bounded by the sock_chan's send watermarks.
     """
     
     RequestHandlerClass = HTTPRequest
@@ -792,15 +4585,43 @@ class HTTPConnection(object):
                "wsgi.multiprocess": False,
                "wsgi.run_once": False,
                "wsgi.errors": sys.stderr,
+               "wsgi.file_wrapper": FileWrapper,
                }
     
-    def __init__(self, sock_chan, wsgi_app, environ):
+    keepalive_timeout = None
+    header_timeout = None
+    
+    pipelining = True
+    
+    response_cache = None
+    
+    def __init__(self, sock_chan, wsgi_app, environ, server=None):
         self.sock_chan = sock_chan
         self.wsgi_app = wsgi_app
+        self.server = server
+        # The request being served, if any, and whether we are waiting for
+        # another one after it
+        self.request = None
+        self.idle = False
+        if server is not None:
+            self.keepalive_timeout = server.keepalive_timeout
+            self.header_timeout = server.header_timeout
+            self.response_cache = server.response_cache
+            sock_chan.read_timeout = server.body_timeout
+            sock_chan.write_timeout = server.write_timeout
+            sock_chan.send_high_water = server.send_high_water
+            sock_chan.send_low_water = server.send_low_water
         
-        # Copy the class environ into self.
-        self.environ = self.environ.copy()
-        self.environ.update(environ)
+        # The environ we are given is a copy made for this connection (by
+        # Server, from a template that already has our defaults), so we keep
+        # it rather than copy it again. We only fill in any of the class
+        # environ's entries that it lacks. Each request then makes the one
+        # copy it needs.
+        defaults = self.environ
+        self.environ = environ
+        for key in defaults:
+            if key not in environ:
+                environ[key] = defaults[key]
         
         self.rfile = sock_channel_rfile(sock_chan)
         self.sendall = sock_chan.sendall
@@ -809,20 +4630,74 @@ class HTTPConnection(object):
     
     def communicate(self):
         """Read each request and respond appropriately."""
+        requests = 0
+        metrics = self.server.metrics if self.server is not None else None
         try:
             while True:
                 # (re)set req to None so that if something goes wrong in
                 # the RequestHandlerClass constructor, the error doesn't
                 # get written to the previous request.
                 req = None
+                self.request = None
+                self.idle = requests > 0
+                keepalive_timeout = self.keepalive_timeout
+                if self.server is not None and not self.server.running:
+                    # The server is stopping, but we told the client we would
+                    # keep the connection open
+                    keepalive_timeout = self.server.drain_keepalive
+                if self.idle and keepalive_timeout is not None:
+                    # Wait for the next request on an idle connection.
+                    # socket.timeout is raised if it doesn't come.
+                    if not self.sock_chan.wait_for_data(keepalive_timeout):
+                        return
+                requests += 1
+                if self.header_timeout is not None:
+                    self.sock_chan.set_deadline(self.header_timeout)
+                # Time the parse from when the request starts arriving
+                if not self.sock_chan.wait_for_data():
+                    return
+                self.idle = False
+                started = time.time()
                 req = self.RequestHandlerClass(self.sendall, self.environ,
-                                               self.wsgi_app)
+                                               self.wsgi_app,
+                                               self.sock_chan.write)
+                self.request = req
+                if self.response_cache is not None:
+                    req.response_cache = self.response_cache
                 # This order of operations should guarantee correct pipelining.
                 req.parse_request()
-                if not req.ready:
+                self.sock_chan.clear_deadline()
+                if not req.ready or not req.spool_body():
                     return
-                req.respond()
-                if req.close_connection:
+                if metrics is not None:
+                    metrics.requests += 1
+                    metrics.parse_time.record(time.time() - started)
+                if self.server is not None and not self.server.running:
+                    # Tell the client this is the last response
+                    req.close_connection = True
+                if self.pipelining and self.next_request_buffered(req):
+                    # Queue the response behind the previous ones. It is
+                    # written out with them once we get to a request that
+                    # isn't followed by another, or the connection closes.
+                    req.sendall = self.queue_response
+                if self.server is None:
+                    req.respond()
+                elif self.server.admit_request():
+                    started = time.time()
+                    try:
+                        req.respond()
+                    finally:
+                        self.server.release_request()
+                        metrics.app_time.record(time.time() - started)
+                        if req.status:
+                            status = req.status[:1]
+                            metrics.responses[status] = metrics.responses.get(status, 0) + 1
+                else:
+                    # The request body, if any, is still unread
+                    req.close_connection = True
+                    req.simple_response("503 Service Unavailable",
+                                        "The server is overloaded.")
+                if req.close_connection or not req.discard_body():
                     return
         except socket.error, e:
             errno = e.args[0]
@@ -842,7 +4717,40 @@ class HTTPConnection(object):
                         raise
                     # Otherwise, connection was closed and we have nowhere to print error
     
+    def next_request_buffered(self, req):
+        """Return True if the head of another request has already been
+        received after req and whatever is left of its body."""
+        skip = 0
+        if not req.body_consumed() or req.continue_pending:
+            # We can't tell where a chunked body ends before it's read, nor
+            # whether a body we haven't asked for will come
+            return False
+        if req.environ["wsgi.input"] is self.rfile:
+            try:
+                skip = int(req.environ.get("CONTENT_LENGTH") or 0)
+            except ValueError:
+                return False
+        return self.sock_chan.buffered("\r\n\r\n", skip)
+    
+    def queue_response(self, data):
+        """Used instead of sendall for pipelined requests. Only strings are
+        left in the queue. File segments and buffers refer to files that may
+        be closed as soon as we return, so we wait for those to be written."""
+        self.sock_chan.write(data)
+        if isinstance(data, (list, tuple)):
+            owned = not [s for s in data if not isinstance(s, str)]
+        else:
+            owned = isinstance(data, str)
+        if not owned:
+            self.sock_chan.flush()
+    
     def close(self):
         """Close the socket underlying this connection."""
         self.rfile.close()
+        if self.sock_chan.send_pending:
+            # Responses to pipelined requests may still be queued
+            try:
+                self.sock_chan.flush()
+            except socket.error:
+                pass
         self.sock_chan.close()
\ No newline at end of file
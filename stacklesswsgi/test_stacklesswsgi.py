@@ -0,0 +1,665 @@
+#
+# Tests for stacklesswsgi. Run with: python -m unittest test_stacklesswsgi
+#
+
+import base64
+import gzip
+import os
+import resource
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+from email.utils import formatdate
+from StringIO import StringIO
+
+import stackless
+import stacklesswsgi
+
+
+class FakeClock(object):
+    """Stands in for time.time() so that tests can set the clock."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.real_time = time.time
+        self.clock = time.time = FakeClock(1000000.0)
+        self.wheel = stacklesswsgi.timer_wheel()
+        self.fired = []
+
+    def tearDown(self):
+        time.time = self.real_time
+
+    def advance(self, seconds, step=0.1):
+        """Move the clock on by seconds, running the wheel at each step."""
+        end = self.clock.now + seconds
+        while self.clock.now < end:
+            self.clock.now += step
+            self.wheel.run(self.clock.now)
+
+    def test_fires_on_time(self):
+        self.wheel.add(5, lambda: self.fired.append(self.clock.now))
+        self.advance(4.8)
+        self.assertEqual(self.fired, [])
+        self.advance(0.5)
+        self.assertEqual(len(self.fired), 1)
+
+    def test_clock_set_back(self):
+        self.advance(1)
+        self.clock.now -= 3600
+        self.wheel.add(2, lambda: self.fired.append(True))
+        self.wheel.run(self.clock.now)
+        self.assertEqual(self.wheel.timeout(self.clock.now) <= 2.2, True)
+        self.advance(2.5)
+        self.assertEqual(self.fired, [True])
+
+    def test_timer_added_before_clock_set_back(self):
+        self.wheel.add(2, lambda: self.fired.append(True))
+        self.advance(1)
+        self.clock.now -= 60
+        self.advance(1.5)
+        self.assertEqual(self.fired, [True])
+
+
+class AcceptTest(unittest.TestCase):
+
+    def setUp(self):
+        # Keep the hub loop from being started, the test drives the server
+        running = stacklesswsgi.hub.running
+        stacklesswsgi.hub.running = True
+        try:
+            self.server = stacklesswsgi.sock_server(("127.0.0.1", 0))
+        finally:
+            stacklesswsgi.hub.running = running
+        self.client = socket.create_connection(self.server.socket.getsockname())
+        self.accepted = []
+        def accept():
+            self.accepted.extend(self.server.accept_many(1))
+        stackless.tasklet(accept)()
+        # Run it until it waits for a connection
+        stackless.schedule()
+        self.limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    def tearDown(self):
+        resource.setrlimit(resource.RLIMIT_NOFILE, self.limits)
+        self.server.close()
+        self.client.close()
+        for s, a in self.accepted:
+            s.close()
+
+    def test_out_of_file_descriptors(self):
+        # Only allow descriptors below the lowest free one
+        lowest_free = os.dup(0)
+        os.close(lowest_free)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (lowest_free, self.limits[1]))
+        self.server.handle_accept()
+        resource.setrlimit(resource.RLIMIT_NOFILE, self.limits)
+        self.assertEqual(self.accepted, [])
+        # The listening socket stays open, but we stop asking to accept
+        self.assertTrue(self.server._fileno in stacklesswsgi.hub.fd_map)
+        self.assertFalse(self.server.readable())
+
+        self.server._resume_accept()
+        self.assertTrue(self.server.readable())
+        self.server.handle_accept()
+        stackless.schedule()
+        self.assertEqual(len(self.accepted), 1)
+
+
+class SockChannelTest(unittest.TestCase):
+
+    def setUp(self):
+        a, self.peer = socket.socketpair()
+        self.channel = stacklesswsgi.sock_channel(a)
+
+    def tearDown(self):
+        self.channel.close()
+        self.peer.close()
+
+    def test_send_returns_bytes(self):
+        self.assertEqual(self.channel.send("abc"), 3)
+        self.assertEqual(self.channel.send(["ab", "", "cde"]), 5)
+        self.assertEqual(self.channel.send_pending, 8)
+
+    def test_drain(self):
+        drained = []
+        def drain():
+            self.channel.drain(10)
+            drained.append(True)
+        self.peer.sendall("x" * 100)
+        stackless.tasklet(drain)()
+        stackless.schedule()
+        # We have told the client we are done, and wait for it to be
+        self.assertEqual(self.peer.recv(10), "")
+        self.channel.handle_read()
+        stackless.schedule()
+        self.assertEqual(drained, [])
+        self.peer.shutdown(socket.SHUT_WR)
+        self.channel.handle_read()
+        stackless.schedule()
+        self.assertEqual(drained, [True])
+
+
+class FakeRFile(object):
+    """Stands in for a connection's rfile, reading from a string."""
+
+    def __init__(self, data):
+        self.data = StringIO(data)
+
+    def read_until(self, delimiter, limit):
+        data = self.data.getvalue()
+        start = self.data.tell()
+        end = data.find(delimiter, start, start + limit)
+        if end < 0:
+            if len(data) - start >= limit:
+                return None
+            return self.data.read()
+        return self.data.read(end + len(delimiter) - start)
+
+    def read(self, size=-1):
+        return self.data.read(size)
+
+    def readline(self, size=-1):
+        return self.data.readline(size)
+
+    @property
+    def bytes_read(self):
+        return self.data.tell()
+
+
+class HTTPTestCase(unittest.TestCase):
+    """Has HTTPRequest answer requests read from strings."""
+
+    compression = False
+    compression_cache = None
+    response_cache = None
+
+    def request(self, app, path, headers=(), method="GET"):
+        """Respond to a request for path with app, and return the status
+        line, the headers and the body of the response."""
+        return self.respond(app, "%s %s HTTP/1.1" % (method, path),
+                            [("Host", "example.com")] + list(headers))
+
+    def respond(self, app, request_line, headers=()):
+        head = request_line + "\r\n"
+        for header in headers:
+            head += "%s: %s\r\n" % header
+        environ = stacklesswsgi.HTTPConnection.environ.copy()
+        environ.update({"SERVER_SOFTWARE": "test",
+                        "ACTUAL_SERVER_PROTOCOL": "HTTP/1.1",
+                        "SERVER_NAME": "example.com", "SERVER_PORT": "80",
+                        "REMOTE_ADDR": "127.0.0.1",
+                        "wsgi.input": FakeRFile(head + "\r\n")})
+        out = []
+        def sendall(data):
+            if not isinstance(data, (list, tuple)):
+                data = [data]
+            for piece in data:
+                if isinstance(piece, stacklesswsgi.file_segment):
+                    os.lseek(piece.fd, piece.offset, os.SEEK_SET)
+                    piece = os.read(piece.fd, piece.count)
+                out.append(piece)
+        req = stacklesswsgi.HTTPRequest(sendall, environ, app)
+        req.compression = self.compression
+        req.compression_cache = self.compression_cache
+        req.response_cache = self.response_cache
+        self.req = req
+        req.parse_request()
+        if req.ready:
+            req.respond()
+        response = "".join(str(s) for s in out)
+        head, sep, body = response.partition("\r\n\r\n")
+        lines = head.split("\r\n")
+        headers = dict(line.split(": ", 1) for line in lines[1:])
+        if headers.get("Transfer-Encoding") == "chunked":
+            body = self.dechunk(body)
+        if headers.get("Content-Encoding") == "gzip":
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        return lines[0], headers, body
+
+    def dechunk(self, body):
+        data = ""
+        while True:
+            size, sep, body = body.partition("\r\n")
+            size = int(size, 16)
+            if not size:
+                return data
+            data += body[:size]
+            body = body[size + 2:]
+
+
+class CompressionTest(HTTPTestCase):
+
+    compression = True
+
+    def setUp(self):
+        self.compression_cache = stacklesswsgi.CompressionCache()
+        self.dir = tempfile.mkdtemp()
+        f = open(os.path.join(self.dir, "page.html"), "w")
+        f.write("<p>Hello</p>" * 200)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def request(self, app, path, headers=()):
+        return HTTPTestCase.request(self, app, path,
+                                    [("Accept-Encoding", "gzip")] + list(headers))
+
+    def test_revalidate_compressed(self):
+        app = stacklesswsgi.StaticFiles(self.dir)
+        status, headers, body = self.request(app, "/page.html")
+        self.assertEqual(status, "HTTP/1.1 200 OK")
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        etag = headers["ETag"]
+        self.assertTrue(etag.endswith(';gzip"'))
+        status, headers, body = self.request(app, "/page.html",
+                                             [("If-None-Match", etag)])
+        self.assertEqual(status, "HTTP/1.1 304 Not Modified")
+        self.assertEqual(headers["ETag"], etag)
+
+    def test_revalidate_list(self):
+        app = stacklesswsgi.StaticFiles(self.dir)
+        etag = self.request(app, "/page.html")[1]["ETag"]
+        plain = etag.replace(";gzip", "")
+        deflated = etag.replace(";gzip", ";deflate")
+        for tags, expected in [([deflated, '"other"'], deflated),
+                               ([deflated, etag], etag),
+                               ([plain, '"other;gzip"'], plain)]:
+            status, headers, body = self.request(
+                app, "/page.html", [("If-None-Match", ", ".join(tags))])
+            self.assertEqual(status, "HTTP/1.1 304 Not Modified")
+            self.assertEqual(headers["ETag"], expected)
+
+    def test_application_etag_left_alone(self):
+        seen = []
+        def app(environ, start_response):
+            seen.append(environ.get("HTTP_IF_NONE_MATCH"))
+            if environ.get("HTTP_IF_NONE_MATCH") == '"bundle-gzip"':
+                start_response("304 Not Modified", [("ETag", '"bundle-gzip"')])
+                return []
+            start_response("200 OK", [("Content-Type", "text/plain"),
+                                      ("ETag", '"bundle-gzip"')])
+            return ["x" * 2000]
+        status, headers, body = self.request(
+            app, "/", [("If-None-Match", '"bundle-gzip"')])
+        self.assertEqual(seen, ['"bundle-gzip"'])
+        self.assertEqual(status, "HTTP/1.1 304 Not Modified")
+        self.assertEqual(headers["ETag"], '"bundle-gzip"')
+
+    def test_query_string_in_cache_key(self):
+        def app(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/plain"),
+                                      ("ETag", '"same"')])
+            return [environ["QUERY_STRING"] * 1000]
+        self.assertEqual(self.request(app, "/?a")[2], "a" * 1000)
+        self.assertEqual(self.request(app, "/?b")[2], "b" * 1000)
+
+
+class ParserTest(HTTPTestCase):
+
+    def setUp(self):
+        self.environs = []
+
+    def app(self, environ, start_response):
+        self.environs.append(environ)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return ["Hello"]
+
+    def get(self, headers=(), request_line="GET / HTTP/1.1"):
+        return self.respond(self.app, request_line,
+                            [("Host", "example.com")] + list(headers))[0]
+
+    def test_request(self):
+        self.assertEqual(self.get(request_line="GET /a%20b?c=d HTTP/1.0"),
+                         "HTTP/1.1 200 OK")
+        environ = self.environs[0]
+        self.assertEqual(environ["REQUEST_METHOD"], "GET")
+        self.assertEqual(environ["PATH_INFO"], "/a b")
+        self.assertEqual(environ["QUERY_STRING"], "c=d")
+        self.assertEqual(environ["SERVER_PROTOCOL"], "HTTP/1.0")
+        self.assertEqual(environ["HTTP_HOST"], "example.com")
+
+    def test_leading_crlf(self):
+        self.assertEqual(self.get(request_line="\r\nGET / HTTP/1.1"),
+                         "HTTP/1.1 200 OK")
+        self.assertEqual(self.environs[0]["PATH_INFO"], "/")
+
+    def test_malformed_request_line(self):
+        for request_line in ["GET / FOO", "GET / HTTP/x.y", "GET / HTTP/1",
+                             "GET /", "GET / HTTP/1.1x"]:
+            self.assertEqual(self.get(request_line=request_line),
+                             "HTTP/1.1 400 Bad Request")
+        self.assertEqual(self.environs, [])
+
+    def test_unsupported_version(self):
+        self.assertEqual(self.get(request_line="GET / HTTP/2.0"),
+                         "HTTP/1.1 505 HTTP Version Not Supported")
+
+    def test_header_count(self):
+        max_headers = stacklesswsgi.HTTPRequest.max_headers
+        headers = [("X-Header-%d" % i, "x") for i in range(max_headers - 1)]
+        self.assertEqual(self.get(headers), "HTTP/1.1 200 OK")
+        self.assertEqual(self.get(headers + [("X-Another", "x")]),
+                         "HTTP/1.1 431 Request Header Fields Too Large")
+
+    def test_header_size(self):
+        max_header_size = stacklesswsgi.HTTPRequest.max_header_size
+        self.assertEqual(self.get([("X-Big", "x" * (max_header_size - 100))]),
+                         "HTTP/1.1 200 OK")
+        self.assertEqual(self.get([("X-Big", "x" * max_header_size)]),
+                         "HTTP/1.1 431 Request Header Fields Too Large")
+
+    def test_headers(self):
+        self.get([("Accept", "text/html"), ("X-Folded", "a"),
+                  ("Accept", "text/plain"), ("Content-Type", "text/plain"),
+                  ("Content-Length", "0")])
+        environ = self.environs[0]
+        self.assertEqual(environ["HTTP_ACCEPT"], "text/html, text/plain")
+        self.assertEqual(environ["CONTENT_TYPE"], "text/plain")
+        self.assertEqual(environ["CONTENT_LENGTH"], "0")
+        self.assertFalse("HTTP_CONTENT_TYPE" in environ)
+
+    def test_interned_keys(self):
+        self.get([("X-Some-Header", "1")])
+        self.get([("X-Some-Header", "2")])
+        first, second = [[key for key in environ if key == "HTTP_X_SOME_HEADER"][0]
+                         for environ in self.environs]
+        self.assertTrue(first is second)
+        self.assertTrue(first is intern("HTTP_X_SOME_HEADER"))
+
+    def body_request(self, body, declared=None):
+        """Parse a POST with body, followed by another request, and return
+        the HTTPRequest and its rfile."""
+        if declared is None:
+            declared = len(body)
+        head = "POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % declared
+        rfile = FakeRFile(head + body + "GET /next HTTP/1.1\r\n\r\n")
+        environ = stacklesswsgi.HTTPConnection.environ.copy()
+        environ.update({"ACTUAL_SERVER_PROTOCOL": "HTTP/1.1",
+                        "wsgi.input": rfile})
+        req = stacklesswsgi.HTTPRequest(lambda data: None, environ, self.app)
+        req.parse_request()
+        return req, rfile
+
+    def test_body_read(self):
+        req, rfile = self.body_request("hello")
+        self.assertEqual(req.environ["wsgi.input"].read(5), "hello")
+        self.assertTrue(req.discard_body())
+        self.assertEqual(rfile.readline(), "GET /next HTTP/1.1\r\n")
+
+    def test_body_left_unread(self):
+        req, rfile = self.body_request("hello")
+        req.environ["wsgi.input"].read(2)
+        self.assertTrue(req.discard_body())
+        self.assertEqual(rfile.readline(), "GET /next HTTP/1.1\r\n")
+
+    def test_large_body_left_unread(self):
+        size = stacklesswsgi.HTTPRequest.discard_body_size + 1
+        req, rfile = self.body_request("x" * size)
+        self.assertFalse(req.discard_body())
+
+    def test_body_cut_short(self):
+        req, rfile = self.body_request("", 1000)
+        self.assertFalse(req.discard_body())
+
+    def test_basic_authorization(self):
+        credentials = base64.b64encode("user:secret")
+        self.get([("Authorization", "Basic " + credentials)])
+        self.assertEqual(self.environs[0]["AUTH_TYPE"], "Basic")
+        self.assertEqual(self.environs[0]["REMOTE_USER"], "user")
+        self.assertEqual(self.get([("Authorization", "Basic !!!")]),
+                         "HTTP/1.1 400 Bad Request")
+        self.assertEqual(self.get([("Authorization", "Basic")]),
+                         "HTTP/1.1 400 Bad Request")
+
+
+class StaticFilesTest(HTTPTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.dir, "root")
+        os.mkdir(self.root)
+        os.mkdir(os.path.join(self.root, "docs"))
+        self.write("root/small.txt", "0123456789")
+        self.write("root/large.txt", "x" * 1000)
+        self.write("root/docs/index.html", "<p>Index</p>")
+        self.write("secret.txt", "Secret")
+        self.static = stacklesswsgi.StaticFiles(self.root, max_entry_size=100)
+
+    def tearDown(self):
+        self.static.clear()
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        f = open(os.path.join(self.dir, name), "w")
+        f.write(data)
+        f.close()
+
+    def get(self, path, headers=()):
+        return self.request(self.static, path, headers)
+
+    def test_files(self):
+        status, headers, body = self.get("/small.txt")
+        self.assertEqual(status, "HTTP/1.1 200 OK")
+        self.assertEqual(headers["Content-Type"], "text/plain")
+        self.assertEqual(body, "0123456789")
+        self.assertEqual(self.get("/large.txt")[2], "x" * 1000)
+        self.assertEqual(self.get("/docs/")[2], "<p>Index</p>")
+        status, headers, body = self.get("/docs?a=b")
+        self.assertEqual(status, "HTTP/1.1 301 Moved Permanently")
+        self.assertEqual(headers["Location"], "/docs/?a=b")
+        self.assertEqual(self.get("/missing.txt")[0], "HTTP/1.1 404 Not Found")
+
+    def test_outside_root(self):
+        self.assertEqual(self.get("/../secret.txt")[0], "HTTP/1.1 404 Not Found")
+        os.symlink(os.path.join(self.dir, "secret.txt"),
+                   os.path.join(self.root, "link.txt"))
+        os.symlink(self.dir, os.path.join(self.root, "up"))
+        self.assertEqual(self.get("/link.txt")[0], "HTTP/1.1 404 Not Found")
+        self.assertEqual(self.get("/up/secret.txt")[0], "HTTP/1.1 404 Not Found")
+        self.assertEqual(self.get("/up")[0], "HTTP/1.1 404 Not Found")
+        os.symlink(os.path.join(self.root, "small.txt"),
+                   os.path.join(self.root, "inside.txt"))
+        self.assertEqual(self.get("/inside.txt")[2], "0123456789")
+
+    def test_trailing_slash(self):
+        self.assertEqual(self.get("/small.txt/")[0], "HTTP/1.1 404 Not Found")
+        self.assertEqual(self.get("/small.txt")[0], "HTTP/1.1 200 OK")
+        self.assertEqual(self.get("/small.txt/")[0], "HTTP/1.1 404 Not Found")
+
+    def test_not_modified(self):
+        headers = self.get("/small.txt")[1]
+        status, headers304, body = self.get(
+            "/small.txt", [("If-None-Match", headers["ETag"])])
+        self.assertEqual(status, "HTTP/1.1 304 Not Modified")
+        self.assertEqual(headers304["ETag"], headers["ETag"])
+        self.assertEqual(body, "")
+        status = self.get("/small.txt", [("If-None-Match", '"other"')])[0]
+        self.assertEqual(status, "HTTP/1.1 200 OK")
+        status = self.get("/small.txt", [("If-Modified-Since",
+                                          headers["Last-Modified"])])[0]
+        self.assertEqual(status, "HTTP/1.1 304 Not Modified")
+
+    def test_ranges(self):
+        for path in ["/small.txt", "/large.txt"]:
+            status, headers, body = self.get(path, [("Range", "bytes=2-4")])
+            self.assertEqual(status, "HTTP/1.1 206 Partial Content")
+            self.assertEqual(headers["Content-Range"].split("/")[0], "bytes 2-4")
+            self.assertEqual(len(body), 3)
+        self.assertEqual(self.get("/small.txt", [("Range", "bytes=-3")])[2], "789")
+        status, headers, body = self.get("/small.txt", [("Range", "bytes=10-")])
+        self.assertEqual(status, "HTTP/1.1 416 Requested Range Not Satisfiable")
+        self.assertEqual(headers["Content-Range"], "bytes */10")
+        status, headers, body = self.get("/small.txt", [("Range", "bytes=2-4"),
+                                                        ("If-Range", '"other"')])
+        self.assertEqual(status, "HTTP/1.1 200 OK")
+        self.assertEqual(body, "0123456789")
+
+    def test_eviction_closes_files(self):
+        self.static.max_files = 1
+        self.get("/large.txt")
+        entry = self.static.entries["/large.txt"]
+        f = entry.file
+        self.get("/small.txt")
+        self.assertFalse("/large.txt" in self.static.entries)
+        self.assertTrue(f.closed)
+        self.assertEqual(entry.mapped, None)
+
+    def test_eviction_while_sending(self):
+        self.static.max_files = 1
+        environ = {"PATH_INFO": "/large.txt", "REQUEST_METHOD": "GET"}
+        response = self.static(environ, lambda status, headers: None)
+        entry = self.static.entries["/large.txt"]
+        self.get("/small.txt")
+        # The response still has the file to send
+        self.assertFalse(entry.file.closed)
+        self.assertEqual(response.filelike.read(3), "xxx")
+        f = entry.file
+        response.close()
+        self.assertTrue(f.closed)
+
+    def test_changed_file_closed(self):
+        self.static.revalidate = 0
+        self.get("/large.txt")
+        f = self.static.entries["/large.txt"].file
+        self.write("root/large.txt", "y" * 2000)
+        self.assertEqual(self.get("/large.txt")[2], "y" * 2000)
+        self.assertTrue(f.closed)
+
+
+class ResponseCacheTest(HTTPTestCase):
+
+    def setUp(self):
+        self.response_cache = stacklesswsgi.ResponseCache()
+        self.calls = 0
+
+    def app(self, headers, body="Hello"):
+        """Return an application that answers with headers and body."""
+        def app(environ, start_response):
+            self.calls += 1
+            start_response("200 OK", [("Content-Type", "text/plain")] + headers)
+            return [body % environ]
+        return app
+
+    def ttl(self, headers, status="200 OK"):
+        return self.response_cache.time_to_live(status, headers)
+
+    def test_time_to_live(self):
+        self.assertEqual(self.ttl([("Cache-Control", "max-age=60")]), 60)
+        self.assertEqual(self.ttl([("Cache-Control", "max-age=60, s-maxage=30")]), 30)
+        now = time.time()
+        ttl = self.ttl([("Date", formatdate(now, usegmt=True)),
+                        ("Expires", formatdate(now + 120, usegmt=True))])
+        self.assertTrue(119 <= ttl <= 121)
+        self.assertEqual(self.ttl([("Expires", "0")]), None)
+        self.assertEqual(self.ttl([]), None)
+        self.assertEqual(self.ttl([("Cache-Control", "max-age=0")]), None)
+
+    def test_not_kept(self):
+        for header in [("Cache-Control", "max-age=60, no-store"),
+                       ("Cache-Control", "private, max-age=60"),
+                       ("Cache-Control", "no-cache"),
+                       ("Set-Cookie", "a=b"),
+                       ("Vary", "*")]:
+            self.assertEqual(self.ttl([("Cache-Control", "max-age=60"),
+                                       header]), None)
+        self.assertEqual(self.ttl([("Cache-Control", "max-age=60")],
+                                  "500 Internal Server Error"), None)
+
+    def test_hit(self):
+        app = self.app([("Cache-Control", "max-age=60")])
+        status, headers, body = self.request(app, "/")
+        self.assertEqual(body, "Hello")
+        self.assertFalse("Age" in headers)
+        status, headers, body = self.request(app, "/")
+        self.assertEqual(status, "HTTP/1.1 200 OK")
+        self.assertEqual(body, "Hello")
+        self.assertEqual(headers["Age"], "0")
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.response_cache.hits, 1)
+
+    def test_uncacheable(self):
+        app = self.app([("Set-Cookie", "a=b")])
+        self.request(app, "/")
+        self.request(app, "/")
+        self.assertEqual(self.calls, 2)
+
+    def test_generator_app(self):
+        def app(environ, start_response):
+            self.calls += 1
+            start_response("200 OK", [("Content-Type", "text/plain"),
+                                      ("Cache-Control", "max-age=60")])
+            yield "Hello, "
+            yield "world"
+        self.assertEqual(self.request(app, "/")[2], "Hello, world")
+        self.assertEqual(self.request(app, "/")[2], "Hello, world")
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.response_cache.hits, 1)
+
+    def test_uncacheable_generator_app(self):
+        def app(environ, start_response):
+            self.calls += 1
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            yield "Hello, "
+            yield "world"
+        self.assertEqual(self.request(app, "/")[2], "Hello, world")
+        self.assertEqual(self.request(app, "/")[2], "Hello, world")
+        self.assertEqual(self.calls, 2)
+
+    def test_vary(self):
+        app = self.app([("Cache-Control", "max-age=60"),
+                        ("Vary", "Accept-Language")],
+                       "%(HTTP_ACCEPT_LANGUAGE)s")
+        for language in ["en", "fr", "en", "fr"]:
+            body = self.request(app, "/", [("Accept-Language", language)])[2]
+            self.assertEqual(body, language)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.response_cache.hits, 2)
+
+    def test_query_string(self):
+        app = self.app([("Cache-Control", "max-age=60")],
+                       "%(QUERY_STRING)s")
+        self.assertEqual(self.request(app, "/?a")[2], "a")
+        self.assertEqual(self.request(app, "/?b")[2], "b")
+        self.assertEqual(self.calls, 2)
+
+    def test_stampede(self):
+        gate = stackless.channel()
+        def app(environ, start_response):
+            self.calls += 1
+            gate.receive()
+            start_response("200 OK", [("Content-Type", "text/plain"),
+                                      ("Cache-Control", "max-age=60")])
+            return ["Hello"]
+        bodies = []
+        def get():
+            bodies.append(self.request(app, "/")[2])
+        for i in range(5):
+            stackless.tasklet(get)()
+        # Run them until they all wait, for the application or for its
+        # response
+        stackless.schedule()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.response_cache.coalesced, 4)
+        gate.send(None)
+        for i in range(10):
+            if len(bodies) == 5:
+                break
+            stackless.schedule()
+        self.assertEqual(bodies, ["Hello"] * 5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.response_cache.hits, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()